@@ -0,0 +1,359 @@
+# coding:utf-8
+"""
+CSV作成処理の速度を計測する
+
+netkeibaのレース結果のページと同じ構造(data_intro、race_table_01、pay_table_01)のHTMLを合成し、
+以下の処理ごとに件数/秒、馬データ1行あたりの時間(µs)、最大メモリ使用量を計測する
+- HTMLの解析(解析バックエンドごと)
+- データフレームの作成
+- csv_cleansing
+
+--save-baselineで結果を保存し、次回以降は保存した結果と比較して遅くなった処理を表示する
+(遅くなった処理がある場合は終了コード1で終了する)
+
+python benchmark.py
+python benchmark.py --races 1000 --save-baseline
+python benchmark.py --concat
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import pandas as pd
+
+import csv_cleansing
+from convert_csv_into_html import (
+    PARSE_BACKENDS,
+    ColumnarRows,
+    build_race_and_horse_lists,
+    encode_entity_ids,
+    horse_data_columns,
+    horse_data_dtypes,
+    lxml_html,
+    race_data_columns,
+    race_data_dtypes,
+)
+from id_registry import MEMORY_DB, IdRegistry
+
+# 1年分のレース数
+YEAR_RACES = 3400
+# 1レースの頭数の範囲
+MIN_HORSES = 5
+MAX_HORSES = 18
+# 乱数のシード(毎回同じデータで計測する)
+SEED = 0
+# 保存した結果のファイル
+BASELINE_FILE = "benchmark_baseline.json"
+# 保存した結果より遅いと判定する割合
+REGRESSION_THRESHOLD = 1.2
+
+# 合成するページの値の候補
+VENUES = ["札幌", "函館", "福島", "新潟", "東京", "中山", "中京", "京都", "阪神", "小倉"]
+COURSES = ["芝右1600m", "芝左2400m", "ダ右1200m", "ダ左1800m", "障芝3000m"]
+WEATHERS = ["晴", "曇", "小雨", "雨"]
+GROUND_STATUSES = ["良", "稍重", "重", "不良"]
+SEXES = ["牡", "牝", "セ"]
+MARGINS = ["", "ハナ", "アタマ", "クビ", "1/2", "3/4", "1", "1.1/2", "2", "大"]
+
+RESULT_HEADER = (
+    "<tr class=\"txt_c\"><th>着順</th><th>枠番</th><th>馬番</th><th>馬名</th><th>性齢</th>"
+    "<th>斤量</th><th>騎手</th><th>タイム</th><th>着差</th><th>ﾀｲﾑ指数</th><th>通過</th>"
+    "<th>上り</th><th>単勝</th><th>人気</th><th>馬体重</th><th>調教ﾀｲﾑ</th><th>厩舎ｺﾒﾝﾄ</th>"
+    "<th>備考</th><th>調教師</th><th>馬主</th><th>賞金(万円)</th></tr>"
+)
+
+
+def generate_race_page(rng, race_number):
+    """
+    レース結果のページを1件合成する
+
+    頭数・通過順位のコーナー数・払い戻しの表の形(複勝の数、枠連の有無)をばらつかせる
+
+    Returns:
+        tuple: (レースID, HTML)
+    """
+    # レースIDが重ならないように、番号から競馬場・回・日・レース番号を決める
+    race_round = race_number % 12 + 1
+    venue_code = race_number // 12 % len(VENUES) + 1
+    day = race_number // (12 * len(VENUES)) % 12 + 1
+    kai = race_number // (12 * len(VENUES) * 12) % 5 + 1
+    race_id = f"2024{venue_code:02d}{kai:02d}{day:02d}{race_round:02d}"
+    horse_num = rng.randint(MIN_HORSES, MAX_HORSES)
+    corners = rng.randint(2, 4)
+    rows = [RESULT_HEADER]
+    for rank in range(1, horse_num + 1):
+        passed_rank = "-".join(str(rng.randint(1, horse_num)) for _ in range(corners))
+        rows.append(
+            "<tr>"
+            f"<td class=\"txt_r\">{rank}</td>"
+            f"<td class=\"txt_c w31\"><span>{(rank - 1) * 8 // horse_num + 1}</span></td>"
+            f"<td class=\"txt_r\">{rank}</td>"
+            f"<td class=\"txt_l\"><a href=\"/horse/20{rng.randint(10, 21)}10{rng.randint(1000, 9999)}/\">サンプルホース{rank}</a></td>"
+            f"<td class=\"txt_c\">{rng.choice(SEXES)}{rng.randint(2, 9)}</td>"
+            f"<td class=\"txt_r\">{rng.choice(['54', '55', '56', '57', '58'])}</td>"
+            f"<td class=\"txt_l\"><a href=\"/jockey/result/recent/0{rng.randint(1000, 1999)}/\">騎手</a></td>"
+            f"<td class=\"txt_r\">{rng.randint(0, 3)}:{rng.randint(0, 59):02d}.{rng.randint(0, 9)}</td>"
+            f"<td class=\"txt_l\">{'' if rank == 1 else rng.choice(MARGINS)}</td>"
+            "<td class=\"speed_index\">**</td>"
+            f"<td class=\"txt_r\">{passed_rank}</td>"
+            f"<td class=\"txt_r\">{rng.uniform(33, 42):.1f}</td>"
+            f"<td class=\"txt_r\">{rng.uniform(1, 300):.1f}</td>"
+            f"<td class=\"txt_r\">{rng.randint(1, horse_num)}</td>"
+            f"<td>{rng.randint(400, 560)}({rng.randint(-10, 10):+d})</td>"
+            "<td class=\"txt_c\">**</td><td class=\"txt_c\">**</td><td class=\"txt_c\"></td>"
+            f"<td class=\"txt_l\">[東] <a href=\"/trainer/result/recent/0{rng.randint(1000, 1999)}/\">調教師</a></td>"
+            f"<td class=\"txt_l\"><a href=\"/owner/result/recent/{rng.randint(100000, 999999)}/\">馬主</a></td>"
+            f"<td class=\"txt_r\">{rng.randint(0, 5000)}.0</td>"
+            "</tr>"
+        )
+    place_count = 2 if horse_num <= 7 else 3
+    pay_rows1 = [
+        pay_row("単勝", [str(rng.randint(1, horse_num))], [rng.randint(110, 9999)]),
+        pay_row("複勝", [str(i) for i in range(1, place_count + 1)],
+                [rng.randint(100, 2000) for _ in range(place_count)]),
+    ]
+    # 8頭以下のレースは枠連を発売しない
+    if horse_num > 8:
+        pay_rows1.append(pay_row("枠連", ["1 - 2"], [rng.randint(100, 9999)]))
+    pay_rows1.append(pay_row("馬連", ["1 - 2"], [rng.randint(100, 99999)]))
+    pay_rows2 = [
+        pay_row("ワイド", ["1 - 2", "1 - 3", "2 - 3"], [rng.randint(100, 9999) for _ in range(3)]),
+        pay_row("馬単", ["1 → 2"], [rng.randint(100, 99999)]),
+        pay_row("3連複", ["1 - 2 - 3"], [rng.randint(100, 999999)]),
+        pay_row("3連単", ["1 → 2 → 3"], [rng.randint(100, 9999999)]),
+    ]
+    html = (
+        "<html><head><meta charset=\"EUC-JP\"><title>サンプル</title></head><body>"
+        "<div class=\"data_intro\"><dl class=\"racedata fc\">"
+        f"<dt>{race_round} R</dt><dd><h1>サンプルステークス</h1>"
+        f"<p><diary_snap_cut><span>{rng.choice(COURSES)}&nbsp;/&nbsp;天候 : {rng.choice(WEATHERS)}"
+        f"&nbsp;/&nbsp;芝 : {rng.choice(GROUND_STATUSES)}&nbsp;/&nbsp;発走 : 1{rng.randint(0, 6)}:{rng.randint(0, 59):02d}"
+        "</span></diary_snap_cut></p></dd></dl>"
+        f"<p class=\"smalltxt\">2024年{rng.randint(1, 12)}月{rng.randint(1, 28)}日 {kai}回{VENUES[venue_code - 1]}{day}日目 "
+        "3歳未勝利&nbsp;&nbsp;(混)[指](馬齢)</p></div>"
+        "<table class=\"race_table_01 nk_tb_common\" summary=\"レース結果\">" + "".join(rows) + "</table>"
+        "<table class=\"pay_table_01\" summary=\"払い戻し\">" + "".join(pay_rows1) + "</table>"
+        "<table class=\"pay_table_01\" summary=\"払い戻し\">" + "".join(pay_rows2) + "</table>"
+        "</body></html>"
+    )
+    return race_id, html
+
+
+def pay_row(bet_type, combinations, refunds):
+    """
+    払い戻しの表の1行を合成する(複数の組み合わせは改行で区切る)
+    """
+    return (
+        f"<tr><th>{bet_type}</th>"
+        f"<td>{'<br />'.join(combinations)}</td>"
+        f"<td class=\"txt_r\">{'<br />'.join(f'{refund:,}' for refund in refunds)}</td>"
+        f"<td class=\"txt_r\">{'<br />'.join(str(i + 1) for i in range(len(refunds)))}</td></tr>"
+    )
+
+
+def generate_race_pages(races, seed=SEED):
+    """
+    レース結果のページを合成する
+
+    Returns:
+        list: (レースID, HTML)のリスト
+    """
+    rng = random.Random(seed)
+    return [generate_race_page(rng, i) for i in range(races)]
+
+
+def parse_pages(pages, backend):
+    """
+    合成したページを解析する
+
+    Returns:
+        list: (race_list, horse_list_list, payout_list_list)のリスト
+    """
+    extract_race_page = PARSE_BACKENDS[backend]
+    return [build_race_and_horse_lists(race_id, extract_race_page(html)) for race_id, html in pages]
+
+
+def build_frames_with_concat(parsed):
+    """
+    従来の方法(1行ごとにpd.concat)でデータフレームを作成する
+    """
+    registry = IdRegistry(MEMORY_DB)
+    race_df = pd.DataFrame(columns=race_data_columns)
+    horse_df = pd.DataFrame(columns=horse_data_columns)
+    for race_list, horse_list_list, _ in parsed:
+        for horse_list in horse_list_list:
+            horse_se = pd.Series(encode_entity_ids(horse_list, registry), index=horse_df.columns)
+            horse_df = pd.concat([horse_df, horse_se.to_frame().T], ignore_index=True)
+        race_se = pd.Series(race_list, index=race_df.columns)
+        race_df = pd.concat([race_df, race_se.to_frame().T], ignore_index=True)
+    return race_df, horse_df
+
+
+def build_frames_with_columnar_rows(parsed):
+    """
+    ColumnarRowsでデータフレームを作成する(キー番号はメモリ上のIdRegistryでコードにする)
+    """
+    registry = IdRegistry(MEMORY_DB)
+    race_rows = ColumnarRows(race_data_columns, race_data_dtypes)
+    horse_rows = ColumnarRows(horse_data_columns, horse_data_dtypes)
+    for race_list, horse_list_list, _ in parsed:
+        race_rows.append(race_list)
+        for horse_list in horse_list_list:
+            horse_rows.append(encode_entity_ids(horse_list, registry))
+    return race_rows.to_frame(), horse_rows.to_frame()
+
+
+def run_csv_cleansing(csv_dir):
+    """
+    csv_dirに保存したCSVでcsv_cleansingを実行する(前回の加工結果は使わない)
+    """
+    csv_cleansing.CSV_DIR = csv_dir
+    csv_cleansing.PROCESSED_DIR = csv_dir + "processed/"
+    csv_cleansing.CLEANSING_MANIFEST = csv_dir + "cleansing.json"
+    csv_cleansing.FROM_YEAR = 2024
+    csv_cleansing.CURRENT_YEAR = 2024
+    csv_cleansing.csv_cleansing(use_cache=False)
+
+
+def measure(function, *args, memory=True):
+    """
+    処理時間(秒)と最大メモリ使用量(バイト)と戻り値を返す
+
+    メモリ使用量の計測は処理を遅くするため、時間とは別にもう1度実行して計測する
+    """
+    start = time.perf_counter()
+    result = function(*args)
+    elapsed = time.perf_counter() - start
+    peak = None
+    if memory:
+        tracemalloc.start()
+        function(*args)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return elapsed, peak, result
+
+
+def run_benchmark(races, memory=True):
+    """
+    処理ごとの計測結果を返す
+
+    Returns:
+        dict: 処理名ごとの{seconds, files_per_sec, us_per_row, peak_mb}
+    """
+    pages = generate_race_pages(races)
+    results = {}
+    parsed = None
+    backends = [name for name in PARSE_BACKENDS if name != "lxml" or lxml_html is not None]
+    for backend in backends:
+        elapsed, peak, backend_parsed = measure(parse_pages, pages, backend, memory=memory)
+        parsed = parsed or backend_parsed
+        results["parse_" + backend] = elapsed, peak
+    horse_rows = sum(len(horse_list_list) for _, horse_list_list, _ in parsed)
+    elapsed, peak, (race_df, horse_df) = measure(build_frames_with_columnar_rows, parsed, memory=memory)
+    results["build_frames"] = elapsed, peak
+    with tempfile.TemporaryDirectory() as csv_dir:
+        csv_dir += "/"
+        race_df.to_csv(csv_dir + "race-2024.csv", header=True, index=False)
+        horse_df.to_csv(csv_dir + "horse-2024.csv", header=True, index=False)
+        elapsed, peak, _ = measure(run_csv_cleansing, csv_dir, memory=memory)
+        results["csv_cleansing"] = elapsed, peak
+    print(f"レース: {races}件、馬: {horse_rows}行")
+    return {
+        name: {
+            "seconds": elapsed,
+            "files_per_sec": races / elapsed,
+            "us_per_row": elapsed / horse_rows * 1e6,
+            "peak_mb": None if peak is None else peak / 1024 / 1024,
+        }
+        for name, (elapsed, peak) in results.items()
+    }
+
+
+def print_results(results, baseline=None):
+    """
+    計測結果を表示し、保存した結果より遅くなった処理名のリストを返す
+    """
+    regressions = []
+    for name, result in results.items():
+        line = f"{name}: {result['files_per_sec']:.1f}件/秒、{result['us_per_row']:.2f}µs/行"
+        if result["peak_mb"] is not None:
+            line += f"、最大{result['peak_mb']:.1f}MB"
+        if baseline and name in baseline:
+            ratio = result["us_per_row"] / baseline[name]["us_per_row"]
+            line += f"(基準の{ratio:.2f}倍)"
+            if ratio > REGRESSION_THRESHOLD:
+                line += " 遅くなっています"
+                regressions.append(name)
+        print(line)
+    return regressions
+
+
+def compare_concat(races):
+    """
+    1行ごとにpd.concatする従来の方法とColumnarRowsでデータフレームを作成する時間を比較する
+    """
+    parsed = parse_pages(generate_race_pages(races), "bs4")
+    horse_rows = sum(len(horse_list_list) for _, horse_list_list, _ in parsed)
+    print(f"レース: {races}件、馬: {horse_rows}行")
+    columnar_time, _, (race_df, horse_df) = measure(build_frames_with_columnar_rows, parsed, memory=False)
+    print(f"ColumnarRows: {columnar_time:.3f}秒 ({columnar_time / horse_rows * 1e6:.2f}µs/行)")
+    concat_time, _, (concat_race_df, concat_horse_df) = measure(build_frames_with_concat, parsed, memory=False)
+    print(f"pd.concat: {concat_time:.3f}秒 ({concat_time / horse_rows * 1e6:.2f}µs/行)")
+    print(f"速度比: {concat_time / columnar_time:.1f}倍")
+    # CSVに書き出す内容が同じであることを確認する
+    if not (race_df.to_csv(index=False) == concat_race_df.to_csv(index=False)
+            and horse_df.to_csv(index=False) == concat_horse_df.to_csv(index=False)):
+        raise AssertionError("作成したデータフレームの内容が一致しません")
+
+
+if __name__ == "__main__":
+    # コマンドライン引数のパーサーを設定
+    parser = argparse.ArgumentParser(description="CSV作成処理の速度を計測します")
+    parser.add_argument(
+        "--races",
+        type=int,
+        default=YEAR_RACES,
+        help="合成するレース数を指定します（省略時は1年分）",
+    )
+    parser.add_argument(
+        "--baseline",
+        default=BASELINE_FILE,
+        help="比較・保存する結果のファイルを指定します",
+    )
+    parser.add_argument(
+        "--save-baseline",
+        action="store_true",
+        help="計測結果を比較の基準として保存します",
+    )
+    parser.add_argument(
+        "--no-memory",
+        action="store_true",
+        help="最大メモリ使用量の計測を省略します",
+    )
+    parser.add_argument(
+        "--concat",
+        action="store_true",
+        help="従来の方法(1行ごとにpd.concat)とデータフレームの作成時間を比較します",
+    )
+    args = parser.parse_args()
+
+    if args.concat:
+        compare_concat(args.races)
+        sys.exit(0)
+    results = run_benchmark(args.races, memory=not args.no_memory)
+    baseline = None
+    if os.path.isfile(args.baseline) and not args.save_baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+    regressions = print_results(results, baseline)
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(args.baseline + "に保存しました")
+    if regressions:
+        sys.exit(1)
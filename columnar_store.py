@@ -0,0 +1,205 @@
+# coding:utf-8
+"""
+変換したレースデータ・馬データを年月単位の列指向の形式で保存・読み込みする
+
+<テーブル名>/year=yyyy/month=mm/ に1か月分を保存し、
+読み込み時は必要な列(列の射影)と必要な年月のフォルダ(パーティションの絞り込み)のみを読む
+pyarrowがインストールされている場合はParquet(part.parquet)、
+インストールされていない場合は列ごとのNumPy配列(<列名>.npy、欠損値は<列名>.mask.npy)で保存し、
+NumPy配列はメモリマップで読み込む
+"""
+import configparser
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+config = configparser.ConfigParser()
+config.read(os.getcwd() + "/config.ini", encoding="utf-8")
+
+# 列指向の形式のデータを格納するフォルダ
+COLUMNAR_DIR = os.getcwd() + config.get("DIR", "COLUMNAR_DIR", fallback="/columnar/")
+# 保存形式(auto: pyarrowがあればparquet、なければnpy、none: 保存しない)
+COLUMNAR_FORMAT = config.get("CONST", "COLUMNAR_FORMAT", fallback="auto")
+
+# Parquetのファイル名
+PARQUET_FILE = "part.parquet"
+# NumPy配列の形式の列の型などを記録するファイル名
+SCHEMA_FILE = "_schema.json"
+# NumPy配列の拡張子
+NPY_SUFFIX = ".npy"
+# 欠損値の位置を記録するNumPy配列の拡張子
+MASK_SUFFIX = ".mask.npy"
+
+
+def get_columnar_format():
+    """
+    保存形式(parquet, npy, none)を返す
+    """
+    if COLUMNAR_FORMAT == "auto":
+        return "parquet" if pyarrow is not None else "npy"
+    return COLUMNAR_FORMAT
+
+
+class ColumnarStore:
+    """
+    base_dir配下にテーブルごと・年月ごとにデータフレームを保存・読み込みする
+
+    Args:
+        base_dir: 保存先のフォルダ(末尾にスラッシュを含む)
+        file_format: parquet or npy(省略時はget_columnar_format)
+    """
+
+    def __init__(self, base_dir=COLUMNAR_DIR, file_format=None):
+        self.base_dir = base_dir
+        self.file_format = file_format or get_columnar_format()
+
+    def partition_dir(self, table, year, month):
+        return self.base_dir + f"{table}/year={year}/month={month:02d}"
+
+    def write_year(self, table, year, df, months):
+        """
+        1年分のデータフレームを月ごとに分けて保存し、データのない月のフォルダは削除する
+
+        Args:
+            table: テーブル名(race, horse)
+            year: 対象年
+            df: 1年分のデータフレーム
+            months: dfの行ごとの月(Seriesまたは配列)
+        """
+        months = np.asarray(months)
+        for month in range(1, 13):
+            rows = months == month
+            if rows.any():
+                self.write_partition(table, year, month, df[rows].reset_index(drop=True))
+            else:
+                self.delete_partition(table, year, month)
+
+    def write_partition(self, table, year, month, df):
+        """
+        1か月分のデータフレームを保存する(既存のデータは置き換える)
+        """
+        partition_dir = self.partition_dir(table, year, month)
+        tmp_dir = partition_dir + ".tmp"
+        if os.path.isdir(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        os.makedirs(tmp_dir)
+        if self.file_format == "parquet":
+            df.to_parquet(tmp_dir + "/" + PARQUET_FILE, index=False)
+        else:
+            write_npy_partition(tmp_dir, df)
+        # 書き込みが終わってから入れ替え、読み込み中に途中のデータが見えないようにする
+        self.delete_partition(table, year, month)
+        os.rename(tmp_dir, partition_dir)
+
+    def delete_partition(self, table, year, month):
+        partition_dir = self.partition_dir(table, year, month)
+        if os.path.isdir(partition_dir):
+            shutil.rmtree(partition_dir)
+
+    def list_partitions(self, table, years=None, months=None):
+        """
+        保存されている(年, 月)を年月の順に返す
+
+        Args:
+            years: 対象年のリスト(省略時は全ての年)
+            months: 対象月のリスト(省略時は全ての月)
+        """
+        table_dir = self.base_dir + table + "/"
+        if not os.path.isdir(table_dir):
+            return []
+        partitions = []
+        for year_name in os.listdir(table_dir):
+            if not year_name.startswith("year="):
+                continue
+            year = int(year_name[len("year="):])
+            if years is not None and year not in years:
+                continue
+            for month_name in os.listdir(table_dir + year_name):
+                if not month_name.startswith("month=") or month_name.endswith(".tmp"):
+                    continue
+                month = int(month_name[len("month="):])
+                if months is not None and month not in months:
+                    continue
+                partitions.append((year, month))
+        return sorted(partitions)
+
+    def read(self, table, columns=None, years=None, months=None):
+        """
+        データフレームを読み込む
+
+        Args:
+            table: テーブル名(race, horse)
+            columns: 読み込む列のリスト(省略時は全ての列)
+            years: 読み込む年のリスト(省略時は全ての年)
+            months: 読み込む月のリスト(省略時は全ての月)
+
+        Returns:
+            pandas.DataFrame: 年月の順に連結したデータフレーム
+        """
+        frames = []
+        for year, month in self.list_partitions(table, years, months):
+            partition_dir = self.partition_dir(table, year, month)
+            if os.path.isfile(partition_dir + "/" + PARQUET_FILE):
+                frames.append(pd.read_parquet(partition_dir + "/" + PARQUET_FILE, columns=columns))
+            else:
+                frames.append(read_npy_partition(partition_dir, columns))
+        if not frames:
+            return pd.DataFrame(columns=columns)
+        return pd.concat(frames, ignore_index=True)
+
+
+def write_npy_partition(partition_dir, df):
+    """
+    列ごとにNumPy配列として保存する
+
+    文字列の列は固定長の文字列の配列にし、欠損値のある列は欠損値の位置も保存する
+    """
+    dtypes = {}
+    for column in df.columns:
+        series = df[column]
+        mask = series.isna().to_numpy()
+        if pd.api.types.is_float_dtype(series.dtype):
+            values = series.to_numpy(dtype="float64")
+            dtypes[column] = "float64"
+        elif pd.api.types.is_integer_dtype(series.dtype):
+            values = series.to_numpy(dtype="int64", na_value=0)
+            dtypes[column] = "Int64"
+        else:
+            values = np.array(series.fillna("").astype(str).tolist(), dtype=str)
+            dtypes[column] = "object"
+        np.save(partition_dir + "/" + column + NPY_SUFFIX, values)
+        if dtypes[column] != "float64" and mask.any():
+            np.save(partition_dir + "/" + column + MASK_SUFFIX, mask)
+    with open(partition_dir + "/" + SCHEMA_FILE, "w", encoding="utf-8") as f:
+        json.dump({"columns": list(df.columns), "dtypes": dtypes, "rows": len(df)}, f)
+
+
+def read_npy_partition(partition_dir, columns=None):
+    """
+    列ごとのNumPy配列をメモリマップで読み込む(指定した列のファイルのみを開く)
+    """
+    with open(partition_dir + "/" + SCHEMA_FILE, "r", encoding="utf-8") as f:
+        schema = json.load(f)
+    data = {}
+    for column in columns or schema["columns"]:
+        values = np.load(partition_dir + "/" + column + NPY_SUFFIX, mmap_mode="r")
+        mask_file = partition_dir + "/" + column + MASK_SUFFIX
+        mask = np.load(mask_file) if os.path.isfile(mask_file) else np.zeros(len(values), dtype=bool)
+        dtype = schema["dtypes"][column]
+        if dtype == "float64":
+            data[column] = pd.Series(values)
+        elif dtype == "Int64":
+            data[column] = pd.Series(pd.arrays.IntegerArray(np.asarray(values), mask))
+        else:
+            series = pd.Series(values.astype(object))
+            series[mask] = None
+            data[column] = series
+    return pd.DataFrame(data, columns=list(data))
@@ -0,0 +1,94 @@
+# coding:utf-8
+"""
+保存したHTMLを全ての解析バックエンドで解析し、結果が一致することを確認する
+
+バックエンドごとの処理時間も表示する。一致しないHTMLがあった場合は終了コード1で終了する
+
+python compare_parse_backends.py 2024
+python compare_parse_backends.py 2024 --month 5
+"""
+import argparse
+import sys
+import time
+
+from convert_csv_into_html import (
+    PARSE_BACKENDS,
+    build_race_and_horse_lists,
+    html_store,
+    lxml_html,
+    read_race_html,
+)
+
+
+def compare_parse_backends(year, months=range(1, 13)):
+    """
+    対象年月のHTMLを全てのバックエンドで解析して結果を比較する
+
+    Returns:
+        list: (レースID, 内容)の不一致のリスト
+    """
+    backends = [name for name in PARSE_BACKENDS if name != 'lxml' or lxml_html is not None]
+    elapsed = dict.fromkeys(backends, 0.0)
+    mismatches = []
+    total = 0
+    for month in months:
+        for race_id in sorted(html_store.list_keys(year, month)):
+            html = read_race_html(year, month, race_id)
+            total += 1
+            results = {}
+            for backend in backends:
+                start = time.perf_counter()
+                try:
+                    results[backend] = build_race_and_horse_lists(
+                        race_id, PARSE_BACKENDS[backend](html))
+                except Exception as e:
+                    # 例外の種類は問わず、全てのバックエンドで失敗すれば一致とみなす
+                    results[backend] = "error"
+                    if backend == backends[0]:
+                        print(f"{race_id}: {backend}で解析に失敗しました ({e})", file=sys.stderr)
+                elapsed[backend] += time.perf_counter() - start
+            expected = results[backends[0]]
+            for backend in backends[1:]:
+                if results[backend] != expected:
+                    mismatches.append((race_id, describe_mismatch(backends[0], expected, backend, results[backend])))
+    print(f"{year}年のHTML{total}件を比較しました")
+    for backend in backends:
+        rate = total / elapsed[backend] if elapsed[backend] else 0
+        print(f"{backend}: {elapsed[backend]:.2f}秒 ({rate:.1f}件/秒)")
+    return mismatches
+
+
+def describe_mismatch(expected_backend, expected, actual_backend, actual):
+    """
+    最初に一致しない値を説明する文字列を返す
+    """
+    if expected == "error" or actual == "error":
+        return f"{expected_backend}: {expected if expected == 'error' else 'ok'}、{actual_backend}: {actual if actual == 'error' else 'ok'}"
+    # レースデータ、馬データ、払い戻しデータの順に比較する
+    expected_rows = [expected[0]] + expected[1] + expected[2]
+    actual_rows = [actual[0]] + actual[1] + actual[2]
+    if len(expected_rows) != len(actual_rows):
+        return f"行数 {expected_backend}: {len(expected_rows)}、{actual_backend}: {len(actual_rows)}"
+    for row_number, (expected_row, actual_row) in enumerate(zip(expected_rows, actual_rows)):
+        if expected_row != actual_row:
+            for column, (expected_value, actual_value) in enumerate(zip(expected_row, actual_row)):
+                if expected_value != actual_value:
+                    return f"{row_number}行{column}列 {expected_backend}: {expected_value!r}、{actual_backend}: {actual_value!r}"
+            return f"{row_number}行の列数 {expected_backend}: {len(expected_row)}、{actual_backend}: {len(actual_row)}"
+    return ""
+
+
+if __name__ == "__main__":
+    # コマンドライン引数のパーサーを設定
+    parser = argparse.ArgumentParser(description="解析バックエンドの結果が一致することを確認します")
+    parser.add_argument("year", type=int, help="比較する年を指定します")
+    parser.add_argument("--month", type=int, help="比較する月を指定します（省略時は全ての月）")
+    args = parser.parse_args()
+
+    mismatches = compare_parse_backends(
+        args.year, [args.month] if args.month else range(1, 13))
+    for race_id, detail in mismatches:
+        print(f"{race_id}: {detail}")
+    if mismatches:
+        print(f"{len(mismatches)}件が一致しません")
+        sys.exit(1)
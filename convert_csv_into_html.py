@@ -3,17 +3,39 @@
 """
 htmlディレクトリに存在するHTMLファイルからCSVファイルを作成する
 """
+import argparse
+import functools
+import hashlib
+import json
 import logging
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from os import path
 import os
 import re
+import sys
 import pandas as pd
 import numpy as np
 from bs4 import BeautifulSoup
+try:
+    from lxml import etree
+    from lxml import html as lxml_html
+except ImportError:
+    etree = None
+    lxml_html = None
 import pytz
 import time
 import datetime
 import configparser
+from columnar_store import ColumnarStore
+from html_store import HtmlStore
+from id_registry import IdRegistry
+from payout_table import (
+    BET_TYPE_NAMES,
+    MAX_NUMBERS,
+    UNORDERED_BET_TYPES,
+    encode_combination,
+)
 
 # --------------------------------------------------
 # configparserの宣言とiniファイルの読み込み
@@ -26,12 +48,38 @@ now_datetime = datetime.datetime.now(pytz.timezone('Asia/Tokyo'))
 OWN_FILE_NAME = path.splitext(path.basename(__file__))[0]
 # htmlファイルが格納されているフォルダ
 RACE_HTML_DIR = os.getcwd() + config.get('DIR', 'RACE_HTML_DIR')
+# htmlの保存先
+html_store = HtmlStore(RACE_HTML_DIR)
 # csvファイルを格納するフォルダ
 CSV_DIR = os.getcwd() + config.get('DIR', 'CSV_DIR')
+# 列指向の形式の保存先
+columnar_store = ColumnarStore()
+# 馬・騎手・調教師・馬主のキー番号のコード
+id_registry = IdRegistry()
+# 変換の記録を格納するフォルダ
+STATE_DIR = os.getcwd() + config.get('DIR', 'STATE_DIR')
 # ログファイル名
 logger = logging.getLogger(__name__)
 # CSVを作成する開始年
 FROM_YEAR = config.getint('CONST', 'FROM_YEAR')
+# get_race_htmlが保存したスナップショットの先頭の文字コードの記録
+SNAPSHOT_HEADER_PATTERN = re.compile(rb'<!-- snapshot charset=([\w-]+) -->\n')
+# 解析処理のバージョン(変換結果が変わる修正をした場合は上げ、全てのHTMLを変換し直す)
+PARSER_VERSION = 3
+# HTMLの解析に使うバックエンド(bs4 or lxml)
+PARSE_BACKEND = config.get('CONST', 'PARSE_BACKEND', fallback='bs4')
+# レース結果のうちリンクからキー番号を取得する列(馬、騎手、調教師、馬主)
+RESULT_LINK_COLUMNS = (3, 6, 18, 19)
+# 並列で解析する場合に1つのプロセスにまとめて渡すHTMLの件数
+PARSE_BATCH_SIZE = 64
+# 並列で解析する場合にHTMLを先読みするスレッド数
+PREFETCH_THREADS = 2
+# ストリーミング変換でCSVに追記してチェックポイントを保存する間隔(レース数)
+STREAM_FLUSH_RACES = 200
+# ストリーミング変換で既存のCSVを分割して読み込む行数
+STREAM_CHUNK_ROWS = 50000
+# 変換の記録に保存するチェックポイントのキー(レースIDと重ならない)
+CHECKPOINT_KEY = '_checkpoint'
 
 # レースデータのCSVフォーマット
 race_data_columns = [
@@ -49,10 +97,12 @@ race_data_columns = [
     'ground_status',
     # 発走時間
     'time',
-    # 開催日
+    # 開催日(yyyy-mm-dd)
     'date',
     # 開催情報(何回 + 競馬場 + 何日目)
-    'race_information',
+    'kai',
+    'venue',
+    'day',
     # 頭数
     'total_horse_numbers',
     # 1着の枠番
@@ -93,27 +143,32 @@ race_data_columns = [
 horse_data_columns = [
     # レースID(htmlのファイル名)
     'race_id',
-    # 順位
+    # 順位(中止・除外などは文字のまま)
     'rank',
     # 枠番
     'bracket_number',
     # 馬番
     'horse_number',
-    # 馬のキー番号
-    'horse_id',
-    # 性別 + 年齢
-    'sex_and_age',
+    # 馬のコード(キー番号にid_registryで割り当てた整数)
+    'horse_code',
+    # 性別
+    'sex',
+    # 年齢
+    'age',
     # 斤量
     'jockey_weight',
-    # 騎手のキー番号
-    'jockey_id',
-    # タイム
+    # 騎手のコード
+    'jockey_code',
+    # タイム(秒)
     'goal_time',
     # 着差
     'margin',
-    # 通過順位
-    'passed_rank',
-    # 上りタイム
+    # 通過順位(1～4コーナー。コーナーが4つ未満の場合は最終コーナーに揃え、前を空ける)
+    'passed_rank_1',
+    'passed_rank_2',
+    'passed_rank_3',
+    'passed_rank_4',
+    # 上りタイム(秒)
     'last_three_furlong_time',
     # 単勝オッズ
     'odds',
@@ -121,97 +176,840 @@ horse_data_columns = [
     'popular',
     # 馬体重
     'horse_weight',
-    # 調教師のキー番号
-    'trainer_id',
-    # 馬主のキー番号
-    'owner_id'
+    # 馬体重の増減
+    'horse_weight_change',
+    # 調教師のコード
+    'trainer_code',
+    # 馬主のコード
+    'owner_code'
+]
+
+# 払い戻しデータのCSVフォーマット(券種・組み合わせごとに1行)
+payout_data_columns = [
+    # レースID(htmlのファイル名)
+    'race_id',
+    # 券種(payout_table.BET_TYPES)
+    'bet_type',
+    # 組み合わせの馬番(枠連は枠番。順序を問わない券種は昇順、使わない列は空)
+    'number_1',
+    'number_2',
+    'number_3',
+    # 組み合わせを1つにした整数(payout_table.encode_combination)
+    'combination',
+    # 払戻金
+    'payout'
 ]
 
+# 数値の列の型(欠損値を扱えるInt64とfloat64)。記載のない列は文字列
+race_data_dtypes = dict(
+    {column: 'Int64' for column in race_data_columns if column.startswith('refund_for_')},
+    race_round='Int64', kai='Int64', day='Int64', total_horse_numbers='Int64',
+    bracket_number_in_first='Int64', horse_number_in_first='Int64',
+    bracket_number_in_second='Int64', horse_number_in_second='Int64',
+    bracket_number_in_third='Int64', horse_number_in_third='Int64',
+)
+horse_data_dtypes = dict(
+    {column: 'Int64' for column in horse_data_columns if column.startswith('passed_rank_')},
+    bracket_number='Int64', horse_number='Int64', age='Int64', jockey_weight='float64',
+    goal_time='float64', last_three_furlong_time='float64', odds='float64',
+    popular='Int64', horse_weight='Int64', horse_weight_change='Int64',
+    horse_code='Int64', jockey_code='Int64', trainer_code='Int64', owner_code='Int64',
+)
+payout_data_dtypes = {
+    'number_1': 'Int64', 'number_2': 'Int64', 'number_3': 'Int64',
+    'combination': 'Int64', 'payout': 'Int64',
+}
+# レースデータの払戻金の列に入れる券種と件数(race_data_columnsの順)
+REFUND_COLUMN_COUNTS = [
+    ('win', 1),
+    ('place', 3),
+    ('bracket_quinella', 1),
+    ('quinella', 1),
+    ('quinella_place', 3),
+    ('exacta', 1),
+    ('trio', 1),
+    ('trifecta', 1),
+]
+# 変換結果のテーブルごとの列と数値の列の型(CSVファイルは<テーブル名>-yyyy.csv)
+CONVERT_TABLES = {
+    'race': (race_data_columns, race_data_dtypes),
+    'horse': (horse_data_columns, horse_data_dtypes),
+    'payout': (payout_data_columns, payout_data_dtypes),
+}
+# 馬データのうちキー番号をコードにする列と種類
+ENTITY_CODE_COLUMNS = {
+    'horse_code': 'horse',
+    'jockey_code': 'jockey',
+    'trainer_code': 'trainer',
+    'owner_code': 'owner',
+}
+# コードにする列の位置と種類
+ENTITY_CODE_POSITIONS = [
+    (horse_data_columns.index(column), kind) for column, kind in ENTITY_CODE_COLUMNS.items()
+]
+# 通過順位の列数
+CORNER_COUNT = 4
+# 数字以外の文字(払戻金のカンマなど)
+NON_DIGIT_PATTERN = re.compile(r'[^\d]')
+# タイム(例: 1:34.5、58.9)
+GOAL_TIME_PATTERN = re.compile(r'(?:(\d+):)?(\d+(?:\.\d+)?)')
+# 馬体重(例: 480(+4)、計不)
+HORSE_WEIGHT_PATTERN = re.compile(r'(\d+)(?:\(([+-]?\d+)\))?')
+# 性別 + 年齢(例: 牡3)
+SEX_AND_AGE_PATTERN = re.compile(r'(\D+)(\d+)')
+# 開催日(例: 2023年1月5日)
+DATE_PATTERN = re.compile(r'(\d+)年(\d+)月(\d+)日')
+# 開催情報(例: 1回中山1日目)
+RACE_INFORMATION_PATTERN = re.compile(r'(\d+)回(\D+?)(\d+)日目')
+# 払い戻しの組み合わせの馬番(例: 1 - 2、1 → 2 → 3)
+COMBINATION_NUMBER_PATTERN = re.compile(r'\d+')
+
+
+class ColumnarRows:
+    """
+    1行ずつ追加したデータを列ごとのリストに溜め、最後に1度だけデータフレームにする
+
+    1行ごとにpd.concatするとそれまでの全行をコピーするため、行数の2乗の時間がかかる
+
+    Args:
+        columns: 列名のリスト
+        dtypes: 列名ごとの型(記載のない列は推定する)
+    """
+
+    def __init__(self, columns, dtypes=None):
+        self.columns = list(columns)
+        self.dtypes = dtypes or {}
+        self._buffers = [[] for _ in self.columns]
+
+    def __len__(self):
+        return len(self._buffers[0]) if self._buffers else 0
+
+    def append(self, row):
+        if len(row) != len(self.columns):
+            raise ValueError(
+                f"列数が一致しません (列: {len(self.columns)}、値: {len(row)})")
+        for buffer, value in zip(self._buffers, row):
+            buffer.append(value)
+
+    def to_frame(self):
+        return pd.DataFrame({
+            column: pd.Series(buffer, dtype=self.dtypes.get(column, object))
+            for column, buffer in zip(self.columns, self._buffers)
+        }, columns=self.columns)
+
+
+def convert_csv_into_html(workers=1, stream=False):
+    """
+    対象期間のデータを年単位でCSVに変換する
+
+    Args:
+        workers: HTMLを解析するプロセス数(1のときは並列化しない)
+        stream: Trueのときは解析した行を一定件数ごとにCSVに追記する(メモリ使用量が年の大きさによらない)
+    """
+    if workers <= 1:
+        for year in range(FROM_YEAR, now_datetime.year + 1):
+            convert_csv_into_html_by_year(year, stream=stream)
+        return
+    logger.info(str(workers) + "プロセスでHTMLを解析します")
+    # プロセスの起動は1度だけ行い、全ての年で使い回す
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for year in range(FROM_YEAR, now_datetime.year + 1):
+            convert_csv_into_html_by_year(year, pool, workers, stream=stream)
+
 
-def convert_csv_into_html():
-    # 対象期間のデータを年単位でCSVに変換
-    for year in range(FROM_YEAR, now_datetime.year + 1):
-        convert_csv_into_html_by_year(year)
+def convert_csv_into_html_by_year(year, pool=None, workers=1, stream=False):
+    """
+    対象年のHTMLのうち、前回の変換から追加・変更されたもののみを解析してCSVに反映する
 
+    HTMLごとの変更の判定情報・ハッシュ値・解析処理のバージョン・作成した行数を
+    変換の記録(state/convert-yyyy.json)に保存し、
+    変更されたHTMLの行は置き換え、削除されたHTMLの行は削除する
+    解析に失敗したHTMLはエラーを記録して隔離し、変更されるまで解析し直さない
 
-def convert_csv_into_html_by_year(year):
-    # レースデータのCSVファイル名
-    race_data_csv = CSV_DIR + "race-" + str(year) + ".csv"
-    # 馬データのCSVファイル名
-    horse_data_csv = CSV_DIR + "/horse-" + str(year) + ".csv"
-    # ファイルが存在しなければ新規作成
-    if not ((os.path.isfile(race_data_csv)) and (os.path.isfile(horse_data_csv))):
-        # レースデータのデータフレームを作成
-        race_df = pd.DataFrame(columns=race_data_columns)
-        # 馬データのデータフレームを作成
-        horse_df = pd.DataFrame(columns=horse_data_columns)
+    Args:
+        year: 対象年
+        pool: HTMLを解析するProcessPoolExecutor(省略時は並列化しない)
+        workers: poolのプロセス数
+        stream: Trueのときはstream_convert_year、Falseのときはbatch_convert_yearで変換する
+    """
+    # テーブルごとのCSVファイル名
+    csv_files = get_csv_files(year)
+    # 前回のストリーミング変換が中断していれば最後のチェックポイントの状態に戻す
+    restore_convert_checkpoint(year)
+    manifest = load_convert_manifest(year)
+    # CSVファイルが存在しないか、列が現在のフォーマットと異なれば全てのHTMLを変換し直す
+    if not all(is_current_csv(csv_files[table], columns)
+               for table, (columns, _) in CONVERT_TABLES.items()):
+        manifest = {}
+        for csv_file in csv_files.values():
+            if os.path.isfile(csv_file):
+                os.remove(csv_file)
         logger.info(str(year) + "年のCSVファイルを新規作成します")
-        #
-        total = 0
-        for month in range(1, 13):
-            # 対象年月のhtmlフォルダ
-            html_dir = RACE_HTML_DIR + \
-                str(year) + "/" + str('{0:02d}'.format(month))
-            # 対象年月のhtmlフォルダが存在する場合のみ処理を行う
-            if os.path.isdir(html_dir):
-                # ファイル一覧を取得
-                file_list = os.listdir(html_dir)
-                # ファイルのリスト数を加算
-                total += len(file_list)
-                logger.info(str(year) + "年" + str('{0:02d}'.format(month)) + "月のHTMLを" +
-                            str(len(file_list)) + "件変換します")
-                # ファイル一覧の数だけループ
-                for file_name in file_list:
-                    with open(html_dir + "/" + file_name, "r") as f:
-                        html = f.read()
-                        list = file_name.split(".")
-                        race_id = list[-2]
-                        race_list, horse_list_list = get_rade_and_horse_data_by_html(
-                            race_id, html)
-                        for horse_list in horse_list_list:
-                            horse_se = pd.Series(
-                                horse_list, index=horse_df.columns
-                            )
-                            # pandas 2.x では DataFrame.append は削除されたため、pd.concat を使用
-                            horse_df = pd.concat(
-                                [horse_df, horse_se.to_frame().T],
-                                ignore_index=True,
-                            )
-                        race_se = pd.Series(race_list, index=race_df.columns)
-                        race_df = pd.concat(
-                            [race_df, race_se.to_frame().T],
-                            ignore_index=True,
-                        )
-        # ヘッダーありインデックスなしでCSVを保存
-        race_df.to_csv(race_data_csv, header=True, index=False)
-        horse_df.to_csv(horse_data_csv, header=True, index=False)
-        logger.info(
-            "レースデータ" + str(race_df.shape[0]) + "行、" + str(race_df.shape[1]) + "列に変換しました")
-        logger.info(
-            "馬データ" + str(horse_df.shape[0]) + "行、" + str(horse_df.shape[1]) + "列に変換しました")
-        logger.info(str(year) + "年のHTMLを" + str(total) + "件変換しました")
+    # 保存されているHTMLのレースIDごとの(月, 変更の判定情報)
+    stats = {}
+    # 変換するHTMLの(年, 月, レースID, 前回のハッシュ値)のリスト
+    targets = []
+    for month in range(1, 13):
+        # 対象年月のHTMLのレースID一覧を取得
+        for race_id in sorted(html_store.list_keys(year, month)):
+            stat = html_store.stat(year, month, race_id)
+            stats[race_id] = (month, stat)
+            entry = manifest.get(race_id)
+            if entry is not None and entry['parser_version'] == PARSER_VERSION:
+                if entry['month'] == month and entry['stat'] == stat:
+                    continue
+                targets.append((year, month, race_id, entry['hash']))
+            else:
+                targets.append((year, month, race_id, None))
+    removed = set(manifest) - set(stats)
+    # 列指向の形式で保存していない年はCSVから保存し直す
+    missing_columnar = (columnar_store.file_format != 'none' and bool(stats)
+                        and not all(columnar_store.list_partitions(table, [year])
+                                    for table in CONVERT_TABLES))
+    if not targets and not removed and not missing_columnar:
+        # 変更がない場合はログ出力のみ行う
+        logger.info(str(year) + "年は変更がないためスキップします")
+        return
+    logger.info(str(year) + "年のHTMLを" + str(len(targets)) + "件確認します")
+    convert_year = stream_convert_year if stream else batch_convert_year
+    converted, quarantined = convert_year(
+        year, csv_files, manifest, stats, targets, removed, pool, workers)
+    logger.info(str(year) + "年のHTMLを" + str(converted) + "件変換、" + str(len(removed)) +
+                "件削除し、" + str(quarantined) + "件隔離しました")
+
+
+def get_csv_files(year):
+    """
+    テーブルごとのCSVファイル名(<テーブル名>-yyyy.csv)を返す
+    """
+    return {table: CSV_DIR + table + "-" + str(year) + ".csv" for table in CONVERT_TABLES}
+
+
+def new_table_rows():
+    """
+    テーブルごとに行を列ごとに溜めるColumnarRowsを返す
+    """
+    return {table: ColumnarRows(columns, dtypes) for table, (columns, dtypes) in CONVERT_TABLES.items()}
+
+
+def batch_convert_year(year, csv_files, manifest, stats, targets, removed, pool=None, workers=1):
+    """
+    1年分の行をメモリ上で既存のCSVと合わせ、月、レースIDの順に並べて保存する
+
+    Returns:
+        tuple: (変換した件数, 隔離した件数)
+    """
+    # レースデータ・馬データ・払い戻しデータを列ごとに溜める
+    table_rows = new_table_rows()
+    # 行を置き換えるレースID
+    replaced = set(removed)
+    counts = {'converted': 0, 'quarantined': 0}
+    # 並列で解析した場合もtargetsの順に受け取る
+    for parsed in parse_race_htmls(targets, pool, workers):
+        status = apply_parse_result(manifest, stats, parsed, table_rows)
+        if status is not None:
+            replaced.add(parsed[0])
+            counts[status] += 1
+    for race_id in removed:
+        del manifest[race_id]
+
+    # 並び順(月、レースIDの順)
+    race_order = {race_id: i for i, race_id in enumerate(stats)}
+    frames = {
+        table: merge_converted_rows(
+            csv_files[table], table_rows[table].to_frame(), dtypes, replaced, race_order)
+        for table, (_, dtypes) in CONVERT_TABLES.items()
+    }
+    # CSVに保存するコードを先に記録する
+    id_registry.save()
+    # ヘッダーありインデックスなしでCSVを保存
+    for table, df in frames.items():
+        df.to_csv(csv_files[table], header=True, index=False)
+    # 列指向の形式でも年月単位で保存
+    if columnar_store.file_format != 'none':
+        month_of = {race_id: month for race_id, (month, _) in stats.items()}
+        for table, df in frames.items():
+            columnar_store.write_year(table, year, df, df['race_id'].map(month_of))
+    # CSV・列指向の形式の保存後に記録を保存する(途中で中断した場合は次回同じHTMLを変換し直す)
+    save_convert_manifest(year, manifest)
+    for table, df in frames.items():
+        logger.info(table + "のデータが" + str(df.shape[0]) + "行、" + str(df.shape[1]) + "列になりました")
+    return counts['converted'], counts['quarantined']
+
+
+def stream_convert_year(year, csv_files, manifest, stats, targets, removed, pool=None, workers=1):
+    """
+    解析した行をSTREAM_FLUSH_RACES件ごとにCSVに追記し、追記するたびにチェックポイントを保存する
+
+    置き換える行は最後に既存のCSVを分割して読みながら削除する
+    中断した場合は次回の実行時に最後のチェックポイントの状態に戻し、その続きから変換する
+    変更されたHTMLの行はCSVの末尾に移る(月、レースIDの順にはならない)
+
+    Returns:
+        tuple: (変換した件数, 隔離した件数)
+    """
+    checkpoint = {
+        # 追記を始める前の行数(この行より前の行のみ削除の対象にする)
+        'old_rows': {csv_file: count_csv_rows(csv_file) for csv_file in csv_files.values()},
+        # 追記を始める前の行から削除するレースID
+        'pending_drop': sorted(removed),
+    }
+    for race_id in removed:
+        del manifest[race_id]
+    table_rows = new_table_rows()
+    pending_drop = set(removed)
+    counts = {'converted': 0, 'quarantined': 0}
+    for parsed in parse_race_htmls(targets, pool, workers):
+        status = apply_parse_result(manifest, stats, parsed, table_rows)
+        if status is not None:
+            pending_drop.add(parsed[0])
+            counts[status] += 1
+        if len(table_rows['race']) >= STREAM_FLUSH_RACES:
+            flush_converted_rows(year, csv_files, table_rows, manifest, checkpoint, pending_drop)
+            table_rows = new_table_rows()
+    flush_converted_rows(year, csv_files, table_rows, manifest, checkpoint, pending_drop)
+    # 置き換えた行を削除して、チェックポイントのない記録を保存する
+    finish_convert_checkpoint(year, manifest, checkpoint)
+    # 列指向の形式は1か月分ずつ読み込んで保存する
+    if columnar_store.file_format != 'none':
+        month_of = {race_id: month for race_id, (month, _) in stats.items()}
+        for table, (_, dtypes) in CONVERT_TABLES.items():
+            write_columnar_from_csv(year, table, csv_files[table], dtypes, month_of)
+    return counts['converted'], counts['quarantined']
+
+
+def apply_parse_result(manifest, stats, parsed, table_rows):
+    """
+    parse_race_contentの戻り値を変換の記録と溜めている行に反映する
+
+    Returns:
+        str: 変換した場合はconverted、隔離した場合はquarantined、内容が前回と同じ場合はNone
+    """
+    race_id, content_hash, result, error = parsed
+    month, stat = stats[race_id]
+    if result is None and error is None:
+        # 更新時刻のみ変わり内容が同じHTMLは判定情報のみ更新する
+        manifest[race_id].update(month=month, stat=stat)
+        return None
+    entry = {'month': month, 'stat': stat, 'hash': content_hash,
+             'parser_version': PARSER_VERSION}
+    if error is None:
+        race_list, horse_list_list, payout_list_list = result
+        try:
+            table_rows['race'].append(race_list)
+        except ValueError as e:
+            error = str(e)
+    if error is None:
+        for horse_list in horse_list_list:
+            table_rows['horse'].append(encode_entity_ids(horse_list))
+        for payout_list in payout_list_list:
+            table_rows['payout'].append(payout_list)
+        entry['race_rows'] = 1
+        entry['horse_rows'] = len(horse_list_list)
+        entry['payout_rows'] = len(payout_list_list)
     else:
-        # CSVファイルが存在する場合はログ出力のみ行う
-        logger.info(str(year) + "年は存在するためスキップします")
+        entry['error'] = error
+        logger.warning(race_id + "のHTMLの変換に失敗したため隔離します: " + error)
+    manifest[race_id] = entry
+    return 'converted' if error is None else 'quarantined'
+
+
+def encode_entity_ids(horse_list, registry=None):
+    """
+    馬データの馬・騎手・調教師・馬主のキー番号をコードにする
+
+    解析は並列処理のプロセスで行うため、コードの割り当ては結果を受け取るプロセスで行う
+
+    Args:
+        horse_list: build_race_and_horse_listsが作成した馬データのリスト
+        registry: コードを割り当てるIdRegistry(省略時はid_registry)
+
+    Returns:
+        list: キー番号をコードにした馬データのリスト
+    """
+    registry = registry or id_registry
+    horse_list = list(horse_list)
+    for position, kind in ENTITY_CODE_POSITIONS:
+        horse_list[position] = registry.encode(kind, horse_list[position])
+    return horse_list
+
+
+def flush_converted_rows(year, csv_files, table_rows, manifest, checkpoint, pending_drop):
+    """
+    溜めた行をCSVに追記し、追記後のファイルサイズを記録したチェックポイントを保存する
+    """
+    # CSVに追記するコードを先に記録する
+    id_registry.save()
+    for table, rows in table_rows.items():
+        csv_file = csv_files[table]
+        write_header = not os.path.isfile(csv_file) or os.path.getsize(csv_file) == 0
+        if len(rows) == 0 and not write_header:
+            continue
+        with open(csv_file, 'a', encoding='utf-8', newline='') as f:
+            rows.to_frame().to_csv(f, header=write_header, index=False)
+            f.flush()
+            os.fsync(f.fileno())
+    checkpoint['sizes'] = {csv_file: os.path.getsize(csv_file) for csv_file in csv_files.values()}
+    checkpoint['pending_drop'] = sorted(pending_drop)
+    save_convert_manifest(year, manifest, checkpoint)
+
+
+def restore_convert_checkpoint(year):
+    """
+    チェックポイントが残っている場合(ストリーミング変換が中断した場合)、
+    CSVをチェックポイントのサイズに切り詰め、置き換えた行を削除する
+    """
+    manifest = load_convert_manifest(year)
+    checkpoint = load_convert_checkpoint(year)
+    if checkpoint is None:
+        return
+    logger.info(str(year) + "年の中断した変換をチェックポイントから再開します")
+    # 置き換えの段階で中断した場合、CSVは行を削除した後のものに置き換わっている可能性があるため切り詰めない
+    if not checkpoint.get('replacing'):
+        for csv_file, size in checkpoint['sizes'].items():
+            if os.path.isfile(csv_file) and os.path.getsize(csv_file) > size:
+                with open(csv_file, 'r+b') as f:
+                    f.truncate(size)
+    finish_convert_checkpoint(year, manifest, checkpoint)
+
+
+def finish_convert_checkpoint(year, manifest, checkpoint):
+    """
+    追記を始める前の行から置き換えた行を削除し、チェックポイントのない記録を保存する
+
+    行の削除は位置で行うため、1度置き換えたCSVで削除し直すと追記した行まで削除してしまう
+    そのため全てのCSVの削除後の内容を一時ファイルに書き出してから、置き換えの段階に入ったことを
+    チェックポイントに記録し、その後に一時ファイルで置き換える
+    置き換えの途中で中断した場合、再開時は残っている一時ファイルで置き換えるのみ行う
+    """
+    pending_drop = set(checkpoint['pending_drop'])
+    if pending_drop and not checkpoint.get('replacing'):
+        for csv_file, old_rows in checkpoint['old_rows'].items():
+            drop_csv_rows(csv_file, old_rows, pending_drop)
+        checkpoint['replacing'] = True
+        save_convert_manifest(year, manifest, checkpoint)
+    if checkpoint.get('replacing'):
+        for csv_file in checkpoint['old_rows']:
+            if os.path.isfile(get_drop_tmp_file(csv_file)):
+                os.replace(get_drop_tmp_file(csv_file), csv_file)
+    save_convert_manifest(year, manifest)
+
+
+def get_drop_tmp_file(csv_file):
+    return csv_file + '.tmp'
+
+
+def drop_csv_rows(csv_file, old_rows, race_ids):
+    """
+    CSVの先頭old_rows行のうちレースIDがrace_idsに含まれる行を、分割して読みながら削除し、
+    一時ファイル(get_drop_tmp_file)に書き出す(元のCSVは変更しない)
+    """
+    tmp_file = get_drop_tmp_file(csv_file)
+    if not os.path.isfile(csv_file) or old_rows == 0:
+        # 前回中断した時の一時ファイルが残っていれば、置き換えないように削除する
+        if os.path.isfile(tmp_file):
+            os.remove(tmp_file)
+        return
+    row_number = 0
+    with open(tmp_file, 'w', encoding='utf-8', newline='') as f:
+        # 書き出した文字列のまま読み込み、書き戻しても内容が変わらないようにする
+        for chunk in pd.read_csv(csv_file, dtype=str, keep_default_na=False,
+                                 chunksize=STREAM_CHUNK_ROWS):
+            is_old = np.arange(row_number, row_number + len(chunk)) < old_rows
+            row_number += len(chunk)
+            chunk[~(is_old & chunk['race_id'].isin(race_ids).to_numpy())].to_csv(
+                f, header=f.tell() == 0, index=False)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def count_csv_rows(csv_file):
+    if not os.path.isfile(csv_file):
+        return 0
+    return sum(len(chunk) for chunk in pd.read_csv(
+        csv_file, usecols=['race_id'], dtype=str, chunksize=STREAM_CHUNK_ROWS))
+
+
+def write_columnar_from_csv(year, table, csv_file, dtypes, month_of):
+    """
+    CSVを分割して読み込み、1か月分ずつ列指向の形式で保存する
+    """
+    columns = list(pd.read_csv(csv_file, nrows=0).columns)
+    for month in range(1, 13):
+        race_ids = {race_id for race_id, race_month in month_of.items() if race_month == month}
+        if not race_ids:
+            columnar_store.delete_partition(table, year, month)
+            continue
+        chunks = [
+            chunk[chunk['race_id'].isin(race_ids)]
+            for chunk in pd.read_csv(csv_file, dtype={column: dtypes.get(column, object) for column in columns},
+                                     chunksize=STREAM_CHUNK_ROWS)
+        ]
+        columnar_store.write_partition(table, year, month, pd.concat(chunks, ignore_index=True))
+
+
+def is_current_csv(csv_file, columns):
+    """
+    CSVが存在し、列が現在のフォーマットと同じ場合はTrueを返す
+    """
+    return os.path.isfile(csv_file) and list(pd.read_csv(csv_file, nrows=0).columns) == list(columns)
+
+
+def merge_converted_rows(csv_file, new_df, dtypes, replaced, race_order):
+    """
+    既存のCSVの行のうち置き換えるレースIDの行を除き、新しく変換した行と合わせて並べ替える
+
+    Args:
+        csv_file: 既存のCSVファイル
+        new_df: 新しく変換した行のデータフレーム
+        dtypes: 数値の列の型
+        replaced: 行を置き換える(削除する)レースIDの集合
+        race_order: レースIDごとの並び順
+
+    Returns:
+        pandas.DataFrame: 合わせたデータフレーム
+    """
+    if os.path.isfile(csv_file):
+        # 文字列の列は文字列のまま読み込み、書き戻しても内容が変わらないようにする
+        old_df = pd.read_csv(csv_file, dtype={column: dtypes.get(column, object) for column in new_df.columns})
+        # 置き換えるレースIDと、HTMLが存在しないレースIDの行を除く
+        old_df = old_df[old_df['race_id'].isin(race_order) & ~old_df['race_id'].isin(replaced)]
+        new_df = pd.concat([old_df, new_df], ignore_index=True)
+    order = new_df['race_id'].map(race_order)
+    return new_df.iloc[order.argsort(kind='stable')].reset_index(drop=True)
+
+
+def get_convert_manifest_file(year):
+    return STATE_DIR + "convert-" + str(year) + ".json"
+
+
+def _read_convert_manifest_file(year):
+    manifest_file = get_convert_manifest_file(year)
+    if not os.path.isfile(manifest_file):
+        return {}
+    with open(manifest_file, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def load_convert_manifest(year):
+    """
+    変換の記録を読み込む
+
+    Returns:
+        dict: レースIDごとの記録(month, stat, hash, parser_version、
+            変換できた場合はrace_rows, horse_rows, payout_rows、隔離した場合はerror)
+    """
+    manifest = _read_convert_manifest_file(year)
+    manifest.pop(CHECKPOINT_KEY, None)
+    return manifest
+
+
+def load_convert_checkpoint(year):
+    """
+    ストリーミング変換のチェックポイントを読み込む(残っていない場合はNone)
+    """
+    return _read_convert_manifest_file(year).get(CHECKPOINT_KEY)
+
+
+def save_convert_manifest(year, manifest, checkpoint=None):
+    """
+    変換の記録を保存する。チェックポイントは記録と同じファイルに保存し、両者が食い違わないようにする
+    """
+    manifest_file = get_convert_manifest_file(year)
+    os.makedirs(os.path.dirname(manifest_file), exist_ok=True)
+    tmp_file = manifest_file + '.tmp'
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump(dict(manifest, **{CHECKPOINT_KEY: checkpoint}) if checkpoint else manifest,
+                  f, ensure_ascii=False)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file, manifest_file)
+
+
+def list_quarantined_htmls(year):
+    """
+    隔離したHTMLのレースIDとエラーを返す
+
+    Returns:
+        list: (レースID, エラー)のリスト
+    """
+    manifest = load_convert_manifest(year)
+    return [(race_id, entry['error']) for race_id, entry in sorted(manifest.items()) if 'error' in entry]
 
 
-def get_rade_and_horse_data_by_html(race_id, html):
+def parse_race_htmls(targets, pool=None, workers=1):
+    """
+    HTMLを順に解析し、targetsの順にレースデータと馬データを返す
+
+    poolを指定した場合はPARSE_BATCH_SIZE件ずつプロセスで解析する
+    読み込みはスレッドで先読みし、解析中のプロセスがディスクの読み込みを待たないようにする
+
+    Args:
+        targets: (年, 月, レースID, 前回のハッシュ値)のリスト
+        pool: HTMLを解析するProcessPoolExecutor
+        workers: poolのプロセス数
+
+    Yields:
+        tuple: (レースID, ハッシュ値, 解析結果, エラー)。parse_race_contentの戻り値
+    """
+    if pool is None:
+        for target in targets:
+            yield parse_race_content(*read_race_html_batch([target])[0])
+        return
+    batches = iter([
+        targets[i:i + PARSE_BATCH_SIZE] for i in range(0, len(targets), PARSE_BATCH_SIZE)
+    ])
+    # 解析中・解析待ちのバッチ数の上限
+    max_in_flight = workers * 2
+    with ThreadPoolExecutor(max_workers=PREFETCH_THREADS) as reader:
+        read_futures = deque()
+        parse_futures = deque()
+
+        def prefetch():
+            # 解析中のバッチと合わせて上限まで読み込みを予約する
+            while len(read_futures) + len(parse_futures) < max_in_flight + PREFETCH_THREADS:
+                batch = next(batches, None)
+                if batch is None:
+                    return
+                read_futures.append(reader.submit(read_race_html_batch, batch))
+
+        prefetch()
+        while read_futures or parse_futures:
+            while read_futures and len(parse_futures) < max_in_flight:
+                parse_futures.append(pool.submit(parse_race_html_batch, read_futures.popleft().result()))
+                prefetch()
+            for result in parse_futures.popleft().result():
+                yield result
+            prefetch()
+
+
+def read_race_html_batch(batch):
+    """
+    バッチのHTMLを読み込み、ハッシュ値を求める(デコードは解析するプロセスで行う)
+
+    Returns:
+        list: (レースID, ハッシュ値, 保存した内容(前回と同じ場合はNone))のリスト
+    """
+    contents = []
+    for year, month, race_id, known_hash in batch:
+        content = html_store.read(year, month, race_id)
+        content_hash = hashlib.blake2b(content, digest_size=16).hexdigest()
+        contents.append((race_id, content_hash, None if content_hash == known_hash else content))
+    return contents
+
+
+def parse_race_html_batch(batch):
+    """
+    プロセスでバッチのHTMLを解析する
+
+    Args:
+        batch: read_race_html_batchの戻り値
+
+    Returns:
+        list: parse_race_contentの戻り値のリスト
+    """
+    return [parse_race_content(*item) for item in batch]
+
+
+def parse_race_content(race_id, content_hash, content):
+    """
+    保存した内容を解析する。解析に失敗した場合は例外を送出せずにエラーを返す
+
+    Returns:
+        tuple: (レースID, ハッシュ値, (レースデータのリスト, 馬データのリストのリスト,
+            払い戻しデータのリストのリスト), エラー)
+            内容が前回と同じ場合は解析結果とエラーがNone、失敗した場合は解析結果がNone
+    """
+    if content is None:
+        return race_id, content_hash, None, None
+    try:
+        return race_id, content_hash, get_rade_and_horse_data_by_html(
+            race_id, decode_race_html(content)), None
+    except Exception as e:
+        return race_id, content_hash, None, f"{type(e).__name__}: {e}"
+
+
+def read_race_html(year, month, race_id):
+    """
+    保存したHTMLを読み込む
+    """
+    return decode_race_html(html_store.read(year, month, race_id))
+
+
+def decode_race_html(content):
+    """
+    保存した内容をデコードする
+
+    スナップショットは先頭に記録された文字コードでデコードし、
+    ページ全体を保存したファイルはそのままデコードする
+    """
+    match = SNAPSHOT_HEADER_PATTERN.match(content)
+    if match:
+        return content[match.end():].decode(match.group(1).decode('ascii'), errors='replace')
+    return content.decode()
+
+
+def get_rade_and_horse_data_by_html(race_id, html, backend=None):
+    """
+    レースのHTMLからレースデータと馬データを取得する
+
+    Args:
+        race_id: レースID
+        html: レースのHTML
+        backend: 解析に使うバックエンド(省略時はconfig.iniのPARSE_BACKEND)
+
+    Returns:
+        tuple: (レースデータのリスト, 馬データのリストのリスト, 払い戻しデータのリストのリスト)
+    """
+    extract_race_page = PARSE_BACKENDS[backend or get_parse_backend()]
+    return build_race_and_horse_lists(race_id, extract_race_page(html))
+
+
+@functools.lru_cache(maxsize=None)
+def get_parse_backend():
+    """
+    config.iniのPARSE_BACKENDを返す。lxmlがインストールされていない場合はbs4を返す
+    """
+    if PARSE_BACKEND == 'lxml' and lxml_html is None:
+        logger.warning("lxmlがインストールされていないため、bs4で解析します")
+        return 'bs4'
+    return PARSE_BACKEND
+
+
+def extract_race_page_with_bs4(html):
+    """
+    BeautifulSoupでレースのHTMLから必要な要素の文字列を取り出す
+
+    Returns:
+        dict: build_race_and_horse_listsに渡す要素の文字列
+            intro: レース情報(dt、h1、p、p.smalltxt)の文字列
+            result_rows: レース結果の行ごとのtdの文字列(先頭はヘッダー行)
+            result_links: レース結果の行ごとのRESULT_LINK_COLUMNSのtd内の最初のリンク
+            pay_rows: 払い戻しの行ごとの[券種の表記(th), 組み合わせ(最初のtd)内の文字列のリスト,
+                払戻金(最初のtd.txt_r)内の文字列のリスト]
+    """
+    parser = BeautifulSoup(html, 'html.parser')
+    race_info = parser.find("div", class_="data_intro")
+    intro = [
+        race_info.find("dt").get_text(),
+        race_info.find("h1").get_text(),
+        race_info.find("p").get_text(),
+        race_info.find("p", class_="smalltxt").get_text(),
+    ]
+    result_rows = []
+    result_links = []
+    for tr in parser.find("table", class_="race_table_01 nk_tb_common").findAll('tr'):
+        cells = tr.findAll('td')
+        result_rows.append([cell.get_text() for cell in cells])
+        links = {}
+        for column in RESULT_LINK_COLUMNS:
+            if column < len(cells):
+                link = cells[column].find('a')
+                links[column] = link.get('href') if link else None
+        result_links.append(links)
+    pay_rows = []
+    for table in parser.findAll("table", class_="pay_table_01"):
+        for tr in table.findAll('tr'):
+            bet_type = tr.find('th')
+            cells = tr.findAll('td')
+            refund = tr.find("td", class_="txt_r")
+            if bet_type is None or not cells or refund is None:
+                continue
+            pay_rows.append([bet_type.get_text(), list(cells[0].strings), list(refund.strings)])
+    return {'intro': intro, 'result_rows': result_rows,
+            'result_links': result_links, 'pay_rows': pay_rows}
+
+
+def extract_race_page_with_lxml(html):
+    """
+    lxmlとコンパイル済みのXPathでレースのHTMLから必要な要素の文字列を取り出す
+
+    戻り値はextract_race_page_with_bs4と同じ
+    """
+    document = lxml_html.document_fromstring(html)
+    race_info = LXML_XPATHS['data_intro'](document)[0]
+    intro = [
+        _lxml_text(LXML_XPATHS[name](race_info)[0])
+        for name in ('dt', 'h1', 'p', 'smalltxt')
+    ]
+    result_rows = []
+    result_links = []
+    for tr in LXML_XPATHS['tr'](LXML_XPATHS['result_table'](document)[0]):
+        cells = LXML_XPATHS['td'](tr)
+        result_rows.append([_lxml_text(cell) for cell in cells])
+        links = {}
+        for column in RESULT_LINK_COLUMNS:
+            if column < len(cells):
+                hrefs = LXML_XPATHS['href'](cells[column])
+                links[column] = str(hrefs[0]) if hrefs else None
+        result_links.append(links)
+    pay_rows = []
+    for table in LXML_XPATHS['pay_table'](document):
+        for tr in LXML_XPATHS['tr'](table):
+            bet_type = LXML_XPATHS['th'](tr)
+            cells = LXML_XPATHS['td'](tr)
+            refund = LXML_XPATHS['txt_r'](tr)
+            if not bet_type or not cells or not refund:
+                continue
+            pay_rows.append([
+                _lxml_text(bet_type[0]),
+                [str(text) for text in LXML_XPATHS['text'](cells[0])],
+                [str(text) for text in LXML_XPATHS['text'](refund[0])],
+            ])
+    return {'intro': intro, 'result_rows': result_rows,
+            'result_links': result_links, 'pay_rows': pay_rows}
+
+
+def _lxml_text(element):
+    # BeautifulSoupのget_textと同じく、子孫のテキストノードを連結する
+    return "".join(LXML_XPATHS['text'](element))
+
+
+def _class_condition(class_name):
+    # BeautifulSoupのclass_指定と同じく、class属性の単語のいずれかに一致する
+    return f"contains(concat(' ', normalize-space(@class), ' '), ' {class_name} ')"
+
+
+# 解析のバックエンド
+PARSE_BACKENDS = {
+    'bs4': extract_race_page_with_bs4,
+    'lxml': extract_race_page_with_lxml,
+}
+# lxmlのバックエンドで使うコンパイル済みのXPath
+LXML_XPATHS = {} if lxml_html is None else {
+    'data_intro': etree.XPath(f"//div[{_class_condition('data_intro')}]"),
+    'dt': etree.XPath("(.//dt)[1]"),
+    'h1': etree.XPath("(.//h1)[1]"),
+    'p': etree.XPath("(.//p)[1]"),
+    'smalltxt': etree.XPath(f"(.//p[{_class_condition('smalltxt')}])[1]"),
+    'result_table': etree.XPath("//table[@class='race_table_01 nk_tb_common']"),
+    'tr': etree.XPath(".//tr"),
+    'td': etree.XPath(".//td"),
+    'th': etree.XPath("(.//th)[1]"),
+    'href': etree.XPath("(.//a)[1]/@href"),
+    'pay_table': etree.XPath(f"//table[{_class_condition('pay_table_01')}]"),
+    'txt_r': etree.XPath(f"(.//td[{_class_condition('txt_r')}])[1]"),
+    'text': etree.XPath(".//text()"),
+}
+
+
+def build_race_and_horse_lists(race_id, page):
+    """
+    バックエンドが取り出した要素の文字列からレースデータ・馬データ・払い戻しデータを作成する
+
+    数値・日付などはrace_data_columns、horse_data_columns、payout_data_columnsの型に変換する
+    """
     race_list = [race_id]
     horse_list_list = []
-    # htmlパーサー
-    parser = BeautifulSoup(html, 'html.parser')
 
     # レース情報を取得
-    race_info = parser.find("div", class_="data_intro")
+    race_number, race_name, race_details1, race_details2 = page['intro']
     # レース番号
-    race_list.append(race_info.find(
-        "dt").get_text().strip("\n"))
+    race_list.append(parse_int(race_number))
     # レース名
-    race_list.append(race_info.find(
-        "h1").get_text().strip("\n"))
+    race_list.append(race_name.strip("\n"))
     # pタグ内のレース情報
-    race_details1 = race_info.find(
-        "p").get_text().strip("\n").split("\xa0/\xa0")
+    race_details1 = race_details1.strip("\n").split("\xa0/\xa0")
     # コース情報
     race_list.append(race_details1[0])
     # 天候
@@ -220,123 +1018,218 @@ def get_rade_and_horse_data_by_html(race_id, html):
     race_list.append(race_details1[2])
     # 発走時間
     race_list.append(race_details1[3])
-    race_details2 = race_info.find(
-        "p", class_="smalltxt").get_text().strip("\n").split(" ")
+    race_details2 = race_details2.strip("\n").split(" ")
     # 開催日
-    race_list.append(race_details2[0])
-    # 開催情報
-    race_list.append(race_details2[1])
+    race_list.append(parse_date(race_details2[0]))
+    # 開催情報(何回、競馬場、何日目)
+    race_list.extend(parse_race_information(race_details2[1]))
 
-    result_rows = parser.find(
-        "table", class_="race_table_01 nk_tb_common").findAll('tr')  # レース結果
+    result_rows = page['result_rows']  # レース結果
+    result_links = page['result_links']
     # 上位3着の情報
     race_list.append(len(result_rows)-1)  # total_horse_numbers
     for i in range(1, 4):
-        row = result_rows[i].findAll('td')
+        row = result_rows[i]
         # bracket_number_in_first or second or third
-        race_list.append(row[1].get_text())
+        race_list.append(parse_int(row[1]))
         # horse_number_in_first or second or third
-        race_list.append(row[2].get_text())
-
-    # 払い戻し(単勝・複勝・三連複・3連単)
-    pay_back_tables = parser.findAll("table", class_="pay_table_01")
-
-    pay_back1 = pay_back_tables[0].findAll('tr')  # 払い戻し1(単勝・複勝)
-    race_list.append(pay_back1[0].find(
-        "td", class_="txt_r").get_text())  # refund_for_win
-    hukuren = pay_back1[1].find("td", class_="txt_r")
-    tmp = []
-    for string in hukuren.strings:
-        tmp.append(string)
-    for i in range(3):
-        try:
-            # refund_for_first_place or refund_for_second_place or refund_for_third_place
-            race_list.append(tmp[i])
-        except IndexError:
-            race_list.append("0")
+        race_list.append(parse_int(row[2]))
 
-    # 枠連
-    try:
-        race_list.append(pay_back1[2].find("td", class_="txt_r").get_text())
-    except IndexError:
-        race_list.append("0")
-
-    # 馬連
-    try:
-        race_list.append(pay_back1[3].find("td", class_="txt_r").get_text())
-    except IndexError:
-        race_list.append("0")
-    # 払い戻し2(三連複・3連単)
-    pay_back2 = pay_back_tables[1].findAll('tr')
-
-    # wide 1&2
-    wide = pay_back2[0].find("td", class_="txt_r")
-    tmp = []
-    for string in wide.strings:
-        tmp.append(string)
-    for i in range(3):
-        try:
-            race_list.append(tmp[i])
-        except IndexError:
-            race_list.append("0")
-    try:
-        # 馬単の払戻金
-        race_list.append(pay_back2[1].find(
-            "td", class_="txt_r").get_text())
-        # 3連複の払戻金
-        race_list.append(pay_back2[2].find(
-            "td", class_="txt_r").get_text())
-        # 3連単の払戻金
-        race_list.append(pay_back2[3].find(
-            "td", class_="txt_r").get_text())
-    except IndexError:
-        race_list.append("0")
+    # 払い戻し(券種・組み合わせごとの行)
+    payout_list_list = build_payout_lists(race_id, page['pay_rows'])
+    # 券種ごとの払戻金(払い戻しの表の位置ではなく券種で対応付け、発売がない券種は0とする)
+    refunds = {}
+    for payout_list in payout_list_list:
+        refunds.setdefault(payout_list[1], []).append(payout_list[-1])
+    for bet_type, count in REFUND_COLUMN_COUNTS:
+        bet_refunds = refunds.get(bet_type, [])[:count]
+        race_list.extend(bet_refunds + [0] * (count - len(bet_refunds)))
 
     # horse data
     for rank in range(1, len(result_rows)):
         horse_list = [race_id]
-        result_row = result_rows[rank].findAll("td")
+        result_row = result_rows[rank]
+        links = result_links[rank]
         # 順位
-        horse_list.append(result_row[0].get_text())
+        horse_list.append(result_row[0])
         # 枠番
-        horse_list.append(result_row[1].get_text())
+        horse_list.append(parse_int(result_row[1]))
         # 馬番
-        horse_list.append(result_row[2].get_text())
+        horse_list.append(parse_int(result_row[2]))
         # 馬のキー番号
-        horse_list.append(result_row[3].find('a').get('href').split("/")[-2])
-        # 性別 + 年齢
-        horse_list.append(result_row[4].get_text())
+        horse_list.append(links[3].split("/")[-2])
+        # 性別、年齢
+        horse_list.extend(parse_sex_and_age(result_row[4]))
         # 斤量
-        horse_list.append(result_row[5].get_text())
+        horse_list.append(parse_float(result_row[5]))
         # 騎手のキー番号
-        horse_list.append(result_row[6].find('a').get('href').split("/")[-2])
+        horse_list.append(links[6].split("/")[-2])
         # タイム
-        horse_list.append(result_row[7].get_text())
+        horse_list.append(parse_seconds(result_row[7]))
         # 着差
-        horse_list.append(result_row[8].get_text())
+        horse_list.append(result_row[8])
         # 9:タイム指数は取得しない
         # 通過順位
-        horse_list.append(result_row[10].get_text())
+        horse_list.extend(parse_passed_rank(result_row[10]))
         # 上りタイム
-        horse_list.append(result_row[11].get_text())
+        horse_list.append(parse_float(result_row[11]))
         # 単勝オッズ
-        horse_list.append(result_row[12].get_text())
+        horse_list.append(parse_float(result_row[12]))
         # 何番人気か
-        horse_list.append(result_row[13].get_text())
-        # 馬体重
-        horse_list.append(result_row[14].get_text())
+        horse_list.append(parse_int(result_row[13]))
+        # 馬体重、増減
+        horse_list.extend(parse_horse_weight(result_row[14]))
         # 15:調教タイム、16:厩舎コメント、17:備考は取得しない
         # 調教師のキー番号
-        horse_list.append(result_row[18].find('a').get('href').split("/")[-2])
+        horse_list.append(links[18].split("/")[-2])
         # 馬主のキー番号
-        horse_list.append(result_row[19].find('a').get('href').split("/")[-2])
+        horse_list.append(links[19].split("/")[-2])
 
         horse_list_list.append(horse_list)
 
-    return race_list, horse_list_list
+    return race_list, horse_list_list, payout_list_list
+
+
+def build_payout_lists(race_id, pay_rows):
+    """
+    払い戻しの行を券種・組み合わせごとの払い戻しデータにする
+
+    同着などで1つの券種に複数の組み合わせがある場合は組み合わせごとに1行にする
+    券種が不明な行(BET_TYPE_NAMESにない行)は除く
+
+    Returns:
+        list: payout_data_columnsの形式のリストのリスト
+    """
+    payout_list_list = []
+    for bet_type_name, combination_texts, refund_texts in pay_rows:
+        bet_type = BET_TYPE_NAMES.get(bet_type_name.strip())
+        if bet_type is None:
+            continue
+        combination_texts = [text for text in combination_texts if text.strip()]
+        refund_texts = [text for text in refund_texts if text.strip()]
+        if len(combination_texts) != len(refund_texts):
+            raise ValueError(
+                f"{bet_type_name}の組み合わせと払戻金の数が一致しません "
+                f"(組み合わせ: {len(combination_texts)}、払戻金: {len(refund_texts)})")
+        for combination_text, refund_text in zip(combination_texts, refund_texts):
+            numbers = [int(number) for number in COMBINATION_NUMBER_PATTERN.findall(combination_text)]
+            if not 1 <= len(numbers) <= MAX_NUMBERS:
+                raise ValueError(f"{bet_type_name}の組み合わせを読み取れません: {combination_text}")
+            if bet_type in UNORDERED_BET_TYPES:
+                numbers.sort()
+            padded = numbers + [None] * (MAX_NUMBERS - len(numbers))
+            payout_list_list.append(
+                [race_id, bet_type] + padded
+                + [encode_combination(bet_type, numbers), parse_int(refund_text)])
+    return payout_list_list
+
+
+def parse_int(text):
+    """
+    数字のみを取り出して整数にする(例: 1,230 → 1230、11 R → 11)。数字がない場合はNone
+    """
+    digits = NON_DIGIT_PATTERN.sub('', text)
+    return int(digits) if digits else None
+
+
+def parse_float(text):
+    """
+    小数にする(例: 57.0)。数値でない場合(---など)はNone
+    """
+    try:
+        return float(text.strip())
+    except ValueError:
+        return None
+
+
+def parse_seconds(text):
+    """
+    タイムを秒にする(例: 1:34.5 → 94.5)。タイムがない場合はNone
+    """
+    match = GOAL_TIME_PATTERN.fullmatch(text.strip())
+    if not match:
+        return None
+    minutes, seconds = match.groups()
+    return round(int(minutes or 0) * 60 + float(seconds), 1)
+
+
+def parse_passed_rank(text):
+    """
+    通過順位を最終コーナーに揃えたCORNER_COUNT個の整数にする(例: 3-2 → [None, None, 3, 2])
+    """
+    ranks = [int(rank) for rank in text.strip().split('-') if rank.isdigit()][-CORNER_COUNT:]
+    return [None] * (CORNER_COUNT - len(ranks)) + ranks
+
+
+def parse_horse_weight(text):
+    """
+    馬体重を体重と増減にする(例: 480(+4) → [480, 4])。計量不能の場合は[None, None]
+    """
+    match = HORSE_WEIGHT_PATTERN.search(text)
+    if not match:
+        return [None, None]
+    weight, change = match.groups()
+    return [int(weight), int(change) if change else None]
+
+
+def parse_sex_and_age(text):
+    """
+    性別 + 年齢を性別と年齢にする(例: 牡3 → ['牡', 3])
+    """
+    match = SEX_AND_AGE_PATTERN.search(text.strip())
+    if not match:
+        return [text.strip() or None, None]
+    return [match.group(1), int(match.group(2))]
+
+
+def parse_date(text):
+    """
+    開催日をyyyy-mm-ddにする(例: 2023年1月5日 → 2023-01-05)
+    """
+    match = DATE_PATTERN.search(text)
+    if not match:
+        raise ValueError(f"開催日を読み取れません: {text}")
+    year, month, day = (int(value) for value in match.groups())
+    return f"{year:04d}-{month:02d}-{day:02d}"
+
+
+def parse_race_information(text):
+    """
+    開催情報を何回、競馬場、何日目にする(例: 1回中山1日目 → [1, '中山', 1])
+    """
+    match = RACE_INFORMATION_PATTERN.search(text)
+    if not match:
+        raise ValueError(f"開催情報を読み取れません: {text}")
+    return [int(match.group(1)), match.group(2), int(match.group(3))]
 
 
 if __name__ == '__main__':
+    # コマンドライン引数のパーサーを設定
+    parser = argparse.ArgumentParser(description="保存したHTMLからCSVファイルを作成します")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="HTMLを解析するプロセス数を指定します（例: 16）",
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="解析した行を一定件数ごとにCSVに追記し、中断しても途中から再開できるようにします",
+    )
+    parser.add_argument(
+        "--quarantine",
+        type=int,
+        metavar="YEAR",
+        help="変換に失敗して隔離したHTMLを表示します",
+    )
+    args = parser.parse_args()
+
+    if args.quarantine:
+        for race_id, error in list_quarantined_htmls(args.quarantine):
+            print(race_id + "\t" + error)
+        sys.exit(0)
+
     # ログフォーマットを定義
     formatter = "%(asctime)s [%(levelname)s]\t%(message)s"
     # ログファイルを定義
@@ -345,6 +1238,6 @@ if __name__ == '__main__':
     # 処理開始をログに出力
     logger.info("CSV作成処理を開始します")
     # 処理開始
-    convert_csv_into_html()
+    convert_csv_into_html(workers=args.workers, stream=args.stream)
     # 処理終了をログに出力
     logger.info("CSV作成処理を終了します")
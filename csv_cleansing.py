@@ -1,10 +1,17 @@
+import argparse
 import logging
 import configparser
+import json
 import os
+import shutil
 import datetime
+from concurrent.futures import ProcessPoolExecutor
 import pytz
+import numpy as np
 import pandas as pd
 
+from payout_table import PayoutIndex
+
 # 設定ファイルの読み込み
 config = configparser.ConfigParser()
 config.read(os.path.join(os.getcwd(), 'config.ini'), encoding='utf-8')
@@ -15,51 +22,543 @@ CURRENT_YEAR = datetime.datetime.now(pytz.timezone('Asia/Tokyo')).year
 
 # csvファイルを格納するフォルダ
 CSV_DIR = os.getcwd() + config.get('DIR', 'CSV_DIR')
+# 年ごとの加工済みのCSVを格納するフォルダ
+PROCESSED_DIR = CSV_DIR + 'processed/'
+# 加工の記録を格納するフォルダ
+STATE_DIR = os.getcwd() + config.get('DIR', 'STATE_DIR')
+# 年ごとの加工元のCSVの判定情報の記録
+CLEANSING_MANIFEST = STATE_DIR + 'cleansing.json'
+# 加工処理のバージョン(加工結果が変わる修正をした場合は上げ、全ての年を加工し直す)
+CLEANSING_VERSION = 1
 
 # ログファイル名
 logger = logging.getLogger(__name__)
 
-def csv_cleansing():
-    # 複数のCSVファイルを読み込み、統合
-    all_horse_data = []
-    all_race_data = []
+# 馬データのCSVを分割して読み込む行数(メモリ使用量はこの行数と1年分のレースデータで決まる)
+CLEANSING_CHUNK_ROWS = 100000
+
+# 馬データの列の型
+# 種類の少ない文字列はcategory、順位・番号は小さい整数、オッズ・タイムはfloat32にする
+horse_data_schema = {
+    'race_id': str,
+    'rank': 'category',
+    'bracket_number': 'Int8',
+    'horse_number': 'Int8',
+    'horse_code': 'Int32',
+    'sex': 'category',
+    'age': 'Int8',
+    'jockey_weight': 'float32',
+    'jockey_code': 'Int32',
+    'goal_time': 'float32',
+    'margin': str,
+    'passed_rank_1': 'Int8',
+    'passed_rank_2': 'Int8',
+    'passed_rank_3': 'Int8',
+    'passed_rank_4': 'Int8',
+    'last_three_furlong_time': 'float32',
+    'odds': 'float32',
+    'popular': 'Int8',
+    'horse_weight': 'Int16',
+    'horse_weight_change': 'Int16',
+    'trainer_code': 'Int32',
+    'owner_code': 'Int32',
+}
+
+# レースデータの列の型(払戻金は欠損値を扱えるInt32にする)
+race_data_schema = dict(
+    {
+        'race_id': str,
+        'race_round': 'Int8',
+        'race_name': str,
+        'race_course': 'category',
+        'weather': 'category',
+        'ground_status': 'category',
+        'time': str,
+        'date': str,
+        'kai': 'Int8',
+        'venue': 'category',
+        'day': 'Int8',
+        'total_horse_numbers': 'Int8',
+        'bracket_number_in_first': 'Int8',
+        'horse_number_in_first': 'Int8',
+        'bracket_number_in_second': 'Int8',
+        'horse_number_in_second': 'Int8',
+        'bracket_number_in_third': 'Int8',
+        'horse_number_in_third': 'Int8',
+    },
+    **{
+        column: 'Int32'
+        for column in [
+            'refund_for_win',
+            'refund_for_first_place',
+            'refund_for_second_place',
+            'refund_for_third_place',
+            'refund_for_bracket_quinella',
+            'refund_for_quinella',
+            'refund_for_quinella_place_for_first_place_and_second_place',
+            'refund_for_quinella_place_for_first_place_and_third_place',
+            'refund_for_quinella_place_for_second_place_and_third_place',
+            'refund_for_exacta',
+            'refund_for_trio',
+            'refund_for_trifecta',
+        ]
+    }
+)
+
+# 払い戻しデータの列の型(券種・組み合わせごとに1行)
+payout_data_schema = {
+    'race_id': str,
+    'bet_type': 'category',
+    'number_1': 'Int8',
+    'number_2': 'Int8',
+    'number_3': 'Int8',
+    'combination': 'Int32',
+    'payout': 'Int32',
+}
+
+# 馬データの加工後の列
+runner_data_columns = list(horse_data_schema) + ['weight_numeric', 'weight_change']
+# 出力する列(馬データ、馬体重の列、レースデータの順)
+processed_data_columns = (
+    runner_data_columns + [column for column in race_data_schema if column != 'race_id']
+)
+
+# 出力形式ごとの出力ファイル名と、年ごとの加工結果のファイル名の接頭辞
+# wide: 馬データの各行にレースデータを結合する
+# normalized: 馬データとレースID順のレースデータ・払い戻しデータを分けて保存し、
+#   ProcessedDataで必要な列のみを結合する
+OUTPUT_FILES = {
+    'wide': {'processed_data.csv': 'processed'},
+    'normalized': {
+        'processed_runner.csv': 'runner',
+        'processed_race.csv': 'race',
+        'processed_payout.csv': 'payout',
+    },
+}
+
+
+def csv_cleansing(use_cache=True, output='wide', workers=1):
+    """
+    年ごとに加工したCSVを作成し、連結してOUTPUT_FILESのファイルに保存する
+
+    年ごとの加工結果はprocessed/<接頭辞>-yyyy.csvに保存し、
+    加工元のCSVと加工処理のバージョンが前回と同じ年は加工し直さずに使う
 
+    Args:
+        use_cache: Falseのときは全ての年を加工し直す
+        output: 出力形式(wide or normalized)
+        workers: 加工し直す年を並列で加工するプロセス数(1のときは並列化しない)
+    """
+    manifest = load_cleansing_manifest()
+    # 出力形式ごとに記録する
+    output_manifest = manifest.setdefault(output, {}) if use_cache else {}
+    manifest[output] = output_manifest
+    partition_files = {file_name: [] for file_name in OUTPUT_FILES[output]}
+    # 加工し直す年ごとの(年ごとの加工結果のファイル名, 判定情報)
+    stale_years = {}
     for year in range(FROM_YEAR, CURRENT_YEAR + 1):
-        horse_file_path = f'{CSV_DIR}horse-{year}.csv'
-        race_file_path = f'{CSV_DIR}race-{year}.csv'
-
-        # ファイルが存在する場合のみ読み込み
-        if os.path.exists(horse_file_path):
-            horse_data = pd.read_csv(horse_file_path, low_memory=False)
-            # horse_weight列を文字列に変換
-            horse_data['horse_weight'] = horse_data['horse_weight'].astype(str)
-            # horse_weightを数値と変動に分割
-            horse_data['weight_numeric'] = horse_data['horse_weight'].str.extract('(\d+)').astype(float)
-            # 変動値の抽出、NaNの処理と整数型への変換
-            horse_data['weight_change'] = horse_data['horse_weight'].str.extract('\(([^)]*)\)').fillna('0').replace('', '0').astype(int)
-            # 欠損値の処理
-            horse_data.fillna({'margin': 'unknown', 'passed_rank': 'unknown'}, inplace=True)
-            all_horse_data.append(horse_data)
-
-        if os.path.exists(race_file_path):
-            race_data = pd.read_csv(race_file_path, low_memory=False)
-            # 金額関連のデータを数値に変換
-            columns_to_convert = [col for col in race_data.columns if 'refund' in col]
-            for col in columns_to_convert:
-                race_data[col] = race_data[col].str.replace(',', '').astype(float)
-            all_race_data.append(race_data)
-
-    # 全データの結合
-    combined_horse_data = pd.concat(all_horse_data, ignore_index=True)
-    combined_race_data = pd.concat(all_race_data, ignore_index=True)
-
-    # データの統合
-    combined_data = pd.merge(combined_horse_data, combined_race_data, on='race_id', how='left')
-
-    # データをCSVファイルとして保存
-    combined_data.to_csv(CSV_DIR + 'processed_data.csv', index=False)
+        year_files = {
+            file_name: get_partition_file(prefix, year)
+            for file_name, prefix in OUTPUT_FILES[output].items()
+        }
+        fingerprint = get_source_fingerprint(year)
+        if fingerprint is None:
+            # 馬データのCSVがない年は加工結果も削除する
+            for partition_file in year_files.values():
+                if os.path.isfile(partition_file):
+                    os.remove(partition_file)
+            output_manifest.pop(str(year), None)
+            continue
+        if (output_manifest.get(str(year)) == fingerprint
+                and all(os.path.isfile(partition_file) for partition_file in year_files.values())):
+            logger.info(f'{year}年は変更がないため前回の加工結果を使います')
+        else:
+            stale_years[year] = (year_files, fingerprint)
+        for file_name, partition_file in year_files.items():
+            partition_files[file_name].append(partition_file)
+
+    # 加工結果は年の順に受け取り、年の順に記録する
+    for year, rows in cleanse_stale_years(stale_years, output, workers):
+        logger.info(f'{year}年の{rows}行を加工しました')
+        # 加工結果の保存後に記録を保存する(途中で中断した場合は次回加工し直す)
+        output_manifest[str(year)] = stale_years[year][1]
+        save_cleansing_manifest(manifest)
+    # 削除した年の記録も消す
+    save_cleansing_manifest(manifest)
+    for file_name, files in partition_files.items():
+        output_file = CSV_DIR + file_name
+        concatenate_partitions(files, output_file, get_output_columns(file_name))
+        logger.info(f'{len(files)}年分を{output_file}に保存しました')
+
+
+def cleanse_stale_years(stale_years, output, workers=1):
+    """
+    加工し直す年を加工し、年の順に結果を返す
+
+    workersが2以上の場合は年ごとにプロセスで加工する
+    各プロセスは別々のファイルに書き込むため、保存される内容は並列化しない場合と同じになる
+
+    Args:
+        stale_years: 年ごとの(年ごとの加工結果のファイル名, 判定情報)
+        output: 出力形式(wide or normalized)
+        workers: プロセス数
+
+    Yields:
+        tuple: (年, 保存した馬データの行数)
+    """
+    if workers <= 1 or len(stale_years) <= 1:
+        for year, (year_files, _) in stale_years.items():
+            yield year, write_year_partitions(year, output, year_files)
+        return
+    logger.info(f'{len(stale_years)}年分を{workers}プロセスで加工します')
+    with ProcessPoolExecutor(max_workers=min(workers, len(stale_years))) as pool:
+        futures = {
+            year: pool.submit(write_year_partitions, year, output, year_files)
+            for year, (year_files, _) in stale_years.items()
+        }
+        for year, future in futures.items():
+            yield year, future.result()
+
+
+def get_partition_file(prefix, year):
+    return PROCESSED_DIR + f'{prefix}-{year}.csv'
+
+
+def get_output_columns(file_name):
+    """
+    出力ファイルの列を返す
+    """
+    if file_name == 'processed_runner.csv':
+        return runner_data_columns
+    if file_name == 'processed_race.csv':
+        return list(race_data_schema)
+    if file_name == 'processed_payout.csv':
+        return list(payout_data_schema)
+    return processed_data_columns
+
+
+def get_source_fingerprint(year):
+    """
+    加工結果を使い回せるかを判定するための情報を返す(馬データのCSVがない場合はNone)
+
+    Returns:
+        dict: 加工処理のバージョンと、馬データ・レースデータ・払い戻しデータのCSVの[サイズ, 更新時刻(ナノ秒)]
+    """
+    horse_file_path = f'{CSV_DIR}horse-{year}.csv'
+    if not os.path.exists(horse_file_path):
+        return None
+    fingerprint = {'version': CLEANSING_VERSION}
+    for name in ('horse', 'race', 'payout'):
+        file_path = f'{CSV_DIR}{name}-{year}.csv'
+        if os.path.exists(file_path):
+            stat = os.stat(file_path)
+            fingerprint[name] = [stat.st_size, stat.st_mtime_ns]
+        else:
+            fingerprint[name] = None
+    return fingerprint
+
+
+def write_year_partitions(year, output, year_files):
+    """
+    対象年を加工して出力形式ごとのファイルに保存する
+
+    Args:
+        year: 対象年
+        output: 出力形式(wide or normalized)
+        year_files: 出力ファイル名ごとの年ごとの加工結果のファイル名
+
+    Returns:
+        int: 保存した馬データの行数
+    """
+    if output == 'wide':
+        return write_partition(year_files['processed_data.csv'], cleanse_year(year),
+                               processed_data_columns)
+    # レースデータはレースIDの順に並べ、年ごとのファイルを連結してもレースIDの順になるようにする
+    race_data = read_race_data(year).sort_values('race_id', kind='stable')
+    write_partition(year_files['processed_race.csv'], [race_data], list(race_data_schema))
+    payout_data = read_payout_data(year).sort_values('race_id', kind='stable')
+    write_partition(year_files['processed_payout.csv'], [payout_data], list(payout_data_schema))
+    return write_partition(year_files['processed_runner.csv'], cleanse_horse_chunks(year),
+                           runner_data_columns)
+
+
+def write_partition(partition_file, chunks, columns):
+    """
+    データフレームを順にpartition_fileに保存する
+
+    Returns:
+        int: 保存した行数
+    """
+    os.makedirs(os.path.dirname(partition_file), exist_ok=True)
+    # 書き込みが終わってから置き換え、途中で中断しても前回のファイルを残す
+    tmp_file = partition_file + '.tmp'
+    rows = 0
+    with open(tmp_file, 'w', encoding='utf-8', newline='') as f:
+        for chunk in chunks:
+            chunk.to_csv(f, header=f.tell() == 0, index=False)
+            rows += len(chunk)
+        # データがない場合もヘッダーのみのファイルにする
+        if f.tell() == 0:
+            pd.DataFrame(columns=columns).to_csv(f, index=False)
+    os.replace(tmp_file, partition_file)
+    return rows
+
+
+def concatenate_partitions(partition_files, output_file, columns):
+    """
+    年ごとの加工結果を解析せずに連結する(ヘッダーは最初のファイルのみ残す)
+    """
+    tmp_file = output_file + '.tmp'
+    with open(tmp_file, 'wb') as output:
+        if not partition_files:
+            output.write((','.join(columns) + '\n').encode('utf-8'))
+        for i, partition_file in enumerate(partition_files):
+            with open(partition_file, 'rb') as f:
+                header = f.readline()
+                if i == 0:
+                    output.write(header)
+                shutil.copyfileobj(f, output)
+    os.replace(tmp_file, output_file)
+
+
+def load_cleansing_manifest():
+    """
+    加工の記録を読み込む
+
+    Returns:
+        dict: 出力形式ごと・年ごとのget_source_fingerprintの戻り値
+    """
+    if not os.path.isfile(CLEANSING_MANIFEST):
+        return {}
+    with open(CLEANSING_MANIFEST, 'r', encoding='utf-8') as f:
+        manifest = json.load(f)
+    # 出力形式ごとに記録していない古い記録は使わない
+    return {output: manifest[output] for output in OUTPUT_FILES if output in manifest}
+
+
+def save_cleansing_manifest(manifest):
+    os.makedirs(os.path.dirname(CLEANSING_MANIFEST), exist_ok=True)
+    tmp_file = CLEANSING_MANIFEST + '.tmp'
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_file, CLEANSING_MANIFEST)
+
+
+def cleanse_year(year):
+    """
+    対象年の馬データをCLEANSING_CHUNK_ROWS行ずつ加工し、レースデータと結合して返す
+
+    Yields:
+        pandas.DataFrame: processed_data_columnsの列を持つデータフレーム
+    """
+    # レースデータは1年分でも小さいため一度に読み込む
+    race_data = read_race_data(year)
+    for horse_data in cleanse_horse_chunks(year):
+        # データの統合
+        combined_data = pd.merge(horse_data, race_data, on='race_id', how='left')
+        yield combined_data.reindex(columns=processed_data_columns)
+
+
+def read_race_data(year):
+    """
+    対象年のレースデータを読み込む(ファイルがない場合は列のみのデータフレーム)
+    """
+    race_file_path = f'{CSV_DIR}race-{year}.csv'
+    if os.path.exists(race_file_path):
+        return pd.read_csv(race_file_path, dtype=race_data_schema)
+    return pd.DataFrame(columns=list(race_data_schema)).astype(race_data_schema)
+
+
+def read_payout_data(year):
+    """
+    対象年の払い戻しデータを読み込む(ファイルがない場合は列のみのデータフレーム)
+    """
+    payout_file_path = f'{CSV_DIR}payout-{year}.csv'
+    if os.path.exists(payout_file_path):
+        return pd.read_csv(payout_file_path, dtype=payout_data_schema)
+    return pd.DataFrame(columns=list(payout_data_schema)).astype(payout_data_schema)
+
+
+def cleanse_horse_chunks(year):
+    """
+    対象年の馬データをCLEANSING_CHUNK_ROWS行ずつ読み込んで加工する
+
+    Yields:
+        pandas.DataFrame: runner_data_columnsの列を持つデータフレーム
+    """
+    horse_file_path = f'{CSV_DIR}horse-{year}.csv'
+    # ファイルが存在する場合のみ読み込み
+    if not os.path.exists(horse_file_path):
+        return
+    for horse_data in pd.read_csv(horse_file_path, dtype=horse_data_schema,
+                                  chunksize=CLEANSING_CHUNK_ROWS):
+        yield cleanse_horse_data(horse_data).reindex(columns=runner_data_columns)
+
+
+def cleanse_horse_data(horse_data):
+    """
+    馬データを加工する
+    """
+    # 馬体重と増減は変換時に数値に分割済み
+    horse_data['weight_numeric'] = horse_data['horse_weight'].astype('float32')
+    # 増減の欠損値は0とする
+    horse_data['weight_change'] = horse_data['horse_weight_change'].fillna(0).astype('int16')
+    # 欠損値の処理
+    horse_data.fillna({'margin': 'unknown'}, inplace=True)
+    return horse_data
+
+
+class ProcessedData:
+    """
+    normalizedの出力(processed_runner.csv、processed_race.csv、processed_payout.csv)を読み込み、
+    馬データに必要なレースデータの列のみを結合して返す
+    払い戻しはPayoutIndexでレース・券種・組み合わせごとにまとめて引ける
+
+    レースデータはレースIDの順に並んでいるため、馬データの各行のレースデータの位置を二分探索で求め、
+    列ごとに位置で値を取り出す(全ての列を結合するpd.mergeを行わない)
+    読み込んだレースデータの列は使い回す
+
+    Args:
+        csv_dir: 出力ファイルのフォルダ(省略時はCSV_DIR)
+    """
+
+    def __init__(self, csv_dir=None):
+        self.runner_file = (csv_dir or CSV_DIR) + 'processed_runner.csv'
+        self.race_file = (csv_dir or CSV_DIR) + 'processed_race.csv'
+        self.payout_file = (csv_dir or CSV_DIR) + 'processed_payout.csv'
+        # 払い戻しの索引
+        self._payout_index = None
+        # レースIDの順のレースID
+        self._race_ids = None
+        # レースデータの行をレースIDの順にする位置(ファイルが既に順に並んでいる場合はNone)
+        self._race_order = None
+        # 列名ごとのレースIDの順の値
+        self._race_columns = {}
+
+    def runners(self, columns=None):
+        """
+        馬データを読み込む
+
+        Args:
+            columns: 読み込む列のリスト(省略時は全ての列。race_idは常に読み込む)
+        """
+        usecols = None if columns is None else ['race_id'] + [c for c in columns if c != 'race_id']
+        return pd.read_csv(self.runner_file, usecols=usecols, dtype=dict(
+            horse_data_schema, weight_numeric='float32', weight_change='int16'))
+
+    def races(self, columns=None):
+        """
+        レースデータをレースIDの順に返す
+
+        Args:
+            columns: 返す列のリスト(省略時は全ての列)
+        """
+        columns = list(race_data_schema) if columns is None else list(columns)
+        self._load_race_columns(columns)
+        return pd.DataFrame({column: self._race_columns[column] for column in columns},
+                            columns=columns)
+
+    def joined(self, runner_columns=None, race_columns=()):
+        """
+        馬データにレースデータの指定した列を結合して返す(pd.mergeのhow='left'と同じ結果)
+
+        Args:
+            runner_columns: 馬データの列のリスト(省略時は全ての列)
+            race_columns: 結合するレースデータの列のリスト
+
+        Returns:
+            pandas.DataFrame: 馬データの順のデータフレーム
+        """
+        runners = self.runners(runner_columns)
+        positions = self.race_positions(runners['race_id'])
+        self._load_race_columns(race_columns)
+        for column in race_columns:
+            # 位置が-1の行(レースデータがない行)は欠損値にする
+            runners[column] = self._race_columns[column].array.take(positions, allow_fill=True)
+        return runners
+
+    def payouts(self):
+        """
+        払い戻しデータを読み込む
+        """
+        return pd.read_csv(self.payout_file, dtype=payout_data_schema)
+
+    def lookup_payouts(self, race_ids, bet_type, combinations):
+        """
+        レースごとに券種・組み合わせの払戻金を返す(的中しなかった場合は0)
+
+        例: 10,000レースの馬単1 → 2の払戻金
+        data.lookup_payouts(race_ids, 'exacta', np.tile([1, 2], (len(race_ids), 1)))
+
+        Args:
+            race_ids: レースIDの配列
+            bet_type: 券種(payout_table.BET_TYPESのいずれか)
+            combinations: レースごとの組み合わせ(馬番の2次元配列、またはencode_combinationの値の配列)
+
+        Returns:
+            numpy.ndarray: 払戻金の配列
+        """
+        if self._payout_index is None:
+            self._payout_index = PayoutIndex(self.payouts())
+        return self._payout_index.lookup(race_ids, bet_type, combinations)
+
+    def race_positions(self, race_ids):
+        """
+        レースIDごとのレースデータの位置を返す(レースデータがない場合は-1)
+        """
+        self._load_race_columns(['race_id'])
+        sorted_ids = self._race_ids
+        race_ids = np.asarray(race_ids, dtype=str)
+        positions = np.searchsorted(sorted_ids, race_ids)
+        found = positions < len(sorted_ids)
+        found[found] = sorted_ids[positions[found]] == race_ids[found]
+        return np.where(found, positions, -1)
+
+    def _load_race_columns(self, columns):
+        missing = [column for column in columns if column not in self._race_columns]
+        if not missing:
+            return
+        if self._race_ids is None and 'race_id' not in missing:
+            missing.append('race_id')
+        race_data = pd.read_csv(self.race_file, usecols=missing,
+                                dtype={column: race_data_schema[column] for column in missing})
+        if self._race_ids is None:
+            race_ids = race_data['race_id']
+            if not race_ids.is_monotonic_increasing:
+                # レースIDの順に並んでいない場合は読み込むたびに並べ替える
+                self._race_order = race_ids.to_numpy().argsort(kind='stable')
+            self._race_ids = np.asarray(race_ids, dtype=str)
+            if self._race_order is not None:
+                self._race_ids = self._race_ids[self._race_order]
+        for column in missing:
+            values = race_data[column]
+            if self._race_order is not None:
+                values = values.iloc[self._race_order]
+            self._race_columns[column] = values.reset_index(drop=True)
+
 
 if __name__ == '__main__':
+    # コマンドライン引数のパーサーを設定
+    parser = argparse.ArgumentParser(description="変換したCSVを加工してprocessed_data.csvなどを作成します")
+    parser.add_argument(
+        "--rebuild",
+        action="store_true",
+        help="前回の加工結果を使わずに全ての年を加工し直します",
+    )
+    parser.add_argument(
+        "--output",
+        choices=list(OUTPUT_FILES),
+        default="wide",
+        help="出力形式を指定します（normalized: 馬データとレースデータを分けて保存します）",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="加工し直す年を並列で加工するプロセス数を指定します（例: 8）",
+    )
+    args = parser.parse_args()
+
     # ログフォーマットを定義
     formatter = "%(asctime)s [%(levelname)s]\t%(message)s"
     # ログファイルを定義
@@ -68,6 +567,6 @@ if __name__ == '__main__':
     # 処理開始をログに出力
     logger.info("データクレンジング処理を開始します")
     # 処理開始
-    csv_cleansing()
+    csv_cleansing(use_cache=not args.rebuild, output=args.output, workers=args.workers)
     # 処理終了をログに出力
-    logger.info("データクレンジング処理を終了します")
\ No newline at end of file
+    logger.info("データクレンジング処理を終了します")
@@ -0,0 +1,330 @@
+# coding:utf-8
+"""
+取得対象ごとの取得状況をSQLiteに記録する
+
+get_race_html(レースID単位)とget_kyotei_html(日付・競艇場・レース・タブ単位)が
+取得対象ごとに状態・試行回数・最後のエラー・サイズ・次に取得してよい時刻を記録し、
+再開時はファイルの存在確認ではなく未取得の行のみを読み込む
+get_profile_htmlは取得対象の版(最後に出走したレース)も記録し、版が変わった対象を取得し直す
+
+取得状況は以下のコマンドで確認できる
+python fetch_ledger.py --summary race
+python fetch_ledger.py --missing race 2024
+"""
+import argparse
+import configparser
+import datetime
+import logging
+import os
+import sqlite3
+import threading
+import time
+from os import path
+
+import pytz
+
+config = configparser.ConfigParser()
+config.read(os.getcwd() + "/config.ini", encoding="utf-8")
+
+OWN_FILE_NAME = path.splitext(path.basename(__file__))[0]
+# 取得状況などを保存するフォルダ
+STATE_DIR = os.getcwd() + config.get("DIR", "STATE_DIR")
+# 取得状況を記録するデータベース
+FETCH_LEDGER_DB = STATE_DIR + "fetch_ledger.db"
+# ログファイル名
+logger = logging.getLogger(__name__)
+
+# 取得元
+RACE_SOURCE = "race"
+KYOTEI_SOURCE = "kyotei"
+
+# 状態
+STATUS_PENDING = "pending"
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+# 対象のページにデータがない(再取得しない)
+STATUS_NO_DATA = "no_data"
+
+# 失敗した対象を取得し直す最大回数
+MAX_ATTEMPTS = 5
+# 失敗した対象を取得し直すまでの基本の待機時間(秒)。失敗するたびに2倍にする
+RETRY_BASE_WAIT = 600
+
+# 取得する必要がある対象の条件(未取得か、失敗した回数がMAX_ATTEMPTS未満で待機時間を過ぎた対象)
+PENDING_CONDITION = "status IN (?, ?) AND attempts < ? AND next_eligible_at <= ?"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS fetch_ledger (
+    source TEXT NOT NULL,
+    target_key TEXT NOT NULL,
+    year INTEGER NOT NULL,
+    month INTEGER NOT NULL,
+    url TEXT,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT,
+    byte_size INTEGER,
+    next_eligible_at REAL NOT NULL DEFAULT 0,
+    updated_at TEXT,
+    revision TEXT,
+    PRIMARY KEY (source, target_key)
+);
+CREATE INDEX IF NOT EXISTS fetch_ledger_status
+    ON fetch_ledger (source, status, year, month);
+CREATE TABLE IF NOT EXISTS registered_file (
+    file_path TEXT PRIMARY KEY,
+    mtime REAL NOT NULL
+);
+"""
+
+
+class FetchLedger:
+    """
+    取得対象ごとの取得状況を記録するSQLiteのデータベース
+
+    Args:
+        db_file: データベースのファイル名(省略時はFETCH_LEDGER_DB)
+    """
+
+    def __init__(self, db_file=FETCH_LEDGER_DB):
+        os.makedirs(os.path.dirname(db_file), exist_ok=True)
+        # asyncioの保存処理など別スレッドからも使うため、ロックで直列化する
+        self._conn = sqlite3.connect(db_file, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(SCHEMA)
+        # revision列がない古いデータベースには列を追加する
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(fetch_ledger)")]
+        if "revision" not in columns:
+            self._conn.execute("ALTER TABLE fetch_ledger ADD COLUMN revision TEXT")
+        self._lock = threading.Lock()
+
+    def close(self):
+        self._conn.close()
+
+    def register(self, source, targets):
+        """
+        取得対象を未取得として登録する(登録済みの対象は変更しない)
+
+        Args:
+            source: 取得元(RACE_SOURCE or KYOTEI_SOURCE)
+            targets: (キー, 年, 月, URL)のリスト
+        """
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO fetch_ledger (source, target_key, year, month, url)"
+                " VALUES (?, ?, ?, ?, ?)",
+                [(source, key, year, month, url) for key, year, month, url in targets],
+            )
+
+    def register_revisions(self, source, targets):
+        """
+        取得対象を版(revision)付きで登録する
+
+        取得済みの対象の版が変わった場合は未取得に戻し、取得し直す対象にする
+
+        Args:
+            source: 取得元
+            targets: (キー, 年, 月, URL, 版)のリスト
+        """
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT INTO fetch_ledger (source, target_key, year, month, url, revision)"
+                " VALUES (?, ?, ?, ?, ?, ?)"
+                " ON CONFLICT (source, target_key) DO UPDATE SET"
+                "  status = CASE WHEN revision IS NOT excluded.revision AND status IN (?, ?)"
+                "   THEN ? ELSE status END,"
+                "  attempts = CASE WHEN revision IS NOT excluded.revision THEN 0 ELSE attempts END,"
+                "  year = excluded.year, month = excluded.month, revision = excluded.revision",
+                [
+                    (source, key, year, month, url, revision,
+                     STATUS_DONE, STATUS_FAILED, STATUS_PENDING)
+                    for key, year, month, url, revision in targets
+                ],
+            )
+
+    def is_registered_file(self, file_path):
+        """
+        取得対象の一覧ファイルが前回登録した時から変更されていなければTrueを返す
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT mtime FROM registered_file WHERE file_path = ?", (file_path,)
+            ).fetchone()
+        return row is not None and row[0] == os.path.getmtime(file_path)
+
+    def mark_registered_file(self, file_path):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO registered_file (file_path, mtime) VALUES (?, ?)",
+                (file_path, os.path.getmtime(file_path)),
+            )
+
+    def mark_saved(self, source, target_keys):
+        """
+        未取得として登録した対象のうち、既に保存済みのものを取得済みにする
+        """
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "UPDATE fetch_ledger SET status = ? WHERE source = ? AND target_key = ? AND status = ?",
+                [(STATUS_DONE, source, key, STATUS_PENDING) for key in target_keys],
+            )
+
+    def pending(self, source, year=None, month=None):
+        """
+        取得する必要がある対象を年月・キーの順に返す
+
+        未取得の対象と、失敗した回数がMAX_ATTEMPTS未満で待機時間を過ぎた対象を返す
+
+        Returns:
+            list: (キー, 年, 月, URL)のリスト
+        """
+        query = "SELECT target_key, year, month, url FROM fetch_ledger WHERE source = ? AND " + PENDING_CONDITION
+        params = [source, STATUS_PENDING, STATUS_FAILED, MAX_ATTEMPTS, time.time()]
+        if year is not None:
+            query += " AND year = ?"
+            params.append(year)
+        if month is not None:
+            query += " AND month = ?"
+            params.append(month)
+        query += " ORDER BY year, month, target_key"
+        with self._lock:
+            return self._conn.execute(query, params).fetchall()
+
+    def status(self, source, target_key):
+        """
+        対象の状態を返す(登録されていない場合はNone)
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT status FROM fetch_ledger WHERE source = ? AND target_key = ?",
+                (source, target_key),
+            ).fetchone()
+        return row[0] if row else None
+
+    def pending_keys(self, source, target_keys):
+        """
+        指定したキーのうち、取得する必要があるものを1回の問い合わせで返す
+
+        pendingと同じ条件の対象に加え、登録されていない対象も返す
+        (取得済み・データなし・再試行の待機中・試行回数の上限に達した対象は返さない)
+
+        Returns:
+            set: 取得する必要があるキー
+        """
+        target_keys = set(target_keys)
+        if not target_keys:
+            return set()
+        placeholders = ", ".join("?" * len(target_keys))
+        with self._lock:
+            settled = self._conn.execute(
+                "SELECT target_key FROM fetch_ledger"
+                f" WHERE source = ? AND target_key IN ({placeholders}) AND NOT ({PENDING_CONDITION})",
+                [source, *target_keys, STATUS_PENDING, STATUS_FAILED, MAX_ATTEMPTS, time.time()],
+            ).fetchall()
+        return target_keys - {key for key, in settled}
+
+    def mark_done(self, source, target_key, year, month, byte_size, url=None):
+        self._update(source, target_key, year, month, url, STATUS_DONE, byte_size=byte_size)
+
+    def mark_no_data(self, source, target_key, year, month, url=None):
+        self._update(source, target_key, year, month, url, STATUS_NO_DATA)
+
+    def mark_failed(self, source, target_key, year, month, error, url=None):
+        """
+        失敗を記録し、試行回数に応じて次に取得してよい時刻を遅らせる
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT attempts FROM fetch_ledger WHERE source = ? AND target_key = ?",
+                (source, target_key),
+            ).fetchone()
+        attempts = (row[0] if row else 0) + 1
+        self._update(
+            source,
+            target_key,
+            year,
+            month,
+            url,
+            STATUS_FAILED,
+            last_error=str(error),
+            next_eligible_at=time.time() + RETRY_BASE_WAIT * 2 ** (attempts - 1),
+        )
+
+    def _update(self, source, target_key, year, month, url, status,
+                byte_size=None, last_error=None, next_eligible_at=0):
+        updated_at = datetime.datetime.now(pytz.timezone("Asia/Tokyo")).isoformat()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO fetch_ledger"
+                " (source, target_key, year, month, url, status, attempts, last_error,"
+                "  byte_size, next_eligible_at, updated_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, 1, ?, ?, ?, ?)"
+                " ON CONFLICT (source, target_key) DO UPDATE SET"
+                "  url = COALESCE(excluded.url, url), status = excluded.status,"
+                "  attempts = attempts + 1, last_error = excluded.last_error,"
+                "  byte_size = COALESCE(excluded.byte_size, byte_size),"
+                "  next_eligible_at = excluded.next_eligible_at, updated_at = excluded.updated_at",
+                (source, target_key, year, month, url, status, last_error,
+                 byte_size, next_eligible_at, updated_at),
+            )
+
+    def missing(self, source, year, month=None):
+        """
+        対象年(月)で取得が完了していない対象を返す
+
+        Returns:
+            list: (キー, 状態, 試行回数, 最後のエラー)のリスト
+        """
+        query = (
+            "SELECT target_key, status, attempts, last_error FROM fetch_ledger"
+            " WHERE source = ? AND year = ? AND status NOT IN (?, ?)"
+        )
+        params = [source, year, STATUS_DONE, STATUS_NO_DATA]
+        if month is not None:
+            query += " AND month = ?"
+            params.append(month)
+        query += " ORDER BY month, target_key"
+        with self._lock:
+            return self._conn.execute(query, params).fetchall()
+
+    def summary(self, source):
+        """
+        状態ごとの件数を返す
+        """
+        with self._lock:
+            return dict(
+                self._conn.execute(
+                    "SELECT status, COUNT(*) FROM fetch_ledger WHERE source = ? GROUP BY status",
+                    (source,),
+                ).fetchall()
+            )
+
+
+if __name__ == "__main__":
+    # コマンドライン引数のパーサーを設定
+    parser = argparse.ArgumentParser(description="取得状況を表示します")
+    parser.add_argument(
+        "--summary",
+        metavar="SOURCE",
+        help="状態ごとの件数を表示します（例: race、kyotei、profile_horse）",
+    )
+    parser.add_argument(
+        "--missing",
+        nargs="+",
+        metavar=("SOURCE", "YEAR"),
+        help="取得が完了していない対象を表示します（例: race 2024、race 2024 5）",
+    )
+    args = parser.parse_args()
+
+    ledger = FetchLedger()
+    try:
+        if args.summary:
+            for status, count in sorted(ledger.summary(args.summary).items()):
+                print(f"{status}\t{count}")
+        if args.missing:
+            source, year = args.missing[0], int(args.missing[1])
+            month = int(args.missing[2]) if len(args.missing) > 2 else None
+            for row in ledger.missing(source, year, month):
+                print("\t".join("" if value is None else str(value) for value in row))
+    finally:
+        ledger.close()
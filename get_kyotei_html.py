@@ -21,6 +21,9 @@ from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.support.ui import WebDriverWait
 from bs4 import BeautifulSoup
 
+from fetch_ledger import KYOTEI_SOURCE, FetchLedger
+from html_store import HtmlStore
+
 config = configparser.ConfigParser()
 config.read(os.getcwd() + "/config.ini", encoding="utf-8")
 
@@ -29,6 +32,10 @@ now_datetime = datetime.datetime.now(pytz.timezone("Asia/Tokyo"))
 OWN_FILE_NAME = path.splitext(path.basename(__file__))[0]
 # 取得したhtmlを格納するフォルダ
 KYOTEI_HTML_DIR = os.getcwd() + config.get("DIR", "KYOTEI_HTML_DIR")
+# 取得したhtmlの保存先
+kyotei_html_store = HtmlStore(KYOTEI_HTML_DIR)
+# 取得状況を記録するデータベース(--ledger指定時のみ使用)
+kyotei_ledger = None
 # ベースURL
 KYOTEI_BASE_URL = config.get("URL", "KYOTEI_BASE_URL")
 # ログファイル名
@@ -48,6 +55,15 @@ RACE_NO_MAX = 12
 # sliderはページ内のタブ切り替え用のため、slider=0のみを取得する
 SLIDER_VALUES = [0]
 
+# sliderパラメータとタブ名のマッピング
+SLIDER_TAB_MAPPING = {
+    0: "基本情報",
+    1: "枠別情報",
+    2: "モータ情報",
+    3: "今節成績",
+    7: "結果",
+}
+
 # IP制限対策: 待機時間の設定（秒）
 BASE_WAIT_TIME = 10  # 基本的な待機時間
 TAB_WAIT_TIME = 10  # タブ間の待機時間
@@ -104,6 +120,59 @@ def init_webdriver():
         raise
 
 
+def get_ledger_keys(year, month, day, place_no, race_no, slider):
+    """
+    取得状況のデータベースに記録するキーのリストを返す(slider=0の場合はタブごと)
+    """
+    date_str = f"{year}{month:02d}{day:02d}"
+    if slider == 0:
+        return [f"{date_str}_{place_no}_{race_no}_{tab_name}" for tab_name in SLIDER_TAB_MAPPING.values()]
+    return [f"{date_str}_{place_no}_{race_no}_{slider}"]
+
+
+def get_fetch_keys(year, month, ledger_keys):
+    """
+    取得状況のデータベースで取得する必要があるキーを返す
+
+    FetchLedger.pendingと同じ条件で判定し(再試行の待機中・試行回数の上限に達したキーは除く)、
+    --ledgerを指定せずに保存したHTMLのキーは取得済みとして記録して除く
+    """
+    fetch_keys = kyotei_ledger.pending_keys(KYOTEI_SOURCE, ledger_keys)
+    saved_keys = {key for key in fetch_keys if kyotei_html_store.exists(year, month, key)}
+    for key in saved_keys:
+        kyotei_ledger.mark_done(KYOTEI_SOURCE, key, year, month, None)
+    return fetch_keys - saved_keys
+
+
+def get_pending_races(year, month, day, place_no):
+    """
+    指定した日付とplace_noのうち、取得が完了していない(race_no, slider)のリストを返す
+
+    --ledger指定時は場ごとに1回の問い合わせで全レースの状態を調べ、
+    取得する必要があるタブがないレースを除く(未指定時は全レースを返す)
+    """
+    races = [(race_no, slider) for race_no in range(RACE_NO_MIN, RACE_NO_MAX + 1) for slider in SLIDER_VALUES]
+    if kyotei_ledger is None:
+        return races
+    race_keys = {race: get_ledger_keys(year, month, day, place_no, *race) for race in races}
+    fetch_keys = get_fetch_keys(year, month, [key for keys in race_keys.values() for key in keys])
+    return [race for race in races if fetch_keys.intersection(race_keys[race])]
+
+
+def mark_no_data(year, month, day, save_key, url):
+    """
+    取得状況のデータベースにデータなしを記録する
+
+    当日以降のレースの結果・オッズはまだ公開されていないだけのため記録せず、次回の実行で取得し直す
+    """
+    if kyotei_ledger is None:
+        return
+    if datetime.date(year, month, day) >= now_datetime.date():
+        logger.debug(f"当日以降のためデータなしを記録しません: {save_key}")
+        return
+    kyotei_ledger.mark_no_data(KYOTEI_SOURCE, save_key, year, month, url)
+
+
 def get_kyotei_html_by_date_with_selenium(driver, year, month, day, place_no, race_no, slider, start_from_tab=None):
     """
     Seleniumを使用して指定した日付、place_no、race_no、sliderのHTMLを取得する
@@ -133,19 +202,23 @@ def get_kyotei_html_by_date_with_selenium(driver, year, month, day, place_no, ra
         f"&slider={slider}"
     )
 
-    # HTMLを保存するフォルダ(/html_kyotei/yyyy/mm 配下に保存)
-    save_dir = KYOTEI_HTML_DIR + f"{year}/{month:02d}"
-    # フォルダが存在しなければ新規作成
-    if not os.path.isdir(save_dir):
-        os.makedirs(save_dir)
+    # 保存するHTMLのキー(/html_kyotei/yyyy/mm 配下に保存)
+    save_key = f"{date_str}_{place_no}_{race_no}_{slider}"
 
-    # 保存するファイル名
-    file_name = f"{date_str}_{place_no}_{race_no}_{slider}.html"
-    save_file_path = save_dir + "/" + file_name
+    # 対象のHTMLが既に存在する場合はスキップ
+    if kyotei_html_store.exists(year, month, save_key):
+        logger.debug(f"既に取得済み: {save_key}")
+        return True
 
-    # 対象のファイルが既に存在する場合はスキップ
-    if os.path.isfile(save_file_path):
-        logger.debug(f"既に取得済み: {save_file_path}")
+    # 取得する必要があるタブがなければ、ページを開かずにスキップ
+    # (--ledger指定時はタブの状態をレースごとに1回の問い合わせでまとめて調べる)
+    ledger_keys = get_ledger_keys(year, month, day, place_no, race_no, slider)
+    if kyotei_ledger is not None:
+        fetch_keys = get_fetch_keys(year, month, ledger_keys)
+    else:
+        fetch_keys = {key for key in ledger_keys if not kyotei_html_store.exists(year, month, key)}
+    if not fetch_keys:
+        logger.debug(f"取得済み・データなし・再試行待ちのためスキップ: {url}")
         return True
 
     try:
@@ -255,6 +328,8 @@ def get_kyotei_html_by_date_with_selenium(driver, year, month, day, place_no, ra
             page_text = driver.find_element(By.TAG_NAME, "body").text
             if "データはありません。" in page_text:
                 logger.warning(f"データなしのためスキップ: {url}")
+                for key in fetch_keys:
+                    mark_no_data(year, month, day, key, url)
                 return None  # データなしは正常なスキップなのでNoneを返す
         except Exception as e:
             logger.debug(f"データチェックでエラー: {str(e)}")
@@ -267,13 +342,7 @@ def get_kyotei_html_by_date_with_selenium(driver, year, month, day, place_no, ra
         # slider=0で開いた場合、各sliderパラメータでページを開いてHTMLを保存
         if slider == 0:
             # sliderパラメータとタブ名のマッピング
-            slider_tab_mapping = {
-                0: "基本情報",
-                1: "枠別情報",
-                2: "モータ情報",
-                3: "今節成績",
-                7: "結果",
-            }
+            slider_tab_mapping = SLIDER_TAB_MAPPING
 
             saved_count = 0
 
@@ -289,6 +358,14 @@ def get_kyotei_html_by_date_with_selenium(driver, year, month, day, place_no, ra
                         logger.info(f"タブ '{tab_name}' をスキップします（{start_from_tab}から開始）")
                         continue
 
+                # このタブのHTMLを保存するキー
+                tab_save_key = f"{date_str}_{place_no}_{race_no}_{tab_name}"
+                # 保存済み・データなし・再試行待ちのタブはページを開かない
+                # (保存済みのタブはget_fetch_keysで取得状況のデータベースに取得済みとして記録している)
+                if tab_save_key not in fetch_keys:
+                    saved_count += 1
+                    continue
+
                 retry_count = 0
                 max_retries = 3
                 success = False
@@ -385,6 +462,8 @@ def get_kyotei_html_by_date_with_selenium(driver, year, month, day, place_no, ra
 
                 if not success:
                     logger.warning(f"ページ読み込みに失敗しました。スキップします。 (slider={slider_value}, タブ={tab_name})")
+                    if kyotei_ledger is not None:
+                        kyotei_ledger.mark_failed(KYOTEI_SOURCE, tab_save_key, year, month, "ページ読み込みに失敗しました", tab_url)
                     continue
 
                 try:
@@ -415,16 +494,6 @@ def get_kyotei_html_by_date_with_selenium(driver, year, month, day, place_no, ra
                         # 追加の待機時間（データ読み込みを確実にするため）
                         time.sleep(0.5)
 
-                    # このタブのHTMLを保存
-                    tab_file_name = f"{date_str}_{place_no}_{race_no}_{tab_name}.html"
-                    tab_save_file_path = save_dir + "/" + tab_file_name
-
-                    # 既に存在する場合はスキップ
-                    if os.path.isfile(tab_save_file_path):
-                        logger.debug(f"既に取得済み: {tab_save_file_path}")
-                        saved_count += 1
-                        continue
-
                     # HTMLを取得（タイムアウトエラーに対応）
                     html = None
                     try:
@@ -459,12 +528,14 @@ def get_kyotei_html_by_date_with_selenium(driver, year, month, day, place_no, ra
                     # 「データはありません。」が実際に表示されるテキストに含まれている場合、スキップ
                     if "データはありません。" in visible_text:
                         logger.warning(f"データなしのためスキップ: {tab_url} ({tab_name})")
+                        mark_no_data(year, month, day, tab_save_key, tab_url)
                         # データなしの場合は、このタブの処理をスキップして次のタブへ
                         continue
 
                     # HTMLを保存
-                    with open(tab_save_file_path, "w", encoding="utf-8") as file:
-                        file.write(html)
+                    kyotei_html_store.write(year, month, tab_save_key, html)
+                    if kyotei_ledger is not None:
+                        kyotei_ledger.mark_done(KYOTEI_SOURCE, tab_save_key, year, month, len(html.encode("utf-8")), tab_url)
                     saved_count += 1
 
                     # タブ間の待機時間（IP制限対策）
@@ -474,6 +545,8 @@ def get_kyotei_html_by_date_with_selenium(driver, year, month, day, place_no, ra
                     logger.error(f"タブ '{tab_name}' (slider={slider_value}) の処理中にエラーが発生しました: {str(e)}")
                     import traceback
                     logger.error(traceback.format_exc())
+                    if kyotei_ledger is not None:
+                        kyotei_ledger.mark_failed(KYOTEI_SOURCE, tab_save_key, year, month, e, tab_url)
                     continue
 
             # すべてのタブの処理が完了
@@ -523,12 +596,14 @@ def get_kyotei_html_by_date_with_selenium(driver, year, month, day, place_no, ra
                 # 「データはありません。」が実際に表示されるテキストに含まれている場合、スキップ
                 if "データはありません。" in visible_text:
                     logger.debug(f"データなしのためスキップ: {url}")
+                    mark_no_data(year, month, day, save_key, url)
                     return None  # データなしは正常なスキップなのでNoneを返す
 
                 # HTMLを保存
-                with open(save_file_path, "w", encoding="utf-8") as file:
-                    file.write(html)
-                logger.info(f"HTML取得成功: {url} -> {save_file_path}")
+                kyotei_html_store.write(year, month, save_key, html)
+                if kyotei_ledger is not None:
+                    kyotei_ledger.mark_done(KYOTEI_SOURCE, save_key, year, month, len(html.encode("utf-8")), url)
+                logger.info(f"HTML取得成功: {url} -> {save_key}")
 
                 # 待機時間（IP制限対策）
                 time.sleep(BASE_WAIT_TIME)
@@ -561,7 +636,7 @@ def get_kyotei_html_by_date(driver, year, month, day, place_no, race_no, slider)
     return get_kyotei_html_by_date_with_selenium(driver, year, month, day, place_no, race_no, slider)
 
 
-def get_kyotei_html_by_date_and_place_no(driver, year, month, day, place_no):
+def get_kyotei_html_by_date_and_place_no(driver, year, month, day, place_no, races=None):
     """
     指定した日付とplace_noの全レースのHTMLを取得する
 
@@ -571,36 +646,40 @@ def get_kyotei_html_by_date_and_place_no(driver, year, month, day, place_no):
         month: 月
         day: 日
         place_no: 競艇場ID (1-24)
+        races: 取得する(race_no, slider)のリスト。Noneの場合はget_pending_racesで求める
     """
     success_count = 0
     consecutive_errors = 0
-    
-    for race_no in range(RACE_NO_MIN, RACE_NO_MAX + 1):
-        for slider in SLIDER_VALUES:
-            try:
-                result = get_kyotei_html_by_date(driver, year, month, day, place_no, race_no, slider)
-                if result is True:
-                    # 成功した場合
-                    success_count += 1
-                    consecutive_errors = 0  # 成功したらエラーカウントをリセット
-                elif result is None:
-                    # データなしの場合（正常なスキップ）はエラーカウントに含めない
-                    consecutive_errors = 0  # データなしは正常なのでエラーカウントをリセット
-                else:
-                    # エラーの場合（False）
-                    consecutive_errors += 1
-            except Exception as e:
+
+    if races is None:
+        races = get_pending_races(year, month, day, place_no)
+
+    # 取得状況のデータベースで取得が完了したレースはページを開かず、待機もしない
+    for race_no, slider in races:
+        try:
+            result = get_kyotei_html_by_date(driver, year, month, day, place_no, race_no, slider)
+            if result is True:
+                # 成功した場合
+                success_count += 1
+                consecutive_errors = 0  # 成功したらエラーカウントをリセット
+            elif result is None:
+                # データなしの場合（正常なスキップ）はエラーカウントに含めない
+                consecutive_errors = 0  # データなしは正常なのでエラーカウントをリセット
+            else:
+                # エラーの場合（False）
                 consecutive_errors += 1
-                logger.error(f"レース取得エラー (place_no={place_no}, race_no={race_no}): {str(e)}")
-            
-            # 連続エラーが発生した場合、長時間待機（データなしの場合は待機しない）
-            if consecutive_errors >= MAX_CONSECUTIVE_ERRORS:
-                logger.warning(f"連続{consecutive_errors}回エラーが発生しました。IP制限の可能性があるため、{IP_BLOCK_WAIT_TIME}秒待機します...")
-                time.sleep(IP_BLOCK_WAIT_TIME)
-                consecutive_errors = 0  # 待機後にリセット
-            
-            # レース間の待機時間（IP制限対策）
-            time.sleep(BASE_WAIT_TIME)
+        except Exception as e:
+            consecutive_errors += 1
+            logger.error(f"レース取得エラー (place_no={place_no}, race_no={race_no}): {str(e)}")
+        
+        # 連続エラーが発生した場合、長時間待機（データなしの場合は待機しない）
+        if consecutive_errors >= MAX_CONSECUTIVE_ERRORS:
+            logger.warning(f"連続{consecutive_errors}回エラーが発生しました。IP制限の可能性があるため、{IP_BLOCK_WAIT_TIME}秒待機します...")
+            time.sleep(IP_BLOCK_WAIT_TIME)
+            consecutive_errors = 0  # 待機後にリセット
+        
+        # レース間の待機時間（IP制限対策）
+        time.sleep(BASE_WAIT_TIME)
 
 
 def get_kyotei_html_by_date_all_place_nos(driver, year, month, day):
@@ -618,13 +697,25 @@ def get_kyotei_html_by_date_all_place_nos(driver, year, month, day):
     # 日付単位で実行するときに1つのWebDriverを使い続けると、
     # 実行時間が長くなった終盤でタイムアウトが発生しやすくなる。
     # そのため、場ごと（place_noごと）にWebDriverを再起動して負荷を分散する。
+    # 取得状況のデータベースで取得が完了した場はWebDriverを起動せず、待機もしない
+    fetched = False
     for place_no in range(PLACE_NO_MIN, PLACE_NO_MAX + 1):
+        races = get_pending_races(year, month, day, place_no)
+        if not races:
+            logger.debug(f"{year}年{month:02d}月{day:02d}日 place_no={place_no} は取得済みのためスキップします")
+            continue
+
+        # place_no間の待機時間（IP制限対策）
+        if fetched:
+            time.sleep(BASE_WAIT_TIME * 2)  # place_no間は少し長めに待機
+        fetched = True
+
         logger.info(f"{year}年{month:02d}月{day:02d}日 place_no={place_no} のHTMLを取得します（WebDriverを場ごとに再起動）")
         local_driver = None
         try:
             # 場ごとに新しいWebDriverを起動
             local_driver = init_webdriver()
-            get_kyotei_html_by_date_and_place_no(local_driver, year, month, day, place_no)
+            get_kyotei_html_by_date_and_place_no(local_driver, year, month, day, place_no, races)
         except Exception as e:
             logger.error(f"{year}年{month:02d}月{day:02d}日 place_no={place_no} の処理中にエラーが発生しました: {str(e)}")
         finally:
@@ -635,10 +726,6 @@ def get_kyotei_html_by_date_all_place_nos(driver, year, month, day):
                     local_driver.quit()
                 except Exception:
                     pass
-        
-        # place_no間の待機時間（IP制限対策）
-        if place_no < PLACE_NO_MAX:
-            time.sleep(BASE_WAIT_TIME * 2)  # place_no間は少し長めに待機
 
 
 def get_kyotei_html_by_year_and_month(driver, year, month):
@@ -715,31 +802,25 @@ def clean_slider_duplicates(year=None, month=None):
 
     for year in years:
         for month in months:
-            html_dir = KYOTEI_HTML_DIR + f"{year}/{month:02d}"
-            if not os.path.isdir(html_dir):
+            # 保存されているHTMLのキー一覧を取得
+            key_list = kyotei_html_store.list_keys(year, month)
+            if not key_list:
                 continue
+            logger.info(f"{year}年{month:02d}月: {len(key_list)}件のファイルをチェックします")
 
-            # ファイル一覧を取得
-            file_list = os.listdir(html_dir)
-            logger.info(f"{year}年{month:02d}月: {len(file_list)}件のファイルをチェックします")
-
-            for file_name in file_list:
-                if not file_name.endswith('.html'):
-                    continue
-
-                # ファイル名の形式: {place_no}_{race_no}_{yyyymmdd}_{slider}.html
-                parts = file_name.replace('.html', '').split('_')
+            for key in key_list:
+                # キーの形式: {place_no}_{race_no}_{yyyymmdd}_{slider}
+                parts = key.split('_')
                 if len(parts) == 4:
                     slider_value = parts[3]
                     # slider=1,2,3のファイルを削除
                     if slider_value in ['1', '2', '3']:
-                        file_path = os.path.join(html_dir, file_name)
                         try:
-                            os.remove(file_path)
+                            kyotei_html_store.delete(year, month, key)
                             deleted_count += 1
-                            logger.debug(f"削除: {file_path}")
+                            logger.debug(f"削除: {key}")
                         except Exception as e:
-                            logger.error(f"ファイル削除エラー ({file_path}): {str(e)}")
+                            logger.error(f"ファイル削除エラー ({key}): {str(e)}")
 
     logger.info(f"slider=1,2,3の重複ファイル削除処理を完了しました（{deleted_count}件削除）")
 
@@ -754,8 +835,13 @@ if __name__ == "__main__":
     parser.add_argument("--race-no", type=int, help="レース番号を指定します（1-12）")
     parser.add_argument("--slider", type=int, help="スライダー値を指定します（0-3）")
     parser.add_argument("--clean-slider", action="store_true", help="slider=1,2,3の重複ファイルを削除します（slider=0のみ残します）")
+    parser.add_argument("--ledger", action="store_true", help="取得状況のデータベースを使い、取得済み・データなしのレースはページを開かずにスキップします")
     args = parser.parse_args()
 
+    # 取得状況のデータベースを開く
+    if args.ledger:
+        kyotei_ledger = FetchLedger()
+
     # ログフォーマットを定義
     formatter = "%(asctime)s [%(levelname)s]\t%(message)s"
     # ログファイルを定義
@@ -805,6 +891,10 @@ if __name__ == "__main__":
                 except:
                     pass
 
+    # 取得状況のデータベースを閉じる
+    if kyotei_ledger is not None:
+        kyotei_ledger.close()
+
     # 処理終了をログに出力
     logger.info("ボートレース HTML取得処理を終了します")
 
@@ -0,0 +1,245 @@
+# coding:utf-8
+"""
+変換済みのCSVに登場する馬・騎手・調教師・馬主のプロフィールのHTMLを取得する
+
+全年度のCSVからIDの重複を除いて取得対象を作り、各IDのページを1度だけ取得する
+IDごとに最後に出走したレースを版として取得状況に記録し、
+前回の取得後に出走したもの(版が変わったもの)のみを取得し直す
+血統のページは変わらないため取得し直さない
+
+取得したHTMLは種類ごとにアーカイブ(html_profile/<種類>.pack)に保存する
+"""
+import argparse
+import configparser
+import datetime
+import logging
+import os
+from os import path
+
+import pandas as pd
+import pytz
+
+from fetch_ledger import FetchLedger
+from get_race_html import create_session, download_html, get_html_size
+from html_store import HtmlArchive
+from id_registry import IdRegistry
+
+config = configparser.ConfigParser()
+config.read(os.getcwd() + "/config.ini", encoding="utf-8")
+
+now_datetime = datetime.datetime.now(pytz.timezone("Asia/Tokyo"))
+
+
+OWN_FILE_NAME = path.splitext(path.basename(__file__))[0]
+# csvファイルが格納されているフォルダ
+CSV_DIR = os.getcwd() + config.get("DIR", "CSV_DIR")
+# 取得したhtmlを格納するフォルダ
+PROFILE_HTML_DIR = os.getcwd() + config.get("DIR", "PROFILE_HTML_DIR", fallback="/html_profile/")
+# ログファイル名
+logger = logging.getLogger(__name__)
+# CSVを読み込む開始年
+FROM_YEAR = config.getint("CONST", "FROM_YEAR")
+
+# プロフィールの種類ごとの設定
+# kind: id_registryの種類(馬データのCSVの<種類>_codeの列をキー番号に戻す)、url: プロフィールのURL、
+# refresh: Trueのときは出走するたびに取得し直す
+PROFILE_TYPES = {
+    "horse": {
+        "kind": "horse",
+        "url": "https://db.netkeiba.com/horse/{id}/",
+        "refresh": True,
+    },
+    "horse_ped": {
+        "kind": "horse",
+        "url": "https://db.netkeiba.com/horse/ped/{id}/",
+        "refresh": False,
+    },
+    "jockey": {
+        "kind": "jockey",
+        "url": "https://db.netkeiba.com/jockey/{id}/",
+        "refresh": True,
+    },
+    "trainer": {
+        "kind": "trainer",
+        "url": "https://db.netkeiba.com/trainer/{id}/",
+        "refresh": True,
+    },
+    "owner": {
+        "kind": "owner",
+        "url": "https://db.netkeiba.com/owner/{id}/",
+        "refresh": True,
+    },
+}
+# 取得状況に記録する取得元の接頭辞(profile_horseなど)
+PROFILE_SOURCE_PREFIX = "profile_"
+# 開催日の形式(例: 2024-01-06)
+DATE_PATTERN = r"(\d+)-(\d+)-(\d+)"
+
+
+def get_profile_source(profile_type):
+    return PROFILE_SOURCE_PREFIX + profile_type
+
+
+def get_profile_archive(profile_type):
+    return HtmlArchive(PROFILE_HTML_DIR + profile_type)
+
+
+def get_profile_html(profile_types=None, limit=None):
+    """
+    プロフィールのHTMLを取得する
+
+    Args:
+        profile_types: 取得する種類のリスト(省略時は全種類)
+        limit: 種類ごとに取得する最大件数(省略時は全件)
+    """
+    profile_types = profile_types or list(PROFILE_TYPES)
+    last_races = load_last_races()
+    if last_races.empty:
+        logger.info("変換済みのCSVがないためプロフィールを取得しません")
+        return
+    ledger = FetchLedger()
+    session = create_session()
+    try:
+        for profile_type in profile_types:
+            register_profile_targets(ledger, profile_type, last_races)
+            targets = ledger.pending(get_profile_source(profile_type))
+            if limit is not None:
+                targets = targets[:limit]
+            logger.info(f"{profile_type}のプロフィールを{len(targets)}件取得します")
+            saved = download_profile_htmls(ledger, session, profile_type, targets)
+            logger.info(f"{profile_type}のプロフィールを{saved}件保存しました")
+    finally:
+        session.close()
+        ledger.close()
+
+
+def load_last_races():
+    """
+    変換済みの馬データのCSVを読み込み、IDごとに最後に出走したレースを求める
+
+    Returns:
+        pandas.DataFrame: race_id、開催日(sort_key: yyyymmdd)と種類ごとのキー番号(<種類>_id)の列を持つ出走データ
+    """
+    kinds = sorted({profile["kind"] for profile in PROFILE_TYPES.values()})
+    registry = IdRegistry()
+    runs_list = []
+    for year in range(FROM_YEAR, now_datetime.year + 1):
+        horse_data_csv = CSV_DIR + "horse-" + str(year) + ".csv"
+        race_data_csv = CSV_DIR + "race-" + str(year) + ".csv"
+        if not (os.path.isfile(horse_data_csv) and os.path.isfile(race_data_csv)):
+            continue
+        horse_df = pd.read_csv(
+            horse_data_csv,
+            usecols=["race_id"] + [kind + "_code" for kind in kinds],
+            dtype=dict({kind + "_code": "Int64" for kind in kinds}, race_id=str),
+        )
+        # CSVにはコードが保存されているため、URLに使うキー番号に戻す
+        for kind in kinds:
+            horse_df[kind + "_id"] = registry.decode(kind, horse_df.pop(kind + "_code"))
+        race_df = pd.read_csv(race_data_csv, usecols=["race_id", "date"], dtype=str)
+        dates = race_df["date"].str.extract(DATE_PATTERN).astype(float)
+        race_df["sort_key"] = dates[0] * 10000 + dates[1] * 100 + dates[2]
+        runs = horse_df.merge(race_df[["race_id", "sort_key"]], on="race_id", how="left")
+        # 開催日が読み取れない行はレースIDの年の1月1日とみなす
+        runs["sort_key"] = runs["sort_key"].fillna(runs["race_id"].str[:4].astype(float) * 10000 + 101)
+        runs_list.append(runs)
+    registry.close()
+    if not runs_list:
+        return pd.DataFrame()
+    return pd.concat(runs_list, ignore_index=True)
+
+
+def register_profile_targets(ledger, profile_type, last_races):
+    """
+    IDの重複を除いて取得対象を登録する
+
+    出走するたびに取得し直す種類は、最後に出走したレースのIDを版として登録するため、
+    前回の取得後に出走したIDは未取得に戻る
+    """
+    profile = PROFILE_TYPES[profile_type]
+    column = profile["kind"] + "_id"
+    latest = (
+        last_races.dropna(subset=[column])
+        .sort_values(["sort_key", "race_id"])
+        .drop_duplicates(column, keep="last")
+    )
+    targets = []
+    for entity_id, race_id, sort_key in zip(latest[column], latest["race_id"], latest["sort_key"]):
+        sort_key = int(sort_key)
+        targets.append((
+            entity_id,
+            sort_key // 10000,
+            sort_key // 100 % 100,
+            profile["url"].format(id=entity_id),
+            race_id if profile["refresh"] else "",
+        ))
+    ledger.register_revisions(get_profile_source(profile_type), targets)
+    logger.info(f"{profile_type}のIDを{len(targets)}件登録しました")
+
+
+def download_profile_htmls(ledger, session, profile_type, targets):
+    """
+    プロフィールのHTMLを順に取得してアーカイブに保存する
+
+    Args:
+        ledger: 取得状況を記録するFetchLedger
+        session: HTTPセッション
+        profile_type: プロフィールの種類
+        targets: (ID, 年, 月, URL)のリスト
+
+    Returns:
+        int: 保存したHTMLの件数
+    """
+    source = get_profile_source(profile_type)
+    archive = get_profile_archive(profile_type)
+    saved = 0
+    for entity_id, year, month, url in targets:
+        try:
+            html, _ = download_html(url, session)
+            archive.write(entity_id, html)
+            ledger.mark_done(source, entity_id, year, month, get_html_size(html))
+            saved += 1
+        except Exception as e:
+            logger.error(f"プロフィールの取得に失敗しました ({url}): {str(e)}")
+            ledger.mark_failed(source, entity_id, year, month, e)
+    return saved
+
+
+def read_profile_html(profile_type, entity_id):
+    """
+    保存したプロフィールのHTMLを読み込む(保存されていない場合はNone)
+    """
+    archive = get_profile_archive(profile_type)
+    if entity_id not in archive:
+        return None
+    return archive.read(entity_id).decode("utf-8")
+
+
+if __name__ == "__main__":
+    # コマンドライン引数のパーサーを設定
+    parser = argparse.ArgumentParser(description="馬・騎手・調教師・馬主のプロフィールのHTMLを取得します")
+    parser.add_argument(
+        "--type",
+        nargs="+",
+        choices=list(PROFILE_TYPES),
+        help="取得する種類を指定します（省略時は全種類）",
+    )
+    parser.add_argument(
+        "--limit",
+        type=int,
+        help="種類ごとに取得する最大件数を指定します",
+    )
+    args = parser.parse_args()
+
+    # ログフォーマットを定義
+    formatter = "%(asctime)s [%(levelname)s]\t%(message)s"
+    # ログファイルを定義
+    logging.basicConfig(
+        filename="log/activity.log", level=logging.INFO, format=formatter
+    )
+    # 処理開始をログに出力
+    logger.info("プロフィール取得処理を開始します")
+    # 処理開始
+    get_profile_html(profile_types=args.type, limit=args.limit)
+    # 処理終了をログに出力
+    logger.info("プロフィール取得処理を終了します")
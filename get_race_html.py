@@ -2,16 +2,28 @@
 """
 urlディレクトリに存在する情報からHTMLファイルを取得する
 """
+import argparse
+import asyncio
 import configparser
+import csv
 import datetime
+import json
 import logging
 import os
+import re
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from os import path
+from urllib.parse import urlparse
 
 import pytz
 import requests
 from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+
+from fetch_ledger import RACE_SOURCE, FetchLedger
+from html_store import HtmlStore
 
 config = configparser.ConfigParser()
 config.read(os.getcwd() + "/config.ini", encoding="utf-8")
@@ -24,92 +36,790 @@ OWN_FILE_NAME = path.splitext(path.basename(__file__))[0]
 RACE_URL_DIR = os.getcwd() + config.get("DIR", "RACE_URL_DIR")
 # 取得したhtmlを格納するフォルダ
 RACE_HTML_DIR = os.getcwd() + config.get("DIR", "RACE_HTML_DIR")
+# 取得したhtmlの保存先
+html_store = HtmlStore(RACE_HTML_DIR)
 # ログファイル名
 logger = logging.getLogger(__name__)
 # HTMLを作成する開始年
 FROM_YEAR = config.getint("CONST", "FROM_YEAR")
+# ホストごとのリクエストの平均間隔(秒)
+REQUEST_INTERVAL = config.getfloat("CONST", "REQUEST_INTERVAL", fallback=5)
+# ホストごとに連続して送れるリクエスト数
+HTML_BURST = config.getint("CONST", "HTML_BURST", fallback=1)
+# 一時的なエラーで再試行する回数
+MAX_RETRIES = 3
+# 再試行するまでの基本の待機時間(秒)。再試行するたびに2倍にする
+RETRY_BACKOFF = 2
+# 再試行するHTTPのステータスコード
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# ブラウザのようなヘッダー
+HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
+    "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8",
+    "Accept-Language": "ja,en-US;q=0.9,en;q=0.8",
+    "Accept-Encoding": "gzip, deflate, br",
+    "Connection": "keep-alive",
+    "Upgrade-Insecure-Requests": "1",
+    "Referer": "https://db.netkeiba.com/",
+}
+
+# レースのページのURL
+RACE_PAGE_URL = "https://db.netkeiba.com/race/{race_id}/"
+
+# スナップショットとして残す要素(タグ名, class名)
+# convert_csv_into_htmlのget_rade_and_horse_data_by_htmlが読み込む要素のみを残す
+SNAPSHOT_ELEMENTS = [
+    (b"div", b"data_intro"),
+    (b"table", b"race_table_01"),
+    (b"table", b"pay_table_01"),
+]
+# スナップショットの先頭に付ける文字コードの記録
+SNAPSHOT_HEADER = b"<!-- snapshot charset=%s -->\n"
+# 文字コードが判別できない場合の文字コード
+DEFAULT_CHARSET = "EUC-JP"
+
+# コース情報の先頭の文字(芝・ダート・障害)
+SURFACES = ["芝", "ダ", "障"]
+# 取得順
+ORDERS = ["newest", "turf"]
+
+
+def create_session(pool_maxsize=1):
+    """
+    レースのページの取得に使うHTTPセッションを作成する
+
+    Args:
+        pool_maxsize: 同じホストに保持するコネクションの最大数
+
+    Returns:
+        requests.Session: ヘッダーを設定し、コネクションを再利用するセッション
+    """
+    session = requests.Session()
+    session.headers.update(HEADERS)
+    # 再試行もリクエスト間隔の制限を受けるよう、urllib3では再試行せずdownload_htmlで再試行する
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize, max_retries=0)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def get_validators_file(year, month):
+    """
+    月ごとの検証情報ファイル名(/html/yyyy/mm.validators.json)を返す
+
+    HTMLのフォルダの外に置き、HTMLの一覧に含まれないようにする
+    """
+    return html_store.month_dir(year, month) + ".validators.json"
+
+
+def load_validators(year, month):
+    """
+    月ごとのレースIDをキーとした検証情報(ETag・Last-Modified・取得日時)を読み込む
+    """
+    validators_file = get_validators_file(year, month)
+    if not os.path.isfile(validators_file):
+        return {}
+    with open(validators_file, "r", encoding="utf-8") as f:
+        return json.load(f)
+
 
+def save_validators(year, month, validators):
+    """
+    月ごとの検証情報を書き出す
+    """
+    os.makedirs(os.path.dirname(get_validators_file(year, month)), exist_ok=True)
+    with open(get_validators_file(year, month), "w", encoding="utf-8") as f:
+        json.dump(validators, f)
 
-def get_race_html():
+
+def get_race_html(
+    exclude_surfaces=(), order=None, concurrency=None, snapshot=False, use_ledger=False
+):
+    """
+    対象期間のHTMLを月ごとに取得する
+
+    Args:
+        exclude_surfaces: 取得しないコース(SURFACESの値)
+        order: 取得順(ORDERSの値)。Noneのときは古い月からURL一覧の順に取得する
+        concurrency: 指定した場合は全期間の未取得分をまとめてasyncioで並行して取得する
+        snapshot: Trueのときはページ全体ではなく必要な要素のみを保存する
+        use_ledger: Trueのときは保存先を確認せず、取得状況のデータベースから未取得分を取得する
+    """
+    target_months = []
     # 昨年までのデータを取得
     for year in range(FROM_YEAR, now_datetime.year):
         for month in range(1, 13):
-            get_race_html_by_year_and_month(year, month)
+            target_months.append((year, month))
     # 今年のデータを取得
     for year in range(now_datetime.year, now_datetime.year + 1):
         for month in range(1, now_datetime.month + 1):
-            get_race_html_by_year_and_month(year, month)
+            target_months.append((year, month))
+    # 新しい月から取得する
+    if order == "newest":
+        target_months.reverse()
+    if use_ledger:
+        get_race_html_with_ledger(
+            target_months, exclude_surfaces, order, concurrency, snapshot
+        )
+        return
+    if concurrency or order:
+        # 全ての月の取得対象をまとめてから、1回で取得順に並べ替える
+        targets = []
+        for year, month in target_months:
+            targets += list_race_html_targets(year, month, exclude_surfaces)
+        targets = sort_race_targets(targets, load_race_indexes(target_months), order)
+        if concurrency:
+            logger.info(f"{len(targets)}件のHTMLを同時に{concurrency}件まで並行して取得します")
+            saved = asyncio.run(download_race_htmls(targets, concurrency, snapshot))
+        else:
+            logger.info(f"{len(targets)}件のHTMLを取得順に取得します")
+            saved = download_race_htmls_serially(targets, snapshot)
+        logger.info(f"{len(targets)}件中{saved}件のHTMLを保存しました")
+        return
+    # 全期間で1つのセッションを使い、コネクションを再利用する
+    session = create_session()
+    try:
+        for year, month in target_months:
+            get_race_html_by_year_and_month(
+                year, month, exclude_surfaces, order, session, snapshot
+            )
+    finally:
+        session.close()
+
+
+def get_race_html_with_ledger(
+    target_months, exclude_surfaces=(), order=None, concurrency=None, snapshot=False
+):
+    """
+    取得状況のデータベースに記録された未取得・再試行待ちのHTMLを取得する
+
+    URL一覧が変更された月のみ取得対象を登録し直すため、再開時の確認は未取得の件数分で済む
+
+    Args:
+        target_months: 対象の(年, 月)のリスト(取得順)
+        exclude_surfaces: 取得しないコース(SURFACESの値)
+        order: 取得順(ORDERSの値)
+        concurrency: 指定した場合はasyncioで並行して取得する
+        snapshot: Trueのときは必要な要素のみを保存する
+    """
+    ledger = FetchLedger()
+    try:
+        for year, month in target_months:
+            register_race_targets(ledger, year, month)
+        # 未取得の対象を年月ごとにまとめ、索引の情報で絞り込む
+        pending_urls = {}
+        for _, year, month, url in ledger.pending(RACE_SOURCE):
+            pending_urls.setdefault((year, month), []).append(url)
+        pending_months = [key for key in target_months if key in pending_urls]
+        race_index = load_race_indexes(pending_months)
+        targets = []
+        for year, month in pending_months:
+            urls = select_race_urls(pending_urls[(year, month)], race_index, exclude_surfaces)
+            targets += [(url, year, month) for url in urls]
+        # 全ての月の取得対象をまとめて取得順に並べ替える
+        targets = sort_race_targets(targets, race_index, order)
+        logger.info(f"取得状況のデータベースから{len(targets)}件のHTMLを取得します")
+        if concurrency:
+            saved = asyncio.run(
+                download_race_htmls(targets, concurrency, snapshot, ledger)
+            )
+        else:
+            saved = download_race_htmls_serially(targets, snapshot, ledger)
+        logger.info(f"{len(targets)}件中{saved}件のHTMLを保存しました")
+    finally:
+        ledger.close()
+
+
+def register_race_targets(ledger, year, month):
+    """
+    URL一覧が前回の登録から変更されていれば、取得対象として登録する
+
+    登録時に保存済みのHTMLは取得済みとして記録する
+
+    Args:
+        ledger: FetchLedger
+        year: 年
+        month: 月
+    """
+    race_url_file = RACE_URL_DIR + str(year) + str("{0:02d}".format(month)) + ".txt"
+    if not os.path.isfile(race_url_file) or ledger.is_registered_file(race_url_file):
+        return
+    with open(race_url_file, "r") as f:
+        urls = f.read().splitlines()
+    race_ids = [url.split("/")[-2] for url in urls]
+    ledger.register(
+        RACE_SOURCE,
+        [(race_id, year, month, url) for race_id, url in zip(race_ids, urls)],
+    )
+    ledger.mark_saved(RACE_SOURCE, set(race_ids) & html_store.list_keys(year, month))
+    ledger.mark_registered_file(race_url_file)
+
+
+def load_race_index(year, month):
+    """
+    get_race_urlが書き出したレース一覧の索引(yyyymm.tsv)を読み込む
+
+    Args:
+        year: 年
+        month: 月
+
+    Returns:
+        dict: レースIDをキーとした索引の行。索引がない場合は空
+    """
+    race_index_file = (
+        RACE_URL_DIR + str(year) + str("{0:02d}".format(month)) + ".tsv"
+    )
+    if not os.path.isfile(race_index_file):
+        return {}
+    with open(race_index_file, "r", encoding="utf-8", newline="") as f:
+        return {row["race_id"]: row for row in csv.DictReader(f, delimiter="\t")}
+
+
+def load_race_indexes(target_months):
+    """
+    複数の月の索引を1つにまとめて読み込む(レースIDは月をまたいで重複しない)
+
+    Args:
+        target_months: (年, 月)のリスト
+
+    Returns:
+        dict: レースIDをキーとした索引の行
+    """
+    race_index = {}
+    for year, month in target_months:
+        race_index.update(load_race_index(year, month))
+    return race_index
+
+
+def select_race_urls(urls, race_index, exclude_surfaces=()):
+    """
+    索引の情報で取得対象のURLを絞り込む
+
+    索引にないレースは絞り込まない
+
+    Args:
+        urls: URL一覧
+        race_index: load_race_indexが返す索引
+        exclude_surfaces: 取得しないコース(SURFACESの値)
 
+    Returns:
+        list: 取得対象のURL一覧
+    """
+    selected = []
+    for url in urls:
+        row = race_index.get(url.split("/")[-2])
+        if row is not None and row["course"][:1] in exclude_surfaces:
+            continue
+        selected.append(url)
+    return selected
 
-def get_race_html_by_year_and_month(year, month):
+
+def sort_race_targets(targets, race_index, order=None):
+    """
+    取得対象を取得順に並べ替える
+
+    複数の月の取得対象をまとめて渡し、月をまたいで1回で並べ替える
+    索引にないレースは末尾に置き、同じ順位の対象は渡した順を保つ
+
+    Args:
+        targets: (URL, 年, 月)のリスト
+        race_index: 対象の月の索引(load_race_indexes)
+        order: 取得順(ORDERSの値)。Noneのときは並べ替えない
+
+    Returns:
+        list: 並べ替えた(URL, 年, 月)のリスト
+    """
+    if order == "newest":
+        # 開催日の新しい順(索引にないレースは最後)
+        return sorted(
+            targets,
+            key=lambda target: race_index.get(target[0].split("/")[-2], {}).get("date", ""),
+            reverse=True,
+        )
+    if order == "turf":
+        # 芝、ダート、障害の順(索引にないレースは最後)
+        return sorted(
+            targets,
+            key=lambda target: _surface_rank(race_index.get(target[0].split("/")[-2])),
+        )
+    return list(targets)
+
+
+def _surface_rank(row):
+    if row is None or row["course"][:1] not in SURFACES:
+        return len(SURFACES)
+    return SURFACES.index(row["course"][:1])
+
+
+def list_race_html_targets(year, month, exclude_surfaces=()):
+    """
+    対象年月のURL一覧のうち、HTMLを保存していないものをURL一覧の順に返す
+
+    Args:
+        year: 年
+        month: 月
+        exclude_surfaces: 取得しないコース(SURFACESの値)
+
+    Returns:
+        list: (URL, 年, 月)のリスト
+    """
     # 対象年のファイルを開く
     with open(
         RACE_URL_DIR + str(year) + str("{0:02d}".format(month)) + ".txt", "r"
     ) as f:
-        # HTMLを保存するフォルダ(/html/yyyy/mm 配下に保存)
-        save_dir = RACE_HTML_DIR + str(year) + "/" + str("{0:02d}".format(month))
-        # フォルダが存在しなければ新規作成
-        if not os.path.isdir(save_dir):
-            os.makedirs(save_dir)
-        # URLを取得
-        urls = f.read().splitlines()
-        # 現在保持しているHTMLのリストを取得
-        file_list = os.listdir(save_dir)
-        # 保持しているHTMLの数と取得対象のHTMLの数が異なる場合のみ処理を行う
-        if len(urls) != len(file_list):
-            logger.info(
-                str(year) + "年" + str("{0:02d}".format(month)) + "月のHTMLを取得します"
-            )
-            for url in urls:
-                # URLをスラッシュ区切りで格納
-                list = url.split("/")
-                # レースIDを取得
-                race_id = list[-2]
-                # 保存するファイル名
-                save_file_path = save_dir + "/" + race_id + ".html"
-                # 対象のファイルが存在しなければ取得
-                if not os.path.isfile(save_file_path):
-                    # ブラウザのようなヘッダーを設定
-                    headers = {
-                        'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-                        'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
-                        'Accept-Language': 'ja,en-US;q=0.9,en;q=0.8',
-                        'Accept-Encoding': 'gzip, deflate, br',
-                        'Connection': 'keep-alive',
-                        'Upgrade-Insecure-Requests': '1',
-                        'Referer': 'https://db.netkeiba.com/',
-                    }
-                    # レスポンスを取得
-                    response = requests.get(url, headers=headers, timeout=30)
-                    # エンコーディングを行う
-                    response.encoding = response.apparent_encoding
-                    # レスポンスをテキスト形式で取得
-                    html = response.text
-                    # 5秒待機
-                    time.sleep(5)
-                    # HTMLを保存
-                    with open(save_file_path, "w") as file:
-                        file.write(html)
-            # 処理結果を出力
-            logging.info(
-                str(year)
-                + "年"
-                + str("{0:02d}".format(month))
-                + "月のHTMLを"
-                + str(len(urls))
-                + "件保存しました"
-            )
+        # URLを取得し、索引の情報で絞り込む
+        urls = select_race_urls(
+            f.read().splitlines(),
+            load_race_index(year, month),
+            exclude_surfaces,
+        )
+    # 現在保持しているHTMLのレースIDを取得(/html/yyyy/mm 配下に保存)
+    saved_race_ids = html_store.list_keys(year, month)
+    targets = []
+    for url in urls:
+        # レースIDを取得
+        race_id = url.split("/")[-2]
+        # 対象のHTMLが存在しなければ取得
+        if race_id not in saved_race_ids:
+            targets.append((url, year, month))
+    return targets
+
+
+def detect_charset(response):
+    """
+    Content-Typeヘッダーかmetaタグから文字コードを取得する
+
+    本文全体から推定するapparent_encodingより軽く、スナップショットの保存に使う
+    """
+    match = re.search(r"charset=([\w-]+)", response.headers.get("Content-Type", ""), re.I)
+    if match is None:
+        match = re.search(rb"charset=[\"']?([\w-]+)", response.content[:2048], re.I)
+        if match is None:
+            return DEFAULT_CHARSET
+        return match.group(1).decode("ascii")
+    return match.group(1)
+
+
+def extract_snapshot(content, charset):
+    """
+    ページのバイト列からSNAPSHOT_ELEMENTSの要素のみを切り出し、スナップショットを作成する
+
+    区切りの「<」「>」はEUC-JP・UTF-8のマルチバイト文字に含まれないため、
+    デコードせずにバイト列のまま切り出す
+
+    Args:
+        content: ページのバイト列
+        charset: ページの文字コード
+
+    Returns:
+        bytes: 文字コードの記録と切り出した要素を連結したバイト列
+    """
+    fragments = []
+    for tag, class_name in SNAPSHOT_ELEMENTS:
+        start_pattern = re.compile(
+            rb"<" + tag + rb"\b[^>]*\bclass=[\"'][^\"']*\b" + class_name + rb"\b[^>]*>", re.I
+        )
+        tag_pattern = re.compile(rb"<(/?)" + tag + rb"\b", re.I)
+        for match in start_pattern.finditer(content):
+            # 入れ子の同じタグを数え、対応する終了タグまでを切り出す
+            depth = 1
+            for tag_match in tag_pattern.finditer(content, match.end()):
+                depth += -1 if tag_match.group(1) else 1
+                if depth == 0:
+                    end = content.find(b">", tag_match.end()) + 1
+                    fragments.append(content[match.start():end])
+                    break
+    return SNAPSHOT_HEADER % charset.encode("ascii") + b"\n".join(fragments)
+
+
+def download_html(url, session, validator=None, snapshot=False):
+    """
+    レースのページを取得し、テキストとして返す
+
+    validatorを指定した場合は条件付きリクエストを送り、更新されていなければ本文を取得しない
+
+    Args:
+        url: レース情報のURL
+        session: HTTPセッション
+        validator: 前回取得時の検証情報
+        snapshot: Trueのときはextract_snapshotで作成したバイト列を返す
+
+    Returns:
+        tuple: (HTML(更新されていない場合はNone), 今回の検証情報)
+    """
+    headers = {}
+    if validator:
+        if validator.get("etag"):
+            headers["If-None-Match"] = validator["etag"]
+        if validator.get("last_modified"):
+            headers["If-Modified-Since"] = validator["last_modified"]
+    # レスポンスを取得
+    response = send_request(url, session, headers)
+    checked_at = datetime.datetime.now(pytz.timezone("Asia/Tokyo")).isoformat()
+    if response.status_code == 304:
+        return None, dict(validator, checked_at=checked_at)
+    response.raise_for_status()
+    new_validator = {
+        "etag": response.headers.get("ETag"),
+        "last_modified": response.headers.get("Last-Modified"),
+        "fetched_at": checked_at,
+        "checked_at": checked_at,
+    }
+    if snapshot:
+        # デコードせずに必要な要素のみを切り出す
+        return extract_snapshot(response.content, detect_charset(response)), new_validator
+    # エンコーディングを行う
+    response.encoding = response.apparent_encoding
+    # レスポンスをテキスト形式で取得
+    return response.text, new_validator
+
+
+def send_request(url, session, headers):
+    """
+    ホストごとのトークンバケットで間隔をあけてGETリクエストを送り、一時的なエラーは再試行する
+
+    再試行のリクエストもトークンを取得してから送り、さらに再試行するたびに待機時間を2倍にする
+    """
+    bucket = get_token_bucket(urlparse(url).netloc)
+    for attempt in range(MAX_RETRIES + 1):
+        bucket.acquire()
+        try:
+            response = session.get(url, headers=headers, timeout=30)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if attempt == MAX_RETRIES:
+                raise
+            logger.warning(f"リクエストに失敗したため再試行します ({url}): {str(e)}")
         else:
-            # 全てのデータを取得済の場合はログ出力のみ行う
-            logging.info(
-                str(year)
-                + "年"
-                + str("{0:02d}".format(month))
-                + "月のHTMLは取得済のためスキップします"
-            )
+            if response.status_code not in RETRY_STATUSES or attempt == MAX_RETRIES:
+                return response
+            logger.warning(f"ステータスコード{response.status_code}のため再試行します ({url})")
+        time.sleep(RETRY_BACKOFF * 2 ** attempt)
+    return response
+
+
+def save_html(year, month, race_id, html):
+    # HTMLを保存(スナップショットはバイト列のまま保存)
+    html_store.write(year, month, race_id, html)
+
+
+def get_race_html_by_year_and_month(
+    year, month, exclude_surfaces=(), order=None, session=None, snapshot=False
+):
+    targets = sort_race_targets(
+        list_race_html_targets(year, month, exclude_surfaces),
+        load_race_index(year, month),
+        order,
+    )
+    # 保持していないHTMLがある場合のみ処理を行う
+    if targets:
+        logger.info(
+            str(year) + "年" + str("{0:02d}".format(month)) + "月のHTMLを取得します"
+        )
+        validators = load_validators(year, month)
+        own_session = session is None
+        if own_session:
+            session = create_session()
+        try:
+            for url, _, _ in targets:
+                race_id = url.split("/")[-2]
+                # リクエストの間隔はdownload_htmlでホストごとに制限する
+                html, validators[race_id] = download_html(
+                    url, session, snapshot=snapshot
+                )
+                save_html(year, month, race_id, html)
+        finally:
+            save_validators(year, month, validators)
+            if own_session:
+                session.close()
+        # 処理結果を出力
+        logging.info(
+            str(year)
+            + "年"
+            + str("{0:02d}".format(month))
+            + "月のHTMLを"
+            + str(len(targets))
+            + "件保存しました"
+        )
+    else:
+        # 全てのデータを取得済の場合はログ出力のみ行う
+        logging.info(
+            str(year)
+            + "年"
+            + str("{0:02d}".format(month))
+            + "月のHTMLは取得済のためスキップします"
+        )
+
+
+def get_html_size(html):
+    """
+    保存するHTMLのバイト数を返す
+    """
+    return len(html) if isinstance(html, bytes) else len(html.encode("utf-8"))
+
+
+def download_race_htmls_serially(targets, snapshot=False, ledger=None):
+    """
+    複数のHTMLを順に取得し、取得状況を記録する
+
+    失敗した対象は取得状況に記録して次の対象に進む
+
+    Args:
+        targets: (URL, 年, 月)のリスト
+        snapshot: Trueのときは必要な要素のみを保存する
+        ledger: 取得状況を記録するFetchLedger
+
+    Returns:
+        int: 保存したHTMLの件数
+    """
+    session = create_session()
+    validators_by_month = {}
+    saved = 0
+    try:
+        for url, year, month in targets:
+            race_id = url.split("/")[-2]
+            try:
+                html, validator = download_html(url, session, snapshot=snapshot)
+                save_html(year, month, race_id, html)
+                if (year, month) not in validators_by_month:
+                    validators_by_month[(year, month)] = load_validators(year, month)
+                validators_by_month[(year, month)][race_id] = validator
+                if ledger:
+                    ledger.mark_done(RACE_SOURCE, race_id, year, month, get_html_size(html))
+                saved += 1
+            except Exception as e:
+                logger.error(f"HTMLの取得に失敗しました ({url}): {str(e)}")
+                if ledger:
+                    ledger.mark_failed(RACE_SOURCE, race_id, year, month, e)
+    finally:
+        for (year, month), validators in validators_by_month.items():
+            save_validators(year, month, validators)
+        session.close()
+    return saved
+
+
+class TokenBucket:
+    """
+    リクエスト数を平均rate件/秒に制限するトークンバケット
+
+    capacityまでの連続したリクエストを許し、それ以降はトークンが貯まるまで待機する
+    asyncioの並行取得ではスレッドで通信するため、スレッド間で共有できるようにする
+    """
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._last_time = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(
+                    self.capacity, self._tokens + (now - self._last_time) * self.rate
+                )
+                self._last_time = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                time.sleep((1 - self._tokens) / self.rate)
+
+
+# ホストごとのトークンバケット(順次取得・並行取得・再確認の全てで共有する)
+_token_buckets = {}
+_token_buckets_lock = threading.Lock()
+
+
+def get_token_bucket(host):
+    """
+    ホストのトークンバケット(平均REQUEST_INTERVAL秒に1件、HTML_BURST件まで連続)を返す
+    """
+    with _token_buckets_lock:
+        if host not in _token_buckets:
+            _token_buckets[host] = TokenBucket(1 / REQUEST_INTERVAL, HTML_BURST)
+        return _token_buckets[host]
+
+
+async def download_race_htmls(targets, concurrency, snapshot=False, ledger=None):
+    """
+    複数のHTMLを並行して取得し、バックグラウンドで保存する
+
+    同時に処理中のリクエストはconcurrency件まで、ホストごとのリクエスト数は
+    平均で1 / REQUEST_INTERVAL件/秒までに制限する
+
+    Args:
+        targets: (URL, 年, 月)のリスト
+        concurrency: 同時に処理中にできるリクエスト数
+        snapshot: Trueのときは必要な要素のみを保存する
+        ledger: 取得状況を記録するFetchLedger(省略時は記録しない)
+
+    Returns:
+        int: 保存したHTMLの件数
+    """
+    loop = asyncio.get_running_loop()
+    # 通信と保存はブロッキング処理のためスレッドで実行する
+    executor = ThreadPoolExecutor(max_workers=concurrency + 1)
+    session = create_session(concurrency)
+    # 年月ごとの検証情報
+    validators_by_month = {}
+    target_queue = asyncio.Queue()
+    for target in targets:
+        target_queue.put_nowait(target)
+    write_queue = asyncio.Queue(maxsize=concurrency * 2)
+    saved = 0
+
+    async def fetch_worker():
+        while True:
+            try:
+                url, year, month = target_queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            # ホストごとのリクエストの間隔は、スレッドで実行するdownload_htmlで制限する
+            try:
+                html, validator = await loop.run_in_executor(
+                    executor, download_html, url, session, None, snapshot
+                )
+            except Exception as e:
+                logger.error(f"HTMLの取得に失敗しました ({url}): {str(e)}")
+                if ledger:
+                    ledger.mark_failed(RACE_SOURCE, url.split("/")[-2], year, month, e)
+                continue
+            await write_queue.put((year, month, url.split("/")[-2], html, validator))
+
+    async def writer():
+        nonlocal saved
+        while True:
+            item = await write_queue.get()
+            if item is None:
+                return
+            year, month, race_id, html, validator = item
+            try:
+                await loop.run_in_executor(executor, save_html, year, month, race_id, html)
+                if (year, month) not in validators_by_month:
+                    validators_by_month[(year, month)] = load_validators(year, month)
+                validators_by_month[(year, month)][race_id] = validator
+                if ledger:
+                    ledger.mark_done(RACE_SOURCE, race_id, year, month, get_html_size(html))
+                saved += 1
+            except Exception as e:
+                logger.error(f"HTMLの保存に失敗しました ({race_id}): {str(e)}")
+                if ledger:
+                    ledger.mark_failed(RACE_SOURCE, race_id, year, month, e)
+
+    writer_task = asyncio.ensure_future(writer())
+    try:
+        await asyncio.gather(*(fetch_worker() for _ in range(concurrency)))
+    finally:
+        await write_queue.put(None)
+        await writer_task
+        for (year, month), validators in validators_by_month.items():
+            save_validators(year, month, validators)
+        session.close()
+        executor.shutdown()
+    return saved
+
+
+def revalidate_race_html(days, session=None):
+    """
+    直近に取得したHTMLを条件付きリクエストで確認し、更新されていれば取得し直す
+
+    レース後数日間はサイト上で結果が修正されることがあるため、
+    取得日時がdays日以内のHTMLを対象にする
+
+    Args:
+        days: 対象にする取得日時の日数
+        session: HTTPセッション(省略時は新規作成)
+
+    Returns:
+        int: 取得し直したHTMLの件数
+    """
+    since = datetime.datetime.now(pytz.timezone("Asia/Tokyo")) - datetime.timedelta(
+        days=days
+    )
+    own_session = session is None
+    if own_session:
+        session = create_session()
+    checked = 0
+    updated = 0
+    try:
+        # 過去の月のレースを後から取得した場合や、月末のレースを翌月に取得した場合など、
+        # レースの月が対象期間より前でも取得日時は対象期間に入るため、全ての月の検証情報を確認する
+        year, month = FROM_YEAR, 1
+        while (year, month) <= (now_datetime.year, now_datetime.month):
+            validators = load_validators(year, month)
+            try:
+                for race_id, validator in validators.items():
+                    fetched_at = datetime.datetime.fromisoformat(validator["fetched_at"])
+                    if fetched_at < since:
+                        continue
+                    if not html_store.exists(year, month, race_id):
+                        continue
+                    url = RACE_PAGE_URL.format(race_id=race_id)
+                    saved_content = html_store.read(year, month, race_id)
+                    # 保存済みのファイルと同じ形式で取得し直す
+                    html, validators[race_id] = download_html(
+                        url, session, validator, saved_content.startswith(b"<!-- snapshot")
+                    )
+                    checked += 1
+                    if html is None:
+                        continue
+                    # 条件付きリクエストに対応していない場合も、内容が同じであれば書き換えない
+                    if saved_content == (html if isinstance(html, bytes) else html.encode()):
+                        validators[race_id]["fetched_at"] = validator["fetched_at"]
+                        continue
+                    save_html(year, month, race_id, html)
+                    updated += 1
+            finally:
+                if validators:
+                    save_validators(year, month, validators)
+            year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    finally:
+        if own_session:
+            session.close()
+    logger.info(f"直近{days}日以内に取得したHTMLを{checked}件確認し、{updated}件取得し直しました")
+    return updated
 
 
 if __name__ == "__main__":
+    # コマンドライン引数のパーサーを設定
+    parser = argparse.ArgumentParser(description="JRAのレースのHTMLを取得します")
+    parser.add_argument(
+        "--exclude-surface",
+        nargs="+",
+        choices=SURFACES,
+        default=[],
+        help="取得しないコースを指定します（例: 障）",
+    )
+    parser.add_argument(
+        "--order",
+        choices=ORDERS,
+        help="取得順を指定します（newest: 新しい順、turf: 芝を優先）",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        help="asyncioで同時に処理中にするリクエスト数を指定します",
+    )
+    parser.add_argument(
+        "--revalidate",
+        type=int,
+        metavar="DAYS",
+        help="指定した日数以内に取得したHTMLが更新されていないか確認します",
+    )
+    parser.add_argument(
+        "--snapshot",
+        action="store_true",
+        help="ページ全体ではなくレース結果と払い戻しの要素のみを保存します",
+    )
+    parser.add_argument(
+        "--ledger",
+        action="store_true",
+        help="取得状況のデータベースを使い、未取得・再試行待ちのHTMLのみを取得します",
+    )
+    args = parser.parse_args()
+
     # ログフォーマットを定義
     formatter = "%(asctime)s [%(levelname)s]\t%(message)s"
     # ログファイルを定義
@@ -119,6 +829,15 @@ if __name__ == "__main__":
     # 処理開始をログに出力
     logger.info("HTML取得処理を開始します")
     # 処理開始
-    get_race_html()
+    if args.revalidate is not None:
+        revalidate_race_html(args.revalidate)
+    else:
+        get_race_html(
+            exclude_surfaces=args.exclude_surface,
+            order=args.order,
+            concurrency=args.concurrency,
+            snapshot=args.snapshot,
+            use_ledger=args.ledger,
+        )
     # 処理終了をログに出力
     logger.info("HTML取得処理を終了します")
@@ -11,11 +11,21 @@ from selenium.webdriver.firefox.service import Service
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support import expected_conditions as EC
 from selenium import webdriver
+from html.parser import HTMLParser
+from urllib.parse import urljoin
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import argparse
+import csv
+import json
 import logging
 from os import path
 import os
 import re
 import pytz
+import queue
+import requests
+import threading
 import time
 import datetime
 import configparser
@@ -35,9 +45,136 @@ RACE_URL_DIR = os.getcwd() + config.get('DIR', 'RACE_URL_DIR')
 URL = config.get('URL', 'KEIBA_DB_URL')
 # URLを取得する開始年
 FROM_YEAR = config.getint('CONST', 'FROM_YEAR')
+# 検索結果を直接取得するURL(HTTPモード)
+SEARCH_URL = config.get('URL', 'KEIBA_DB_SEARCH_URL')
+# ページ取得の最小間隔(秒)。並列取得時は全ワーカーの合計に対する間隔
+REQUEST_INTERVAL = config.getfloat('CONST', 'REQUEST_INTERVAL', fallback=5)
+# 並列取得時にWebDriverの異常終了から復旧を試みる回数
+MAX_WORKER_RETRIES = 3
+# 並列取得時にWebDriverを再起動するまでの待機時間(秒)
+WORKER_RETRY_WAIT = 30
 
+# JRAの競馬場コード(01:札幌 〜 10:小倉)
+JRA_PLACE_CODES = [str(i).zfill(2) for i in range(1, 11)]
+# 検索結果の1ページあたりの表示件数(サイトの初期値)
+DEFAULT_LIST_NUM = 20
+# 検索結果の1ページあたりの表示件数(選択できる最大値)
+MAX_LIST_NUM = 100
+# レース一覧の索引ファイル(yyyymm.tsv)の列
+RACE_INDEX_COLUMNS = [
+    # レースID
+    'race_id',
+    # 開催日(yyyy/mm/dd)
+    'date',
+    # 開催情報(何回 + 競馬場 + 何日目)
+    'place',
+    # レース名
+    'race_name',
+    # コース情報(芝 or ダ or 障 + 距離)
+    'course',
+    # 頭数
+    'horse_num',
+]
+# 検索結果の文字コード(ヘッダーで指定がない場合)
+SEARCH_PAGE_ENCODING = 'EUC-JP'
+# ブラウザのようなヘッダー
+HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
+    'Accept-Language': 'ja,en-US;q=0.9,en;q=0.8',
+    'Accept-Encoding': 'gzip, deflate',
+    'Connection': 'keep-alive',
+    'Upgrade-Insecure-Requests': '1',
+    'Referer': 'https://db.netkeiba.com/',
+}
 
-def get_race_url():
+
+class RequestInterval:
+    """
+    リクエストの最小間隔を保証する
+
+    前回のリクエストからの経過時間を差し引いて待機するため、
+    通信にかかった時間の分だけ固定の待機時間より短くなる
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._last_time = 0.0
+
+    def wait(self):
+        with self._lock:
+            wait_time = self._last_time + self.interval - time.monotonic()
+            if wait_time > 0:
+                time.sleep(wait_time)
+            self._last_time = time.monotonic()
+
+
+class RaceTableParser(HTMLParser):
+    """
+    検索結果のrace_table_01からセルのテキストとリンクを抽出する
+
+    Attributes:
+        rows: 行ごとの[(セルのテキスト, セル内の最初のリンク), ...]のリスト(見出し行は除く)
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.rows = []
+        self._in_table = False
+        self._nested_table = 0
+        self._row = None
+        self._cell = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'table':
+            if self._in_table:
+                self._nested_table += 1
+            elif 'race_table_01' in (dict(attrs).get('class') or '').split():
+                self._in_table = True
+            return
+        if not self._in_table:
+            return
+        if tag == 'tr':
+            self._row = []
+        elif tag == 'td' and self._row is not None:
+            self._cell = [[], None]
+        elif tag == 'a' and self._cell is not None and self._cell[1] is None:
+            self._cell[1] = dict(attrs).get('href')
+
+    def handle_endtag(self, tag):
+        if not self._in_table:
+            return
+        if tag == 'table':
+            if self._nested_table:
+                self._nested_table -= 1
+            else:
+                self._in_table = False
+        elif tag == 'td' and self._cell is not None:
+            self._row.append((''.join(self._cell[0]).strip(), self._cell[1]))
+            self._cell = None
+        elif tag == 'tr' and self._row is not None:
+            # th のみの見出し行は除く
+            if self._row:
+                self.rows.append(self._row)
+            self._row = None
+
+    def handle_data(self, data):
+        if self._cell is not None:
+            self._cell[0].append(data)
+
+
+# HTTPモードで共有するリクエスト間隔
+_default_interval = RequestInterval(REQUEST_INTERVAL)
+
+
+def init_webdriver():
+    """
+    Selenium WebDriverを初期化する
+
+    Returns:
+        webdriver.Firefox: 初期化されたWebDriverインスタンス
+    """
     # Firefox Optionsの設定
     options = Options()
     # ヘッドレスモードを有効にする
@@ -66,57 +203,609 @@ def get_race_url():
         driver = webdriver.Firefox(options=options, service=service)
         # ドライバが設定されるまでの待機時間(秒)
         driver.implicitly_wait(10)
+        return driver
     except Exception as e:
         logger.error(f"Firefox WebDriverの起動に失敗しました: {str(e)}")
         logger.error(f"geckodriver.logを確認してください: {os.path.join(os.getcwd(), 'geckodriver.log')}")
         raise
-    
+
+
+def quit_webdriver(driver):
+    """
+    WebDriverを終了する(既に異常終了している場合のエラーは無視する)
+    """
+    if driver is None:
+        return
     try:
-        # 昨年までのデータを取得
-        for year in range(FROM_YEAR, now_datetime.year):
-            for month in range(1, 13):
-                # URL一覧を記載するファイル名(yyyymm.txt)
-                race_url_file = RACE_URL_DIR + \
-                    str(year) + str('{0:02d}'.format(month)) + ".txt"
-                # ファイルが存在しなければ取得
-                if not os.path.isfile(race_url_file):
-                    logger.info(
-                        str(year) + "年" + str('{0:02d}'.format(month)) + "月のURL情報を取得します")
-                    get_race_url_by_year_and_month(driver, year, month)
-        # 今年の開始から先月までのデータを取得
-        for year in range(now_datetime.year, now_datetime.year + 1):
-            for month in range(1, now_datetime.month):
-                # URL一覧を記載するファイル名(yyyymm.txt)
-                race_url_file = RACE_URL_DIR + \
-                    str(year) + str('{0:02d}'.format(month)) + ".txt"
-                # ファイルが存在しなければ取得
-                if not os.path.isfile(race_url_file):
-                    logger.info(
-                        str(year) + "年" + str('{0:02d}'.format(month)) + "月のURL情報を取得します")
-                    get_race_url_by_year_and_month(driver, year, month)
-        # 今月のデータを取得
-        logger.info(str(now_datetime.year) +
-                    "年" + str('{0:02d}'.format(now_datetime.month)) + "月のURL情報を取得します")
-        get_race_url_by_year_and_month(
-            driver, now_datetime.year, now_datetime.month)
+        driver.close()
+        driver.quit()
+    except:
+        pass
+
+
+def create_session():
+    """
+    検索結果の取得に使うHTTPセッションを作成する
+
+    Returns:
+        requests.Session: コネクションを再利用するセッション
+    """
+    session = requests.Session()
+    session.headers.update(HEADERS)
+    # 一時的なエラーは指数的に間隔をあけて再試行する
+    retry = Retry(total=3, backoff_factor=2,
+                  status_forcelist=[429, 500, 502, 503, 504])
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=4, max_retries=retry)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def get_race_url(use_selenium=False, bulk=False, workers=1):
+    """
+    対象期間のURL一覧を月ごとに取得する
+
+    Args:
+        use_selenium: TrueのときはHTTPモードを使わずSeleniumで取得する
+        bulk: Trueのときは年ごとに連続した未取得の月を1回の検索でまとめて取得し、月ごとのファイルに分割する
+        workers: Seleniumで取得する場合に並列に起動するブラウザの数
+    """
+    if use_selenium and workers > 1:
+        get_race_url_with_workers(workers)
+        return
+    session = None if use_selenium else create_session()
+    driver = init_webdriver() if use_selenium else None
+    try:
+        for year in range(FROM_YEAR, now_datetime.year + 1):
+            target_months = get_target_months(year)
+            if not target_months:
+                continue
+            # 連続した未取得の月はまとめて取得し、取得できた月は月ごとの取得を行わない
+            if bulk and session is not None:
+                month_runs, target_months = split_bulk_months(year, target_months)
+                for start_mon, end_mon in month_runs:
+                    try:
+                        get_race_url_by_period_with_requests(
+                            session, year, start_mon, year, end_mon)
+                    except Exception as e:
+                        logger.warning(
+                            f"{year}年{start_mon:02d}月から{end_mon:02d}月のURL情報をまとめて取得できませんでした。"
+                            f"月ごとに取得します: {str(e)}")
+                        target_months += range(start_mon, end_mon + 1)
+                target_months.sort()
+            for month in target_months:
+                logger.info(
+                    str(year) + "年" + str('{0:02d}'.format(month)) + "月のURL情報を取得します")
+                driver = get_race_url_by_month(session, driver, year, month)
     except Exception as e:
         logger.error(f"URL取得処理中にエラーが発生しました: {str(e)}")
         raise
     finally:
+        if session is not None:
+            session.close()
         # Firefox Driverを終了する
+        quit_webdriver(driver)
+
+
+def get_race_url_with_workers(workers, interval=None):
+    """
+    対象の月を複数のブラウザに割り振って並列に取得する
+
+    全ワーカーで1つのRequestIntervalを共有するため、サイトへのリクエスト間隔は
+    ワーカー数によらずREQUEST_INTERVAL以上に保たれる
+
+    Args:
+        workers: 起動するブラウザの数
+        interval: リクエスト間隔を管理するRequestInterval(省略時はモジュール共通のもの)
+    """
+    if interval is None:
+        interval = _default_interval
+    month_queue = queue.Queue()
+    for year in range(FROM_YEAR, now_datetime.year + 1):
+        for month in get_target_months(year):
+            month_queue.put((year, month))
+    logger.info(f"{month_queue.qsize()}か月分のURL情報を{workers}個のブラウザで取得します")
+    threads = [
+        threading.Thread(target=_browser_worker, args=(worker_no, month_queue, interval),
+                         name=f"browser-worker-{worker_no}")
+        for worker_no in range(1, workers + 1)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def _browser_worker(worker_no, month_queue, interval):
+    # ワーカーごとにWebDriverを保持し、異常終了した場合は起動し直す
+    driver = None
+    try:
+        while True:
+            try:
+                year, month = month_queue.get_nowait()
+            except queue.Empty:
+                return
+            for attempt in range(1, MAX_WORKER_RETRIES + 1):
+                try:
+                    if driver is None:
+                        driver = init_webdriver()
+                    logger.info(f"[ワーカー{worker_no}] {year}年{month:02d}月のURL情報を取得します")
+                    get_race_url_by_year_and_month(driver, year, month, interval)
+                    break
+                except Exception as e:
+                    logger.warning(
+                        f"[ワーカー{worker_no}] {year}年{month:02d}月の取得中にエラーが発生しました"
+                        f"(リトライ {attempt}/{MAX_WORKER_RETRIES}): {str(e)}")
+                    quit_webdriver(driver)
+                    driver = None
+                    time.sleep(WORKER_RETRY_WAIT * attempt)
+            else:
+                logger.error(f"[ワーカー{worker_no}] {year}年{month:02d}月のURL情報を取得できませんでした")
+    finally:
+        quit_webdriver(driver)
+
+
+def get_target_months(year):
+    """
+    URL一覧を取得する必要がある月を返す
+
+    昨年までは未取得の月のみ、今年は未取得の月に加えて今月を常に対象とする
+
+    Args:
+        year: 年
+
+    Returns:
+        list: 対象の月のリスト(昇順)
+    """
+    last_month = 12 if year < now_datetime.year else now_datetime.month
+    target_months = []
+    for month in range(1, last_month + 1):
+        # URL一覧を記載するファイル名(yyyymm.txt)
+        race_url_file = RACE_URL_DIR + \
+            str(year) + str('{0:02d}'.format(month)) + ".txt"
+        # ファイルが存在しないか、今月であれば取得
+        if not os.path.isfile(race_url_file) or \
+                (year == now_datetime.year and month == now_datetime.month):
+            target_months.append(month)
+        # 月の途中で取得したままのファイルは残りの開催分を取得
+        elif is_manifest_outdated(year, month):
+            target_months.append(month)
+    return target_months
+
+
+def split_bulk_months(year, target_months):
+    """
+    対象の月を、まとめて検索する連続した未取得の月の範囲と、月ごとに取得する月に分ける
+
+    今月と月の途中で取得したままの月は、取得済みのレースに新しいレースのみを追記するため月ごとに取得する
+
+    Args:
+        year: 年
+        target_months: get_target_monthsが返す対象の月のリスト(昇順)
+
+    Returns:
+        tuple: (開始月, 終了月)のリストと、月ごとに取得する月のリスト
+    """
+    month_runs = []
+    monthly_months = []
+    for month in target_months:
+        # URL一覧を記載するファイル名(yyyymm.txt)
+        race_url_file = RACE_URL_DIR + \
+            str(year) + str('{0:02d}'.format(month)) + ".txt"
+        if os.path.isfile(race_url_file) or \
+                (year == now_datetime.year and month == now_datetime.month):
+            monthly_months.append(month)
+        elif month_runs and month_runs[-1][1] == month - 1:
+            month_runs[-1] = (month_runs[-1][0], month)
+        else:
+            month_runs.append((month, month))
+    return month_runs, monthly_months
+
+
+def get_manifest_file(year, month):
+    """
+    月ごとのマニフェストファイル名(yyyymm.json)を返す
+    """
+    return RACE_URL_DIR + str(year) + str('{0:02d}'.format(month)) + ".json"
+
+
+def get_race_id(race_link):
+    """
+    レース情報のURL(https://db.netkeiba.com/race/<race_id>/)からレースIDを取得する
+    """
+    return race_link.split("/")[-2]
+
+
+def load_manifest(year, month):
+    """
+    月ごとのマニフェストを読み込む
+
+    マニフェストがない場合や、yyyymm.txtと件数が合わない場合はyyyymm.txtから作り直す
+
+    Args:
+        year: 年
+        month: 月
+
+    Returns:
+        dict or None: {'total_num': サイト上の件数, 'race_ids': 取得済みのレースIDのリスト,
+            'crawled_at': 最終取得日時(ISO形式)}。yyyymm.txtもない場合はNone
+    """
+    # URL一覧を記載するファイル名(yyyymm.txt)
+    race_url_file = RACE_URL_DIR + \
+        str(year) + str('{0:02d}'.format(month)) + ".txt"
+    if not os.path.isfile(race_url_file):
+        return None
+    with open(race_url_file, mode='r') as f:
+        race_links = f.read().splitlines()
+    manifest_file = get_manifest_file(year, month)
+    if os.path.isfile(manifest_file):
+        with open(manifest_file, mode='r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        if len(manifest['race_ids']) == len(race_links):
+            return manifest
+    return {
+        'total_num': len(race_links),
+        'race_ids': [get_race_id(race_link) for race_link in race_links],
+        'crawled_at': None,
+    }
+
+
+def save_manifest(year, month, total_num, race_ids):
+    """
+    月ごとのマニフェストを書き出す
+
+    Args:
+        year: 年
+        month: 月
+        total_num: サイト上の件数
+        race_ids: 取得済みのレースIDのリスト
+    """
+    manifest = {
+        'total_num': total_num,
+        'race_ids': race_ids,
+        'crawled_at': datetime.datetime.now(pytz.timezone('Asia/Tokyo')).isoformat(),
+    }
+    with open(get_manifest_file(year, month), mode='w', encoding='utf-8') as f:
+        json.dump(manifest, f)
+
+
+def write_race_index(year, month, races, mode='w'):
+    """
+    検索結果の行の情報をyyyymm.tsvに書き出す
+
+    get_race_htmlで取得対象の絞り込みと取得順の決定に使う
+
+    Args:
+        year: 年
+        month: 月
+        races: parse_search_resultが返すレース情報のリスト
+        mode: 'w'のときは上書き、'a'のときは追記
+    """
+    race_index_file = RACE_URL_DIR + \
+        str(year) + str('{0:02d}'.format(month)) + ".tsv"
+    write_header = mode == 'w' or not os.path.isfile(race_index_file)
+    with open(race_index_file, mode=mode, encoding='utf-8', newline='') as f:
+        writer = csv.writer(f, delimiter='\t')
+        if write_header:
+            writer.writerow(RACE_INDEX_COLUMNS)
+        for race in races:
+            writer.writerow([get_race_id(race['url'])] +
+                            [race[column] for column in RACE_INDEX_COLUMNS[1:]])
+
+
+def is_manifest_outdated(year, month):
+    """
+    最終取得日時がその月の終わりより前であればTrueを返す
+
+    マニフェストのない過去のファイルは取得済とみなす
+    """
+    manifest_file = get_manifest_file(year, month)
+    if not os.path.isfile(manifest_file):
+        return False
+    with open(manifest_file, mode='r', encoding='utf-8') as f:
+        crawled_at = json.load(f).get('crawled_at')
+    if crawled_at is None:
+        return False
+    next_month = datetime.datetime(
+        year + month // 12, month % 12 + 1, 1, tzinfo=now_datetime.tzinfo)
+    return datetime.datetime.fromisoformat(crawled_at) < next_month
+
+
+def get_race_url_by_month(session, driver, year, month):
+    """
+    HTTPモードで1か月分のURLを取得し、失敗した場合はSeleniumで取得し直す
+
+    Args:
+        session: HTTPセッション(NoneのときはSeleniumのみを使う)
+        driver: WebDriverインスタンス(未起動の場合はNone)
+        year: 年
+        month: 月
+
+    Returns:
+        webdriver.Firefox or None: フォールバックで起動した場合も含めたWebDriverインスタンス
+    """
+    if session is not None:
         try:
-            driver.close()
-            driver.quit()
-        except:
-            pass
+            get_race_url_by_year_and_month_with_requests(session, year, month)
+            return driver
+        except Exception as e:
+            logger.warning(
+                f"{year}年{month:02d}月のURL情報をHTTPで取得できませんでした。Seleniumで取得します: {str(e)}")
+    # フォールバック時にのみWebDriverを起動する
+    if driver is None:
+        driver = init_webdriver()
+    get_race_url_by_year_and_month(driver, year, month)
+    return driver
+
+
+def build_search_params(start_year, start_mon, end_year, end_mon, page=1, list_num=DEFAULT_LIST_NUM):
+    """
+    詳細検索フォームの送信内容と同じ検索条件のクエリを作成する
+
+    Args:
+        start_year: 開始年
+        start_mon: 開始月
+        end_year: 終了年
+        end_mon: 終了月
+        page: ページ番号(1始まり)
+        list_num: 1ページあたりの表示件数
+
+    Returns:
+        list: (パラメータ名, 値)のリスト(jyo[]は競馬場の数だけ繰り返す)
+    """
+    params = [
+        ('pid', 'race_list'),
+        ('word', ''),
+        ('start_year', str(start_year)),
+        ('start_mon', str(start_mon)),
+        ('end_year', str(end_year)),
+        ('end_mon', str(end_mon)),
+    ]
+    # JRAの競馬場を全て指定
+    params += [('jyo[]', code) for code in JRA_PLACE_CODES]
+    params += [
+        ('kyori_min', ''),
+        ('kyori_max', ''),
+        ('sort', 'date'),
+        ('list', str(list_num)),
+        ('page', str(page)),
+    ]
+    return params
+
+
+def fetch_search_page(session, params, interval):
+    """
+    検索結果のページを取得し、テキストとして返す
+
+    Args:
+        session: HTTPセッション
+        params: build_search_paramsで作成したクエリ
+        interval: リクエスト間隔を管理するRequestInterval
+
+    Returns:
+        str: 検索結果のHTML
+    """
+    interval.wait()
+    response = session.get(SEARCH_URL, params=params, timeout=30)
+    response.raise_for_status()
+    # Content-Typeに文字コードの指定がなければサイトの文字コードを使う
+    if 'charset' not in response.headers.get('Content-Type', '').lower():
+        response.encoding = SEARCH_PAGE_ENCODING
+    return response.text
+
+
+def parse_search_result(html):
+    """
+    検索結果のHTMLから総件数とレース情報のリンクを取得する
+
+    Args:
+        html: 検索結果のHTML
 
+    Returns:
+        tuple: (総件数, レース情報のリスト)。件数が取得できない場合、総件数はNone
+            レース情報は{'url': レース情報のURL, 'date': 開催日(yyyy/mm/dd), 'place': 開催情報,
+            'race_name': レース名, 'course': コース情報, 'horse_num': 頭数}の辞書
+    """
+    # 件数を取得(「1,234件中1〜20件目」の形式)
+    match = re.search(r'([\d,]+)件中', html)
+    total_num = int(match.group(1).replace(',', '')) if match else None
+    table_parser = RaceTableParser()
+    table_parser.feed(html)
+    table_parser.close()
+    races = []
+    for row in table_parser.rows:
+        # 5列目(レース名)のリンクがレース情報のURL
+        if len(row) > 4 and row[4][1]:
+            races.append({
+                'url': urljoin(SEARCH_URL, row[4][1]),
+                # 1列目が開催日
+                'date': row[0][0],
+                # 2列目が開催情報
+                'place': row[1][0],
+                'race_name': row[4][0],
+                # 7列目がコース情報、8列目が頭数
+                'course': row[6][0] if len(row) > 6 else '',
+                'horse_num': row[7][0] if len(row) > 7 else '',
+            })
+    return total_num, races
 
-def get_race_url_by_year_and_month(driver, year, month):
+
+def fetch_search_result(session, start_year, start_mon, end_year, end_mon,
+                        interval, list_num=DEFAULT_LIST_NUM, first_html=None):
+    """
+    検索結果の全ページを取得し、レース情報をまとめて返す
+
+    Args:
+        session: HTTPセッション
+        start_year: 開始年
+        start_mon: 開始月
+        end_year: 終了年
+        end_mon: 終了月
+        interval: リクエスト間隔を管理するRequestInterval
+        list_num: 1ページあたりの表示件数
+        first_html: 取得済みの1ページ目のHTML(省略時は取得する)
+
+    Returns:
+        tuple: (総件数, レース情報のリスト)
+    """
+    if first_html is None:
+        first_html = fetch_search_page(session, build_search_params(
+            start_year, start_mon, end_year, end_mon, 1, list_num), interval)
+    total_num, races = parse_search_result(first_html)
+    if total_num is None:
+        raise ValueError("件数の取得に失敗しました")
+    page = 1
+    # 全件を取得するか、ページが空になるまで次のページを取得
+    while len(races) < total_num:
+        page += 1
+        html = fetch_search_page(session, build_search_params(
+            start_year, start_mon, end_year, end_mon, page, list_num), interval)
+        _, page_races = parse_search_result(html)
+        if not page_races:
+            break
+        races += page_races
+    return total_num, races
+
+
+def get_race_url_by_period_with_requests(session, start_year, start_mon, end_year, end_mon, interval=None):
+    """
+    期間全体を1回の検索で取得し、開催日ごとにyyyymm.txtへ分割して書き出す
+
+    Args:
+        session: HTTPセッション
+        start_year: 開始年
+        start_mon: 開始月
+        end_year: 終了年
+        end_mon: 終了月
+        interval: リクエスト間隔を管理するRequestInterval(省略時はモジュール共通のもの)
+    """
+    if interval is None:
+        interval = _default_interval
+    logger.info(f"{start_year}年{start_mon:02d}月から{end_year}年{end_mon:02d}月までのURL情報をまとめて取得します")
+    total_num, races = fetch_search_result(
+        session, start_year, start_mon, end_year, end_mon, interval, MAX_LIST_NUM)
+    # 一部しか取得できなかった場合は月のファイルが欠けるため書き出さない
+    if len(races) < total_num:
+        raise ValueError(f"{total_num}件中{len(races)}件しか取得できませんでした")
+    # 期間内の全ての月を用意し、レースのない月も空のファイルとして書き出す
+    races_by_month = {}
+    year, month = start_year, start_mon
+    while (year, month) <= (end_year, end_mon):
+        races_by_month[(year, month)] = []
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    for race in races:
+        match = re.match(r'(\d{4})/(\d{1,2})/\d{1,2}', race['date'])
+        if match is None:
+            raise ValueError("開催日の取得に失敗しました: " + race['date'])
+        key = (int(match.group(1)), int(match.group(2)))
+        if key not in races_by_month:
+            raise ValueError("期間外のレースが含まれています: " + race['url'])
+        races_by_month[key].append(race)
+    for (year, month), month_races in races_by_month.items():
+        race_links = [race['url'] for race in month_races]
+        # URL一覧を記載するファイル名(yyyymm.txt)
+        race_url_file = RACE_URL_DIR + \
+            str(year) + str('{0:02d}'.format(month)) + ".txt"
+        with open(race_url_file, mode='w') as f:
+            for race_link in race_links:
+                f.write(race_link + "\n")
+        save_manifest(year, month, len(race_links),
+                      [get_race_id(race_link) for race_link in race_links])
+        write_race_index(year, month, month_races)
+        logging.info(str(
+            year) + "年" + str('{0:02d}'.format(month)) + "月のURL情報を" + str(len(race_links)) + "件取得しました")
+
+
+def get_race_url_by_year_and_month_with_requests(session, year, month, interval=None):
+    """
+    ブラウザを使わずに1か月分のURL一覧を取得し、yyyymm.txtに書き出す
+
+    取得済みのレースがある場合は、検索結果(開催日の新しい順)をたどって既知のレースIDに
+    到達した時点でページ送りをやめ、新しいレースのみを追記する
+
+    Args:
+        session: HTTPセッション
+        year: 年
+        month: 月
+        interval: リクエスト間隔を管理するRequestInterval(省略時はモジュール共通のもの)
+    """
+    if interval is None:
+        interval = _default_interval
+    # URL一覧を記載するファイル名(yyyymm.txt)
+    race_url_file = RACE_URL_DIR + \
+        str(year) + str('{0:02d}'.format(month)) + ".txt"
+
+    first_html = fetch_search_page(session, build_search_params(
+        year, month, year, month, 1, MAX_LIST_NUM), interval)
+    total_num, races = parse_search_result(first_html)
+    if total_num is None:
+        raise ValueError("件数の取得に失敗しました")
+    manifest = load_manifest(year, month)
+    known_race_ids = manifest['race_ids'] if manifest else []
+    # ファイルの行数と該当したWebページの件数が一致していればスキップ
+    if total_num == len(known_race_ids):
+        save_manifest(year, month, total_num, known_race_ids)
+        logging.info(str(year) + "年" +
+                     str('{0:02d}'.format(month)) + "月までのURL情報は取得済のためスキップします")
+        return
+
+    if known_race_ids:
+        known = set(known_race_ids)
+        new_races = []
+        page = 1
+        while True:
+            new_races += [race for race in races
+                          if get_race_id(race['url']) not in known]
+            # 既知のレースIDに到達したか、最後のページであれば終了
+            if len(new_races) + len(known) >= total_num or \
+                    any(get_race_id(race['url']) in known for race in races) or \
+                    page * MAX_LIST_NUM >= total_num:
+                break
+            page += 1
+            html = fetch_search_page(session, build_search_params(
+                year, month, year, month, page, MAX_LIST_NUM), interval)
+            _, races = parse_search_result(html)
+            if not races:
+                break
+        # 追記分で件数が一致する場合のみ追記し、一致しなければ全件を取得し直す
+        if len(new_races) + len(known) == total_num:
+            new_links = [race['url'] for race in new_races]
+            with open(race_url_file, mode='a') as f:
+                for race_link in new_links:
+                    f.write(race_link + "\n")
+            save_manifest(year, month, total_num,
+                          known_race_ids + [get_race_id(race_link) for race_link in new_links])
+            write_race_index(year, month, new_races, mode='a')
+            logging.info(str(
+                year) + "年" + str('{0:02d}'.format(month)) + "月のURL情報を" + str(len(new_links)) + "件追加しました")
+            return
+        logger.warning(str(year) + "年" + str('{0:02d}'.format(month)) +
+                       "月の取得済みのURL情報が検索結果と一致しないため全件を取得し直します")
+
+    _, races = fetch_search_result(
+        session, year, month, year, month, interval, MAX_LIST_NUM, first_html)
+    race_links = [race['url'] for race in races]
+    # 途中で失敗した場合に不完全なファイルが残らないよう、全件取得後に書き出す
+    with open(race_url_file, mode='w') as f:
+        for race_link in race_links:
+            f.write(race_link + "\n")
+    save_manifest(year, month, total_num,
+                  [get_race_id(race_link) for race_link in race_links])
+    write_race_index(year, month, races)
+    # 処理結果を出力
+    logging.info(str(
+        year) + "年" + str('{0:02d}'.format(month)) + "月のURL情報を" + str(len(race_links)) + "件取得しました")
+
+
+def get_race_url_by_year_and_month(driver, year, month, interval=None):
+    if interval is None:
+        interval = _default_interval
     # URL一覧を記載するファイル名(yyyymm.txt)
     race_url_file = RACE_URL_DIR + \
         str(year) + str('{0:02d}'.format(month)) + ".txt"
 
     # Webページを開く
+    interval.wait()
     driver.get(URL)
     # 1秒待機
     time.sleep(1)
@@ -151,9 +840,10 @@ def get_race_url_by_year_and_month(driver, year, month):
 
     # フォームを送信
     form = driver.find_element(By.CSS_SELECTOR, "#db_search_detail_form > form")
+    interval.wait()
     form.submit()
-    # 5秒待機
-    time.sleep(5)
+    # 検索結果のページに遷移するまで待機
+    WebDriverWait(driver, 30).until(EC.staleness_of(form))
     # ページ上のすべての要素が読み込まれるまで10秒待機
     wait.until(EC.presence_of_all_elements_located)
     # 件数に該当するフォームの要素を取得
@@ -174,34 +864,51 @@ def get_race_url_by_year_and_month(driver, year, month):
             pre_url_num = len(f.readlines())
     # ファイルの行数と該当したWebページの件数が一致しているか
     if total_num != pre_url_num:
-        # 一致していなければ書き込みモードでファイルを開く
-        with open(race_url_file, mode='w') as f:
+        # 書き出したレースIDと索引に書き出すレース情報
+        race_ids = []
+        races = []
+        # 一致していなければ一時ファイルに書き出し、全件取得後に置き換える
+        with open(race_url_file + ".tmp", mode='w') as f:
             # 取得行数
             total_file_rows = 0
             # エラーが出るまで無限ループ
             while True:
-                # 5秒待機
-                time.sleep(5)
                 # ページ上のすべての要素が読み込まれるまで10秒待機
                 wait.until(EC.presence_of_all_elements_located)
                 # bodyのtrタグの要素数を取得
-                table_rows = driver.find_element(By.CLASS_NAME,
-                    'race_table_01').find_elements(By.TAG_NAME, "tr")
+                table = driver.find_element(By.CLASS_NAME, 'race_table_01')
+                table_rows = table.find_elements(By.TAG_NAME, "tr")
                 total_file_rows += len(table_rows) - 1
                 # 行数分ループ
                 for row in range(1, len(table_rows)):
+                    cells = table_rows[row].find_elements(By.TAG_NAME, "td")
                     # レース情報のリンクを取得し、ファイルに書き出し
-                    race_link = table_rows[row].find_elements(By.TAG_NAME,
-                        "td")[4].find_element(By.TAG_NAME, "a").get_attribute("href")
+                    race_link = cells[4].find_element(
+                        By.TAG_NAME, "a").get_attribute("href")
                     f.write(race_link + "\n")
+                    race_ids.append(get_race_id(race_link))
+                    races.append({
+                        'url': race_link,
+                        'date': cells[0].text,
+                        'place': cells[1].text,
+                        'race_name': cells[4].text,
+                        'course': cells[6].text,
+                        'horse_num': cells[7].text,
+                    })
                 try:
                     # ページを次に送る
                     target = driver.find_elements(By.LINK_TEXT, "次")[0]
+                    interval.wait()
                     # javascriptで強制的にクリック処理
                     driver.execute_script("arguments[0].click();", target)
+                    # 次のページに遷移するまで待機
+                    WebDriverWait(driver, 30).until(EC.staleness_of(table))
                 # エラーをキャッチしたらループを抜ける
                 except IndexError:
                     break
+        os.replace(race_url_file + ".tmp", race_url_file)
+        save_manifest(year, month, total_num, race_ids)
+        write_race_index(year, month, races)
         # 処理結果を出力
         logging.info(str(
             year) + "年" + str('{0:02d}'.format(month)) + "月のURL情報を" + str(total_file_rows) + "件取得しました")
@@ -212,6 +919,21 @@ def get_race_url_by_year_and_month(driver, year, month):
 
 
 if __name__ == '__main__':
+    # コマンドライン引数のパーサーを設定
+    parser = argparse.ArgumentParser(description="JRAのレースのURLを取得します")
+    parser.add_argument("--selenium", action="store_true",
+                        help="HTTPモードを使わずSeleniumで取得します")
+    parser.add_argument("--bulk", action="store_true",
+                        help="連続した未取得の月を1回の検索(100件表示)でまとめて取得します")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Seleniumで取得する場合に並列に起動するブラウザの数を指定します")
+    parser.add_argument("--period", nargs=2, metavar=("YYYYMM", "YYYYMM"),
+                        help="指定した期間を1回の検索でまとめて取得します（例: 201001 201412）")
+    args = parser.parse_args()
+    # 並列に起動するのはブラウザのみのため、HTTPモードでは指定できない
+    if args.workers > 1 and not args.selenium:
+        parser.error("--workersは--seleniumと合わせて指定してください")
+
     # ログフォーマットを定義
     formatter = "%(asctime)s [%(levelname)s]\t%(message)s"
     # ログファイルを定義
@@ -220,6 +942,18 @@ if __name__ == '__main__':
     # 処理開始をログに出力
     logger.info("URL取得処理を開始します")
     # 処理開始
-    get_race_url()
+    if args.period:
+        # 指定した期間をまとめて取得
+        (start_year, start_mon), (end_year, end_mon) = [
+            (int(yyyymm[:4]), int(yyyymm[4:])) for yyyymm in args.period]
+        session = create_session()
+        try:
+            get_race_url_by_period_with_requests(
+                session, start_year, start_mon, end_year, end_mon)
+        finally:
+            session.close()
+    else:
+        get_race_url(use_selenium=args.selenium, bulk=args.bulk,
+                     workers=args.workers)
     # 処理終了をログに出力
     logger.info("URL取得処理を終了します")
@@ -0,0 +1,402 @@
+# coding:utf-8
+"""
+取得したHTMLをyyyy/mm単位で保存・読み込みする
+
+packed形式では1か月分のHTMLを1つの圧縮アーカイブ(yyyy/mm.pack)にまとめ、
+索引(yyyy/mm.idx)でキー(レースIDなど)ごとに読み込む
+loose形式では従来通りyyyy/mm/<キー>.htmlに1ファイルずつ保存する
+読み込みはどちらの形式にも対応する
+
+既存のloose形式のファイルは以下のコマンドでpacked形式に移行できる
+python html_store.py --migrate html
+書き直し・削除で使われなくなった領域は以下のコマンドで詰められる(取得・変換を実行していない時に行う)
+python html_store.py --compact html
+"""
+import argparse
+import configparser
+import logging
+import os
+import threading
+import zlib
+from os import path
+
+config = configparser.ConfigParser()
+config.read(os.getcwd() + "/config.ini", encoding="utf-8")
+
+OWN_FILE_NAME = path.splitext(path.basename(__file__))[0]
+# ログファイル名
+logger = logging.getLogger(__name__)
+# 保存形式(loose or packed)
+HTML_STORE = config.get("CONST", "HTML_STORE", fallback="loose")
+
+# アーカイブの拡張子
+PACK_SUFFIX = ".pack"
+# 索引の拡張子
+INDEX_SUFFIX = ".idx"
+# loose形式のファイルの拡張子
+HTML_SUFFIX = ".html"
+# 圧縮レベル
+COMPRESS_LEVEL = 6
+# 詰め直しに使う一時ファイルの拡張子
+TMP_SUFFIX = ".tmp"
+# アーカイブのうち使われていない領域の割合がこの値以上の場合に詰め直す
+COMPACT_DEAD_RATIO = config.getfloat("CONST", "COMPACT_DEAD_RATIO", fallback=0.3)
+
+
+class HtmlArchive:
+    """
+    複数のHTMLをキーごとにまとめた圧縮アーカイブ(HtmlStoreでは1か月分を1つにまとめる)
+
+    HTMLはキーごとに圧縮してアーカイブの末尾に追記し、索引に(キー, 位置, 長さ)を追記する
+    同じキーを書き込んだ場合は後の行が有効になり、長さが-1の行は削除を表す
+    書き直し・削除した古い内容はcompactで有効な内容のみを書き直すまでアーカイブに残る
+    """
+
+    def __init__(self, archive_path):
+        self.pack_file = archive_path + PACK_SUFFIX
+        self.index_file = archive_path + INDEX_SUFFIX
+        self._index = None
+        # 索引の末尾が壊れていた場合、有効な行までのバイト数(次の追記の前に切り詰める)
+        self._truncate_at = None
+
+    def exists(self):
+        return os.path.isfile(self.index_file)
+
+    def _load_index(self):
+        if self._index is None:
+            self._recover_compaction()
+            self._index = {}
+            if self.exists():
+                # 追記の途中で中断した行は読み飛ばす(マルチバイト文字の途中で切れることもあるため1行ずつ変換する)
+                valid_size = 0
+                size = 0
+                with open(self.index_file, "rb") as f:
+                    for line in f:
+                        size += len(line)
+                        try:
+                            if not line.endswith(b"\n"):
+                                raise ValueError("改行がありません")
+                            key, offset, length = line.decode("utf-8").rstrip("\r\n").split("\t")
+                            offset, length = int(offset), int(length)
+                        except ValueError:
+                            logger.warning(f"索引の壊れた行を読み飛ばします ({self.index_file}): {line!r}")
+                            continue
+                        valid_size = size
+                        if length < 0:
+                            self._index.pop(key, None)
+                        else:
+                            self._index[key] = (offset, length)
+                if valid_size < size:
+                    self._truncate_at = valid_size
+        return self._index
+
+    def _append_index(self, line):
+        # 末尾の壊れた行を切り詰めてから追記し、次の行と1行につながらないようにする
+        if self._truncate_at is not None:
+            with open(self.index_file, "r+b") as f:
+                f.truncate(self._truncate_at)
+            self._truncate_at = None
+        with open(self.index_file, "a", encoding="utf-8") as f:
+            f.write(line)
+
+    def keys(self):
+        return set(self._load_index())
+
+    def __contains__(self, key):
+        return key in self._load_index()
+
+    def entry(self, key):
+        """
+        キーの(位置, 長さ)を返す(保存されていない場合はNone)
+        """
+        return self._load_index().get(key)
+
+    def read(self, key):
+        offset, length = self._load_index()[key]
+        with open(self.pack_file, "rb") as f:
+            f.seek(offset)
+            return zlib.decompress(f.read(length))
+
+    def write(self, key, content):
+        if isinstance(content, str):
+            content = content.encode("utf-8")
+        compressed = zlib.compress(content, COMPRESS_LEVEL)
+        index = self._load_index()
+        os.makedirs(os.path.dirname(self.pack_file), exist_ok=True)
+        # 本体を書き込んでから索引に追記するため、途中で中断しても索引は壊れない
+        with open(self.pack_file, "ab") as f:
+            offset = f.tell()
+            f.write(compressed)
+        self._append_index(f"{key}\t{offset}\t{len(compressed)}\n")
+        index[key] = (offset, len(compressed))
+
+    def delete(self, key):
+        index = self._load_index()
+        if key not in index:
+            return
+        self._append_index(f"{key}\t0\t-1\n")
+        del index[key]
+
+    def dead_bytes(self):
+        """
+        アーカイブのうち書き直し・削除で使われなくなった領域のバイト数を返す
+        """
+        if not os.path.isfile(self.pack_file):
+            return 0
+        live_bytes = sum(length for _, length in self._load_index().values())
+        return os.path.getsize(self.pack_file) - live_bytes
+
+    def compact(self):
+        """
+        有効な内容のみを一時ファイルのアーカイブと索引に書き直し、os.replaceで置き換える
+
+        索引を置き換えてからアーカイブを置き換えるため、その間で中断した場合は
+        次に索引を読み込む時にアーカイブの置き換えを行う(_recover_compaction)
+        内容の位置が変わるため、HtmlStore.statの値も変わる
+
+        Returns:
+            int: 削減したバイト数
+        """
+        dead_bytes = self.dead_bytes()
+        if dead_bytes <= 0:
+            return 0
+        index = self._load_index()
+        tmp_pack_file = self.pack_file + TMP_SUFFIX
+        tmp_index_file = self.index_file + TMP_SUFFIX
+        new_index = {}
+        with open(self.pack_file, "rb") as src, open(tmp_pack_file, "wb") as pack, \
+                open(tmp_index_file, "w", encoding="utf-8") as index_f:
+            # 元のアーカイブの位置の順に読み、読み込みを先頭から順に行う
+            for key, (offset, length) in sorted(index.items(), key=lambda item: item[1][0]):
+                src.seek(offset)
+                new_index[key] = (pack.tell(), length)
+                pack.write(src.read(length))
+                index_f.write(f"{key}\t{new_index[key][0]}\t{length}\n")
+            for f in (pack, index_f):
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_index_file, self.index_file)
+        os.replace(tmp_pack_file, self.pack_file)
+        self._index = new_index
+        self._truncate_at = None
+        return dead_bytes
+
+    def _recover_compaction(self):
+        # 索引のみ置き換えて中断した場合はアーカイブも置き換え、それ以前に中断した場合は一時ファイルを削除する
+        tmp_pack_file = self.pack_file + TMP_SUFFIX
+        tmp_index_file = self.index_file + TMP_SUFFIX
+        if os.path.isfile(tmp_index_file):
+            os.remove(tmp_index_file)
+            if os.path.isfile(tmp_pack_file):
+                os.remove(tmp_pack_file)
+        elif os.path.isfile(tmp_pack_file):
+            logger.info(f"中断した詰め直しのアーカイブを置き換えます: {self.pack_file}")
+            os.replace(tmp_pack_file, self.pack_file)
+
+
+class HtmlStore:
+    """
+    base_dir配下にyyyy/mm単位でHTMLを保存・読み込みする
+
+    Args:
+        base_dir: 保存先のフォルダ(末尾にスラッシュを含む)
+        packed: Trueのときはpacked形式、Falseのときはloose形式で書き込む
+            (省略時はconfig.iniのHTML_STOREに従う)
+    """
+
+    def __init__(self, base_dir, packed=None):
+        self.base_dir = base_dir
+        self.packed = HTML_STORE == "packed" if packed is None else packed
+        self._archives = {}
+        self._lock = threading.Lock()
+
+    def month_dir(self, year, month):
+        """
+        loose形式のフォルダ(yyyy/mm)を返す。アーカイブと索引はこの名前に拡張子を付ける
+        """
+        return self.base_dir + f"{year}/{month:02d}"
+
+    def _archive(self, year, month):
+        if (year, month) not in self._archives:
+            self._archives[(year, month)] = HtmlArchive(self.month_dir(year, month))
+        return self._archives[(year, month)]
+
+    def list_keys(self, year, month):
+        """
+        対象年月に保存されているキーの一覧を返す
+        """
+        keys = self._archive(year, month).keys()
+        month_dir = self.month_dir(year, month)
+        if os.path.isdir(month_dir):
+            keys |= {
+                file_name[:-len(HTML_SUFFIX)]
+                for file_name in os.listdir(month_dir)
+                if file_name.endswith(HTML_SUFFIX)
+            }
+        return keys
+
+    def exists(self, year, month, key):
+        return key in self._archive(year, month) or os.path.isfile(
+            self._loose_file(year, month, key)
+        )
+
+    def stat(self, year, month, key):
+        """
+        HTMLが変更されたかを判定するための情報を返す
+
+        loose形式は[サイズ, 更新時刻]、packed形式は[長さ, アーカイブ内の位置]を返す
+        (packed形式は書き直すと末尾に追記するため位置が変わる)
+        """
+        entry = self._archive(year, month).entry(key)
+        if entry is not None:
+            offset, length = entry
+            return [length, offset]
+        stat = os.stat(self._loose_file(year, month, key))
+        return [stat.st_size, stat.st_mtime]
+
+    def read(self, year, month, key):
+        """
+        HTMLをバイト列として読み込む
+        """
+        archive = self._archive(year, month)
+        if key in archive:
+            return archive.read(key)
+        with open(self._loose_file(year, month, key), "rb") as f:
+            return f.read()
+
+    def write(self, year, month, key, content):
+        """
+        HTMLを書き込む。文字列はUTF-8でエンコードする
+        """
+        if isinstance(content, str):
+            content = content.encode("utf-8")
+        with self._lock:
+            if self.packed:
+                os.makedirs(os.path.dirname(self.month_dir(year, month)), exist_ok=True)
+                self._archive(year, month).write(key, content)
+                return
+            os.makedirs(self.month_dir(year, month), exist_ok=True)
+            with open(self._loose_file(year, month, key), "wb") as f:
+                f.write(content)
+
+    def delete(self, year, month, key):
+        with self._lock:
+            self._archive(year, month).delete(key)
+            loose_file = self._loose_file(year, month, key)
+            if os.path.isfile(loose_file):
+                os.remove(loose_file)
+
+    def migrate(self, year, month):
+        """
+        対象年月のloose形式のファイルをアーカイブに移し、元のファイルを削除する
+
+        Returns:
+            int: 移行したファイルの件数
+        """
+        month_dir = self.month_dir(year, month)
+        if not os.path.isdir(month_dir):
+            return 0
+        archive = self._archive(year, month)
+        migrated = 0
+        for file_name in sorted(os.listdir(month_dir)):
+            if not file_name.endswith(HTML_SUFFIX):
+                continue
+            loose_file = month_dir + "/" + file_name
+            with open(loose_file, "rb") as f:
+                archive.write(file_name[:-len(HTML_SUFFIX)], f.read())
+            os.remove(loose_file)
+            migrated += 1
+        # 空になったフォルダは削除する
+        if not os.listdir(month_dir):
+            os.rmdir(month_dir)
+        return migrated
+
+    def _loose_file(self, year, month, key):
+        return self.month_dir(year, month) + "/" + key + HTML_SUFFIX
+
+
+def compact_html_dir(base_dir, min_dead_ratio=COMPACT_DEAD_RATIO):
+    """
+    base_dir配下の全てのアーカイブ(月ごとのアーカイブ、プロフィールのアーカイブ)のうち、
+    使われていない領域の割合がmin_dead_ratio以上のものを詰め直す
+
+    Args:
+        base_dir: 対象のフォルダ(末尾にスラッシュを含む)
+        min_dead_ratio: 詰め直す使われていない領域の割合
+    """
+    total = 0
+    for dir_path, _, file_names in sorted(os.walk(base_dir)):
+        for file_name in sorted(file_names):
+            if not file_name.endswith(INDEX_SUFFIX):
+                continue
+            archive = HtmlArchive(os.path.join(dir_path, file_name[:-len(INDEX_SUFFIX)]))
+            if not os.path.isfile(archive.pack_file):
+                continue
+            pack_size = os.path.getsize(archive.pack_file)
+            if pack_size == 0 or archive.dead_bytes() / pack_size < min_dead_ratio:
+                continue
+            reclaimed = archive.compact()
+            logger.info(f"{archive.pack_file}を詰め直し、{reclaimed}バイト削減しました")
+            total += reclaimed
+    logger.info(f"{base_dir}のアーカイブを詰め直し、合計{total}バイト削減しました")
+    return total
+
+
+def migrate_html_dir(base_dir):
+    """
+    base_dir配下のyyyy/mmフォルダを全てpacked形式に移行する
+
+    Args:
+        base_dir: 移行するフォルダ(末尾にスラッシュを含む)
+    """
+    store = HtmlStore(base_dir, packed=True)
+    total = 0
+    for year_name in sorted(os.listdir(base_dir)):
+        if not (year_name.isdigit() and os.path.isdir(base_dir + year_name)):
+            continue
+        for month_name in sorted(os.listdir(base_dir + year_name)):
+            if not (month_name.isdigit() and os.path.isdir(base_dir + year_name + "/" + month_name)):
+                continue
+            migrated = store.migrate(int(year_name), int(month_name))
+            logger.info(f"{year_name}年{month_name}月のHTMLを{migrated}件アーカイブに移行しました")
+            total += migrated
+    logger.info(f"{base_dir}のHTMLを合計{total}件アーカイブに移行しました")
+
+
+if __name__ == "__main__":
+    # コマンドライン引数のパーサーを設定
+    parser = argparse.ArgumentParser(description="保存したHTMLをアーカイブに移行・詰め直します")
+    command = parser.add_mutually_exclusive_group(required=True)
+    command.add_argument(
+        "--migrate",
+        metavar="DIR",
+        help="移行するフォルダを指定します（例: html, html_kyotei）",
+    )
+    command.add_argument(
+        "--compact",
+        metavar="DIR",
+        help="アーカイブを詰め直すフォルダを指定します（例: html, html_kyotei, html_profile）",
+    )
+    parser.add_argument(
+        "--min-dead-ratio",
+        type=float,
+        default=COMPACT_DEAD_RATIO,
+        help="使われていない領域の割合がこの値以上のアーカイブのみ詰め直します（0で全て）",
+    )
+    args = parser.parse_args()
+
+    # ログフォーマットを定義
+    formatter = "%(asctime)s [%(levelname)s]\t%(message)s"
+    # ログファイルを定義
+    logging.basicConfig(
+        filename="log/activity.log", level=logging.INFO, format=formatter
+    )
+    # 処理開始をログに出力
+    logger.info("HTML移行処理を開始します")
+    # 処理開始
+    if args.compact:
+        compact_html_dir(os.getcwd() + "/" + args.compact.strip("/") + "/", args.min_dead_ratio)
+    else:
+        migrate_html_dir(os.getcwd() + "/" + args.migrate.strip("/") + "/")
+    # 処理終了をログに出力
+    logger.info("HTML移行処理を終了します")
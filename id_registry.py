@@ -0,0 +1,168 @@
+# coding:utf-8
+"""
+馬・騎手・調教師・馬主のキー番号(netkeibaのID)に整数のコードを割り当ててSQLiteに記録する
+
+コードは種類ごとに0から順に割り当て、一度割り当てたコードは年や実行をまたいで変わらない
+convert_csv_into_htmlは馬データのCSVにキー番号の代わりにコードを保存するため、
+このデータベースはCSVと一緒に保管する(失うとコードからキー番号に戻せなくなる)
+コードを割り当てるのはconvert_csv_into_htmlのみとし、同時に複数の処理から割り当てない
+
+割り当てた件数は以下のコマンドで確認できる
+python id_registry.py --summary
+python id_registry.py --decode horse 0
+"""
+import argparse
+import configparser
+import os
+import sqlite3
+from os import path
+
+import numpy as np
+import pandas as pd
+
+config = configparser.ConfigParser()
+config.read(os.getcwd() + "/config.ini", encoding="utf-8")
+
+OWN_FILE_NAME = path.splitext(path.basename(__file__))[0]
+# csvファイルを格納するフォルダ
+CSV_DIR = os.getcwd() + config.get("DIR", "CSV_DIR")
+# コードを記録するデータベース
+ID_REGISTRY_DB = CSV_DIR + "id_registry.db"
+# メモリ上のみに記録する場合のデータベース名(sqlite3の指定)
+MEMORY_DB = ":memory:"
+
+# 種類
+ENTITY_KINDS = ("horse", "jockey", "trainer", "owner")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entity_code (
+    kind TEXT NOT NULL,
+    entity_id TEXT NOT NULL,
+    code INTEGER NOT NULL,
+    PRIMARY KEY (kind, entity_id),
+    UNIQUE (kind, code)
+);
+"""
+
+
+class IdRegistry:
+    """
+    種類ごとにキー番号と整数のコードを対応付ける
+
+    割り当てたコードはメモリ上に溜め、saveでデータベースに書き込む
+    コードを使ったデータを保存する前に必ずsaveを呼ぶ
+
+    Args:
+        db_file: データベースのファイル名(省略時はID_REGISTRY_DB、MEMORY_DBのときは保存しない)
+    """
+
+    def __init__(self, db_file=ID_REGISTRY_DB):
+        self.db_file = db_file
+        # 接続は初めて使う時に行う(並列処理のプロセスなど、使わない場合は接続しない)
+        self._conn = None
+        # 種類ごとのキー番号 → コード
+        self._codes = {}
+        # 種類ごとのコード順のキー番号
+        self._ids = {}
+        # 書き込んでいない(種類, キー番号, コード)のリスト
+        self._pending = []
+
+    def _connect(self):
+        if self._conn is None:
+            if self.db_file != MEMORY_DB:
+                os.makedirs(os.path.dirname(self.db_file), exist_ok=True)
+            self._conn = sqlite3.connect(self.db_file)
+            self._conn.executescript(SCHEMA)
+        return self._conn
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def _load(self, kind):
+        if kind not in self._codes:
+            rows = self._connect().execute(
+                "SELECT entity_id, code FROM entity_code WHERE kind = ? ORDER BY code", (kind,)
+            ).fetchall()
+            self._ids[kind] = [entity_id for entity_id, _ in rows]
+            self._codes[kind] = {entity_id: code for entity_id, code in rows}
+        return self._codes[kind]
+
+    def encode(self, kind, entity_id):
+        """
+        キー番号のコードを返す。初めてのキー番号には次のコードを割り当てる
+        """
+        codes = self._load(kind)
+        code = codes.get(entity_id)
+        if code is None:
+            code = len(codes)
+            codes[entity_id] = code
+            self._ids[kind].append(entity_id)
+            self._pending.append((kind, entity_id, code))
+        return code
+
+    def save(self):
+        """
+        割り当てたコードをデータベースに書き込む
+        """
+        if not self._pending:
+            return
+        conn = self._connect()
+        with conn:
+            conn.executemany(
+                "INSERT INTO entity_code (kind, entity_id, code) VALUES (?, ?, ?)", self._pending
+            )
+        self._pending = []
+
+    def decode(self, kind, codes):
+        """
+        コードの配列をキー番号の配列にする(欠損値はNone)
+
+        Args:
+            kind: 種類
+            codes: コードの配列(Series、リストなど)
+
+        Returns:
+            numpy.ndarray: キー番号の配列
+        """
+        self._load(kind)
+        # 末尾にNoneを加え、欠損値を-1として参照する
+        ids = np.array(self._ids[kind] + [None], dtype=object)
+        positions = pd.array(codes, dtype="Int64").fillna(-1).to_numpy(dtype="int64")
+        return ids[positions]
+
+    def summary(self):
+        """
+        種類ごとの割り当てた件数を返す
+        """
+        return {kind: len(self._load(kind)) for kind in ENTITY_KINDS}
+
+
+if __name__ == "__main__":
+    # コマンドライン引数のパーサーを設定
+    parser = argparse.ArgumentParser(description="キー番号に割り当てたコードを表示します")
+    parser.add_argument(
+        "--summary",
+        action="store_true",
+        help="種類ごとの割り当てた件数を表示します",
+    )
+    parser.add_argument(
+        "--decode",
+        nargs="+",
+        metavar=("KIND", "CODE"),
+        help="コードをキー番号に戻して表示します（例: horse 0 1 2）",
+    )
+    args = parser.parse_args()
+
+    registry = IdRegistry()
+    try:
+        if args.summary:
+            for kind, count in registry.summary().items():
+                print(f"{kind}\t{count}")
+        if args.decode:
+            kind, codes = args.decode[0], [int(code) for code in args.decode[1:]]
+            for code, entity_id in zip(codes, registry.decode(kind, codes)):
+                print(f"{code}\t{entity_id}")
+    finally:
+        registry.close()
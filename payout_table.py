@@ -0,0 +1,134 @@
+# coding:utf-8
+"""
+払い戻しを(レース, 券種, 組み合わせ)ごとの1行で扱う
+
+convert_csv_into_htmlは払い戻しの表の各行を券種・組み合わせ(馬番、枠連は枠番)・払戻金の行にし、
+payout-yyyy.csvに保存する
+組み合わせは馬番を1つの整数(1着・1頭目 * 10000 + 2着・2頭目 * 100 + 3着・3頭目)にし、
+順序を問わない券種は馬番を昇順に並べてから整数にする(例: 馬連 2 - 1 → 10200、3連単 1 → 2 → 3 → 10203)
+
+PayoutIndexで多数のレースの払戻金をまとめて引ける
+index = PayoutIndex(payout_df)
+index.lookup(race_ids, "exacta", [(1, 2)] * len(race_ids))
+"""
+import numpy as np
+import pandas as pd
+
+# ページの券種の表記と券種
+BET_TYPE_NAMES = {
+    "単勝": "win",
+    "複勝": "place",
+    "枠連": "bracket_quinella",
+    "馬連": "quinella",
+    "ワイド": "quinella_place",
+    "馬単": "exacta",
+    "三連複": "trio",
+    "3連複": "trio",
+    "三連単": "trifecta",
+    "3連単": "trifecta",
+}
+# 券種(索引ではこの順の番号を使う)
+BET_TYPES = (
+    "win",
+    "place",
+    "bracket_quinella",
+    "quinella",
+    "quinella_place",
+    "exacta",
+    "trio",
+    "trifecta",
+)
+# 組み合わせの順序を問わない券種
+UNORDERED_BET_TYPES = {"bracket_quinella", "quinella", "quinella_place", "trio"}
+# 組み合わせの馬番の最大数
+MAX_NUMBERS = 3
+# 組み合わせを整数にする時の1頭あたりの桁(100: 2桁)
+NUMBER_BASE = 100
+# 索引のキーのうち、券種の番号の桁(組み合わせの整数はこの値未満)
+BET_TYPE_BASE = NUMBER_BASE ** MAX_NUMBERS
+# 索引のキーのうち、レースの位置の桁
+RACE_BASE = BET_TYPE_BASE * len(BET_TYPES)
+
+
+def encode_combination(bet_type, numbers):
+    """
+    組み合わせの馬番を整数にする(例: exacta, [1, 2] → 10200)
+    """
+    numbers = list(numbers)
+    return int(encode_combinations(bet_type, np.array([numbers + [0] * (MAX_NUMBERS - len(numbers))]))[0])
+
+
+def encode_combinations(bet_type, combinations):
+    """
+    組み合わせの配列を整数の配列にする
+
+    Args:
+        bet_type: 券種
+        combinations: 整数にした組み合わせの配列、または馬番の2次元配列(レース数 x 頭数)
+
+    Returns:
+        numpy.ndarray: 整数にした組み合わせの配列
+    """
+    combinations = np.asarray(combinations, dtype="int64")
+    if combinations.ndim == 1:
+        return combinations
+    if bet_type in UNORDERED_BET_TYPES:
+        # 使わない位置(0)は末尾のままにして昇順に並べる
+        combinations = np.sort(np.where(combinations == 0, NUMBER_BASE, combinations), axis=1)
+        combinations[combinations == NUMBER_BASE] = 0
+    weights = NUMBER_BASE ** np.arange(MAX_NUMBERS - 1, MAX_NUMBERS - 1 - combinations.shape[1], -1)
+    return combinations @ weights
+
+
+class PayoutIndex:
+    """
+    (レース, 券種, 組み合わせ)を1つの整数のキーにして並べ、二分探索で払戻金を引く
+
+    Args:
+        payouts: race_id、bet_type、combination、payoutの列を持つデータフレーム
+    """
+
+    def __init__(self, payouts):
+        self._race_ids = np.unique(np.asarray(payouts["race_id"], dtype=str))
+        race_positions = np.searchsorted(self._race_ids, np.asarray(payouts["race_id"], dtype=str))
+        bet_type_codes = pd.Categorical(payouts["bet_type"], categories=BET_TYPES).codes
+        keys = (
+            race_positions.astype("int64") * RACE_BASE
+            + bet_type_codes.astype("int64") * BET_TYPE_BASE
+            + np.asarray(payouts["combination"], dtype="int64")
+        )
+        # 券種がBET_TYPESにない行は除く
+        valid = bet_type_codes >= 0
+        order = np.argsort(keys[valid], kind="stable")
+        self._keys = keys[valid][order]
+        # 払戻金を読み取れなかった行は0とする
+        payout_values = pd.array(payouts["payout"], dtype="Int64").fillna(0).to_numpy(dtype="int64")
+        self._payouts = payout_values[valid][order]
+
+    def lookup(self, race_ids, bet_type, combinations):
+        """
+        レースごとに券種・組み合わせの払戻金を返す(的中しなかった組み合わせ・レースがない場合は0)
+
+        Args:
+            race_ids: レースIDの配列
+            bet_type: 券種(BET_TYPESのいずれか)
+            combinations: レースごとの組み合わせ(encode_combinationsに渡す配列)
+
+        Returns:
+            numpy.ndarray: 払戻金の配列
+        """
+        race_ids = np.asarray(race_ids, dtype=str)
+        race_positions = np.searchsorted(self._race_ids, race_ids)
+        found = race_positions < len(self._race_ids)
+        found[found] = self._race_ids[race_positions[found]] == race_ids[found]
+        keys = (
+            race_positions.astype("int64") * RACE_BASE
+            + BET_TYPES.index(bet_type) * BET_TYPE_BASE
+            + encode_combinations(bet_type, combinations)
+        )
+        positions = np.searchsorted(self._keys, keys)
+        found &= positions < len(self._keys)
+        found[found] = self._keys[positions[found]] == keys[found]
+        payouts = np.zeros(len(race_ids), dtype="int64")
+        payouts[found] = self._payouts[positions[found]]
+        return payouts
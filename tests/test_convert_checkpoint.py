@@ -0,0 +1,119 @@
+# coding:utf-8
+"""
+ストリーミング変換の最後に置き換えた行を削除する処理が、途中で中断しても行を失わないことを確認する
+
+python -m pytest tests
+"""
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import pandas as pd
+
+import convert_csv_into_html as converter
+
+# 対象年
+YEAR = 2000
+# 変換済みのレースID
+OLD_RACE_IDS = [f"2000010101{no:02d}" for no in range(1, 7)]
+# 変換し直したレースID(CSVの末尾に追記した行がある)
+CHANGED_RACE_IDS = [OLD_RACE_IDS[1], OLD_RACE_IDS[3]]
+# レースごとの馬の行数
+HORSES_PER_RACE = 2
+
+
+class CrashError(Exception):
+    pass
+
+
+class FinishConvertCheckpointTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        patcher = mock.patch.object(converter, "STATE_DIR", self.tmp_dir + "/")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.race_csv = os.path.join(self.tmp_dir, "race.csv")
+        self.horse_csv = os.path.join(self.tmp_dir, "horse.csv")
+        # 変換済みの行の後に、変換し直した行を追記した状態のCSV
+        pd.DataFrame({
+            "race_id": OLD_RACE_IDS + CHANGED_RACE_IDS,
+            "race_name": ["old"] * len(OLD_RACE_IDS) + ["new"] * len(CHANGED_RACE_IDS),
+        }).to_csv(self.race_csv, index=False)
+        horse_race_ids = OLD_RACE_IDS * HORSES_PER_RACE
+        pd.DataFrame({
+            "race_id": horse_race_ids + CHANGED_RACE_IDS * HORSES_PER_RACE,
+            "horse_name": ["old"] * len(horse_race_ids) + ["new"] * len(CHANGED_RACE_IDS) * HORSES_PER_RACE,
+        }).to_csv(self.horse_csv, index=False)
+        self.manifest = {race_id: {"month": 1} for race_id in OLD_RACE_IDS}
+        self.checkpoint = {
+            "old_rows": {self.race_csv: len(OLD_RACE_IDS), self.horse_csv: len(horse_race_ids)},
+            "pending_drop": sorted(CHANGED_RACE_IDS),
+            "sizes": {csv_file: os.path.getsize(csv_file) for csv_file in (self.race_csv, self.horse_csv)},
+        }
+        converter.save_convert_manifest(YEAR, self.manifest, self.checkpoint)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def finish_with_crash(self, crash_on, finish=None):
+        """
+        crash_onに一致するファイルをos.replaceで置き換える時に中断したことにして削除を行う
+
+        finishを省略した場合は最初の変換の最後の削除、指定した場合はその処理(再開など)を中断する
+        """
+        if finish is None:
+            def finish():
+                converter.finish_convert_checkpoint(YEAR, dict(self.manifest), dict(self.checkpoint))
+        real_replace = os.replace
+
+        def replace(src, dst):
+            if crash_on(src, dst):
+                raise CrashError(dst)
+            real_replace(src, dst)
+
+        with mock.patch("os.replace", side_effect=replace):
+            with self.assertRaises(CrashError):
+                finish()
+
+    def assert_rows_kept(self):
+        self.assertIsNone(converter.load_convert_checkpoint(YEAR))
+        race_df = pd.read_csv(self.race_csv, dtype=str)
+        self.assertEqual(sorted(race_df["race_id"]), sorted(OLD_RACE_IDS))
+        self.assertEqual(
+            sorted(race_df.loc[race_df["race_name"] == "new", "race_id"]), sorted(CHANGED_RACE_IDS))
+        horse_df = pd.read_csv(self.horse_csv, dtype=str)
+        self.assertEqual(len(horse_df), len(OLD_RACE_IDS) * HORSES_PER_RACE)
+        self.assertEqual(
+            sorted(horse_df.loc[horse_df["horse_name"] == "new", "race_id"]),
+            sorted(CHANGED_RACE_IDS * HORSES_PER_RACE))
+        self.assertFalse(os.path.isfile(converter.get_drop_tmp_file(self.race_csv)))
+        self.assertFalse(os.path.isfile(converter.get_drop_tmp_file(self.horse_csv)))
+
+    def test_crash_after_some_csv_replaced(self):
+        # 1つ目のCSVを置き換えた後、2つ目のCSVを置き換える前に中断
+        self.finish_with_crash(lambda src, dst: dst == self.horse_csv)
+        converter.restore_convert_checkpoint(YEAR)
+        self.assert_rows_kept()
+
+    def test_crash_before_replacing(self):
+        # 一時ファイルを書き出した後、置き換えの段階に入ったことを記録する前に中断
+        self.finish_with_crash(lambda src, dst: dst == converter.get_convert_manifest_file(YEAR))
+        converter.restore_convert_checkpoint(YEAR)
+        self.assert_rows_kept()
+
+    def test_restore_twice(self):
+        # 再開した処理も中断し、もう一度再開する
+        self.finish_with_crash(lambda src, dst: dst == self.horse_csv)
+        self.finish_with_crash(
+            lambda src, dst: dst == self.horse_csv,
+            lambda: converter.restore_convert_checkpoint(YEAR))
+        converter.restore_convert_checkpoint(YEAR)
+        converter.restore_convert_checkpoint(YEAR)
+        self.assert_rows_kept()
+
+
+if __name__ == "__main__":
+    unittest.main()